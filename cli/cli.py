@@ -1,16 +1,12 @@
-from cli_storage_aws import AwsStorageCli
-from cli_storage_openstack import OpenStackStorageCli
-from cli_cloudformation import CloudFormationCli
-from cli_cloudwatch import CloudWatchCli
-from cli_compute_openstack import OpenStackComputeCli
-from cli_elb import ElbCli
-from cli_compute_aws import AwsComputeCli
+from logic.imports import lazy_import
 from menu import Menu, MenuEntry
 
 
 class Cli:
     """
     The CLI class represents the main menu, offering access to different sub menus
+
+    Each sub menu (and therefore the provider SDK it uses) is only imported when it is entered for the first time
     """
 
     def __init__(self):
@@ -51,40 +47,40 @@ class Cli:
         """
         AWS Compute sub menu
         """
-        AwsComputeCli()
+        lazy_import('cli.cli_compute_aws').AwsComputeCli()
 
     def aws_storage(self):
         """
         AWS Storage sub menu
         """
-        AwsStorageCli()
+        lazy_import('cli.cli_storage_aws').AwsStorageCli()
 
     def aws_cloudwatch(self):
         """
         AWS CloudWatch sub menu
         """
-        CloudWatchCli()
+        lazy_import('cli.cli_cloudwatch').CloudWatchCli()
 
     def aws_elb(self):
         """
         AWS Elastic Load Balancer sub menu
         """
-        ElbCli()
+        lazy_import('cli.cli_elb').ElbCli()
 
     def aws_cloudformation(self):
         """
         AWS CloudFormation sub menu
         """
-        CloudFormationCli()
+        lazy_import('cli.cli_cloudformation').CloudFormationCli()
 
     def openstack_storage(self):
         """
         OpenStack storage sub menu
         """
-        OpenStackStorageCli()
+        lazy_import('cli.cli_storage_openstack').OpenStackStorageCli()
 
     def openstack_compute(self):
         """
         OpenStack compute sub menu
         """
-        OpenStackComputeCli()
+        lazy_import('cli.cli_compute_openstack').OpenStackComputeCli()
@@ -33,7 +33,7 @@ class AwsComputeCli:
         :return: Instance id of a running instance, false value if cancelled
         """
 
-        instances = self.compute.get_running_instances_ids()
+        instances = list(self.compute.get_running_instances_ids())
 
         # No instances
         if not instances:
@@ -78,7 +78,7 @@ class AwsComputeCli:
         :return: Instance id of a stopped instance, false value if cancelled
         """
 
-        instances = self.compute.get_not_running_instances_ids()
+        instances = list(self.compute.get_not_running_instances_ids())
 
         # No instances
         if not instances:
@@ -83,7 +83,7 @@ class StorageCli:
 
         # List the name of containers
         print 'Choose an object:'
-        objects = self.storage.get_objects_names(container_name)
+        objects = list(self.storage.get_objects_names(container_name) or [])
 
         # No objects
         if not len(objects):
@@ -0,0 +1,956 @@
+import argparse
+import shlex
+import sys
+import time
+
+from logic.connections import Connection
+from logic.imports import lazy_import
+
+
+class Session:
+    """
+    Logic handlers shared by every command executed in the same process
+
+    The handlers are created the first time a command needs them and reused afterwards, so a batch of commands
+    reuses the same clients and caches instead of creating them once per operation
+    """
+
+    # Module and class of the logic handler of each group of commands
+    HANDLERS = {
+        'compute': ('logic.compute_aws', 'AwsCompute'),
+        'storage': ('logic.storage_aws', 'AwsStorage'),
+        'cloudwatch': ('logic.cloudwatch', 'CloudWatch'),
+        'elb': ('logic.elastic_load_balancer', 'ElasticLoadBalancing'),
+        'cloudformation': ('logic.cloudformation', 'CloudFormation'),
+        'openstack-compute': ('logic.compute_openstack', 'OpenStackCompute'),
+        'openstack-storage': ('logic.storage_openstack', 'OpenStackStorage'),
+    }
+
+    def __init__(self):
+        """
+        Init the (empty) collection of handlers
+        """
+        self._handlers = {}
+
+    def get(self, name):
+        """
+        Get a logic handler, creating it the first time
+
+        :param name: Name of the group of commands (e.g. 'compute')
+        :return: Logic handler
+        """
+        handler = self._handlers.get(name)
+        if handler is None:
+            module, cls = self.HANDLERS[name]
+            handler = getattr(lazy_import(module), cls)()
+            self._handlers[name] = handler
+        return handler
+
+
+class CommandLine:
+    """
+    Non-interactive entry point, which executes commands such as 'compute stop i-123 i-456' without the menus
+
+    Commands can be run one by one or in batches (read from a file or the standard input), and all the commands
+    executed by the same CommandLine share its Session
+    """
+
+    def __init__(self, session=None):
+        """
+        Store the session and build the command parser
+
+        :param session: Session with the logic handlers (a new one by default)
+        """
+        self.session = session or Session()
+        self.parser = self._build_parser()
+
+    @staticmethod
+    def _add_command(group, name, f, description):
+        """
+        Add a command to a group of commands
+
+        :param group: Subparsers of the group
+        :param name: Name of the command
+        :param f: Function executing the command
+        :param description: Description of the command
+        :return: Parser of the command, to add its arguments
+        """
+        parser = group.add_parser(name, help=description, description=description)
+        parser.set_defaults(f=f)
+        return parser
+
+    @staticmethod
+    def _add_instance_filters(parser, state=False):
+        """
+        Add the options to filter EC2 instances to a command
+        The values may contain wildcards (*)
+
+        :param parser: Parser of the command
+        :param state: True to add the instance state option
+        """
+        if state:
+            parser.add_argument('--state', help='instance state (e.g. running, stopped)')
+        parser.add_argument('--type', dest='instance_type', help='instance type (e.g. t2.micro)')
+        parser.add_argument('--zone', help='availability zone (e.g. eu-west-1a)')
+        parser.add_argument('--ami', help='AMI of the instances')
+        parser.add_argument('--tag', action='append', default=[], metavar='KEY[=VALUE]',
+                            help='tag of the instances (can be repeated)')
+
+    @staticmethod
+    def _add_scope_options(parser):
+        """
+        Add the options to query many regions and accounts concurrently to a command
+
+        :param parser: Parser of the command
+        """
+        parser.add_argument('--regions', help='comma separated regions to query concurrently, or "all" '
+                                              '(the configured region by default)')
+        parser.add_argument('--accounts', help='comma separated profiles to query concurrently, or "all" '
+                                               '(the [aws] credentials by default)')
+
+    @staticmethod
+    def _regions(args):
+        """
+        Get the regions selected by the options of a command
+
+        :param args: Parsed arguments
+        :return: Region names, None for the configured region
+        """
+        if not args.regions:
+            return None
+        return Connection().get_regions(args.regions)
+
+    @staticmethod
+    def _accounts(args):
+        """
+        Get the accounts (profiles) selected by the options of a command
+
+        :param args: Parsed arguments
+        :return: Profile names, None for the [aws] credentials
+        """
+        if not args.accounts:
+            return None
+        return Connection().get_profiles(args.accounts)
+
+    @staticmethod
+    def _add_openstack_regions_option(parser):
+        """
+        Add the option to query many OpenStack regions concurrently to a command
+
+        :param parser: Parser of the command
+        """
+        parser.add_argument('--regions', help='comma separated regions to query concurrently, or "all" (every compute '
+                                              'region of the catalog; the configured region by default)')
+
+    @staticmethod
+    def _openstack_regions(args):
+        """
+        Get the OpenStack regions selected by the options of a command
+
+        :param args: Parsed arguments
+        :return: Region names, None for the configured region
+        """
+        if not args.regions:
+            return None
+        return Connection().get_openstack_regions(args.regions)
+
+    @staticmethod
+    def _add_wait_options(parser, resources='instances'):
+        """
+        Add the options to wait for the resources to reach their final state to a command
+
+        :param parser: Parser of the command
+        :param resources: Name of the resources, for the help
+        """
+        parser.add_argument('--wait', action='store_true',
+                            help='wait until the %s reach their final state' % resources)
+        parser.add_argument('--timeout', type=int, default=600, help='maximum seconds to wait (600 by default)')
+
+    def _report_wait(self, done, states):
+        """
+        Print the result of a wait
+
+        :param done: True if all the resources reached the state
+        :param states: Dictionary with the last state of each resource
+        :return: True if all the resources reached the state
+        """
+        for resource_id, state in sorted(states.items()):
+            print '%s: %s' % (resource_id, state or 'unknown')
+        return self._report(done, 'All of them reached the state', 'Not all of them reached the state')
+
+    def _instance_filters(self, args):
+        """
+        Build the EC2 filters from the options of a command
+
+        :param args: Parsed arguments
+        :return: EC2 filters
+        """
+        tags = {}
+        for tag in args.tag:
+            key, separator, value = tag.partition('=')
+            tags[key] = value if separator else None
+        return self.session.get('compute').make_filters(state=getattr(args, 'state', None),
+                                                        instance_type=args.instance_type, zone=args.zone,
+                                                        image_id=args.ami, tags=tags)
+
+    def _build_parser(self):
+        """
+        Build the parser of the commands
+
+        :return: Parser (argparse)
+        """
+        parser = argparse.ArgumentParser(prog='main.py', description='Cloud CLI non-interactive commands')
+        groups = parser.add_subparsers(title='services', dest='group')
+
+        # AWS compute
+        compute = groups.add_parser('compute', help='AWS EC2 operations').add_subparsers(title='commands')
+        command = self._add_command(compute, 'list', self.compute_list, 'list all the instances')
+        self._add_instance_filters(command, state=True)
+        self._add_scope_options(command)
+        command = self._add_command(compute, 'list-running', self.compute_list_running, 'list the running instances')
+        self._add_instance_filters(command)
+        self._add_scope_options(command)
+        self._add_command(compute, 'detail', self.compute_detail,
+                          'detail a running instance').add_argument('instance_id')
+        for action in ['start', 'stop', 'reboot', 'terminate']:
+            command = self._add_command(compute, action, self.compute_bulk_action,
+                                        '%s instances, given their IDs or filters' % action)
+            command.add_argument('instance_ids', nargs='*')
+            self._add_instance_filters(command, state=True)
+            command.add_argument('--query', help='query selecting the instances (see "compute select -h")')
+            self._add_scope_options(command)
+            self._add_wait_options(command)
+            command.set_defaults(action=action)
+        command = self._add_command(compute, 'select', self.compute_select,
+                                    'list the instances matching a query over the indexed inventory')
+        command.add_argument('query', nargs='*',
+                             help='space separated terms, all of which must match: state=running, type=m5.*, '
+                                  'zone=eu-west-1a, ami=ami-123, region=eu-west-1, account=prod, tag:team=search, '
+                                  'tag:team, '
+                                  'launched>=2016-01-01, launched<2016-02-01 (comma separated values are '
+                                  'alternatives, e.g. state=running,stopped)')
+        self._add_scope_options(command)
+        self._add_command(compute, 'stop-all', self.compute_stop_all, 'stop all the running instances')
+        self._add_command(compute, 'create-image', self.compute_create_image,
+                          'start a new instance given an AMI').add_argument('ami')
+        self._add_command(compute, 'create-os', self.compute_create_os,
+                          'start a new instance given the OS').add_argument('os', choices=['linux', 'windows'])
+        command = self._add_command(compute, 'launch', self.compute_launch,
+                                    'launch many instances at once given an AMI')
+        command.add_argument('ami')
+        command.add_argument('--count', type=int, default=1, help='number of instances (1 by default)')
+        command.add_argument('--type', dest='instance_type', default='t2.micro',
+                             help='instance type (t2.micro by default)')
+        zones = command.add_mutually_exclusive_group()
+        zones.add_argument('--zones', help='comma separated availability zones to spread the instances across')
+        zones.add_argument('--spread', action='store_true',
+                           help='spread the instances across all the available zones of the region')
+        self._add_wait_options(command)
+        command = self._add_command(compute, 'wait', self.compute_wait, 'wait until instances reach a state')
+        command.add_argument('instance_ids', nargs='+')
+        command.add_argument('--state', default='running', help='state to reach (running by default)')
+        command.add_argument('--timeout', type=int, default=600, help='maximum seconds to wait (600 by default)')
+        self._add_scope_options(self._add_command(compute, 'volumes', self.compute_volumes, 'list the volumes'))
+        command = self._add_command(compute, 'wait-volumes', self.compute_wait_volumes,
+                                    'wait until volumes reach a status')
+        command.add_argument('volume_ids', nargs='+')
+        command.add_argument('--status', default='available', help='status to reach (available by default)')
+        command.add_argument('--timeout', type=int, default=600, help='maximum seconds to wait (600 by default)')
+        command = self._add_command(compute, 'attach', self.compute_attach, 'attach a volume to an instance')
+        command.add_argument('volume_id')
+        command.add_argument('instance_id')
+        command.add_argument('--device', help='device name (the first free one by default)')
+        command = self._add_command(compute, 'attach-many', self.compute_attach_many,
+                                    'attach many volumes concurrently')
+        command.add_argument('attachments', nargs='+', metavar='VOLUME_ID:INSTANCE_ID')
+        self._add_wait_options(command, 'volumes')
+        command = self._add_command(compute, 'detach', self.compute_detach, 'detach volumes concurrently')
+        command.add_argument('volume_ids', nargs='+')
+        self._add_wait_options(command, 'volumes')
+
+        # Storage (AWS S3 and OpenStack Swift)
+        for name, provider in [('storage', 'AWS S3'), ('openstack-storage', 'OpenStack Swift')]:
+            storage = groups.add_parser(name, help='%s operations' % provider).add_subparsers(title='commands')
+            self._add_command(storage, 'containers', self.storage_containers, 'list the containers')
+            command = self._add_command(storage, 'objects', self.storage_objects, 'list the objects of a container')
+            command.add_argument('container')
+            command.add_argument('--prefix', help='only list the objects whose name starts by this prefix')
+            command.add_argument('--delimiter',
+                                 help='group the objects whose name contains this delimiter (e.g. /) by directories')
+            self._add_command(storage, 'create-container', self.storage_create_container,
+                              'create a container').add_argument('container')
+            self._add_command(storage, 'delete-container', self.storage_delete_container,
+                              'delete a container and its objects').add_argument('container')
+            command = self._add_command(storage, 'delete-prefix', self.storage_delete_prefix,
+                                        'delete the objects whose name starts by a prefix')
+            command.add_argument('container')
+            command.add_argument('prefix')
+            command = self._add_command(storage, 'upload', self.storage_upload, 'upload files to a container')
+            command.add_argument('container')
+            command.add_argument('files', nargs='+')
+            command = self._add_command(storage, 'download', self.storage_download, 'download an object')
+            command.add_argument('container')
+            command.add_argument('object')
+            command.add_argument('path', nargs='?', default='', help='folder to download the object to')
+            command = self._add_command(storage, 'delete-object', self.storage_delete_object, 'delete objects')
+            command.add_argument('container')
+            command.add_argument('objects', nargs='+')
+
+        # AWS CloudWatch
+        cloudwatch = groups.add_parser('cloudwatch', help='AWS CloudWatch operations').add_subparsers(title='commands')
+        self._add_command(cloudwatch, 'monitor', self.cloudwatch_monitor, 'monitor all the instances')
+        self._add_command(cloudwatch, 'metrics', self.cloudwatch_metrics,
+                          'list the metrics of an instance').add_argument('instance_id')
+        self._add_scope_options(self._add_command(cloudwatch, 'alarms', self.cloudwatch_alarms,
+                                                   'list the CPU alarms'))
+        self._add_command(cloudwatch, 'enable-alarm', self.cloudwatch_enable_alarm,
+                          'enable the CPU alarm of an instance').add_argument('instance_id')
+        self._add_command(cloudwatch, 'delete-alarm', self.cloudwatch_delete_alarm,
+                          'delete the CPU alarm of an instance').add_argument('instance_id')
+        self._add_command(cloudwatch, 'delete-all-alarms', self.cloudwatch_delete_all_alarms,
+                          'delete all the CPU alarms')
+        self._add_command(cloudwatch, 'email', self.cloudwatch_email,
+                          'change the email recipient of the CPU alarms').add_argument('email')
+
+        # AWS Elastic Load Balancer
+        elb = groups.add_parser('elb', help='AWS Elastic Load Balancer operations').add_subparsers(title='commands')
+        self._add_scope_options(self._add_command(elb, 'list', self.elb_list, 'list the load balancers'))
+        self._add_command(elb, 'create', self.elb_create, 'create a load balancer').add_argument('name')
+        self._add_command(elb, 'delete', self.elb_delete, 'delete a load balancer').add_argument('name')
+        command = self._add_command(elb, 'register', self.elb_register, 'add an instance to a load balancer')
+        command.add_argument('name')
+        command.add_argument('instance_id')
+        command = self._add_command(elb, 'deregister', self.elb_deregister,
+                                    'remove an instance from a load balancer')
+        command.add_argument('name')
+        command.add_argument('instance_id')
+
+        # AWS CloudFormation
+        cloudformation = groups.add_parser('cloudformation',
+                                           help='AWS CloudFormation operations').add_subparsers(title='commands')
+        self._add_command(cloudformation, 'web-bucket', self.cloudformation_web_bucket, 'generate a web bucket')
+        self._add_scope_options(self._add_command(cloudformation, 'stacks', self.cloudformation_stacks,
+                                                   'list the stacks'))
+
+        # OpenStack compute
+        openstack = groups.add_parser('openstack-compute',
+                                      help='OpenStack compute operations').add_subparsers(title='commands')
+        self._add_openstack_regions_option(self._add_command(openstack, 'list-running',
+                                                             self.openstack_compute_list_running,
+                                                             'list the running instances'))
+        for action in ['reboot', 'stop', 'start', 'destroy']:
+            command = self._add_command(openstack, action, self.openstack_compute_bulk_action,
+                                        '%s nodes concurrently, given their IDs or their name and state' % action)
+            command.add_argument('node_ids', nargs='*')
+            command.add_argument('--name', help='name of the nodes (may contain wildcards)')
+            command.add_argument('--state', help='state of the nodes (e.g. ACTIVE, SHUTOFF)')
+            self._add_openstack_regions_option(command)
+            self._add_wait_options(command, 'nodes')
+            command.set_defaults(action=action)
+        command = self._add_command(openstack, 'create', self.openstack_compute_create,
+                                    'create many nodes concurrently, named NAME-1 to NAME-COUNT')
+        command.add_argument('name')
+        command.add_argument('--count', type=int, default=1, help='number of nodes (1 by default)')
+        command.add_argument('--image', required=True, help='name or ID of the image')
+        command.add_argument('--flavor', required=True, help='name or ID of the flavor')
+        command.add_argument('--region', help='region of the nodes (the configured one by default)')
+        self._add_wait_options(command, 'nodes')
+
+        # Inventory snapshot
+        inventory = groups.add_parser('inventory', help='local snapshot of the AWS inventory').add_subparsers(
+            title='commands')
+        kinds = ['instances', 'volumes', 'load_balancers', 'alarms']
+        command = self._add_command(inventory, 'refresh', self.inventory_refresh,
+                                    'refresh the snapshot (only the resources which changed are stored)')
+        command.add_argument('kinds', nargs='*', metavar='kind',
+                             help='kind of resources: %s (all by default)' % ', '.join(kinds))
+        command.add_argument('--force', action='store_true',
+                             help='describe every resource, instead of refreshing incrementally where possible')
+        command = self._add_command(inventory, 'show', self.inventory_show, 'list resources from the snapshot')
+        command.add_argument('kind', choices=kinds)
+        command.add_argument('--refresh', action='store_true', help='refresh the snapshot before listing')
+        self._add_command(inventory, 'status', self.inventory_status, 'show when the snapshot was refreshed')
+
+        # Batch mode
+        command = groups.add_parser('batch', help='execute many commands (one per line) in a single process',
+                                    description='Execute many commands, one per line; empty lines and comments '
+                                                '(starting by #) are ignored')
+        command.add_argument('file', nargs='?', default='-', help='file with the commands (standard input by default)')
+        command.add_argument('--stop-on-error', action='store_true', help='stop at the first command which fails')
+        command.set_defaults(f=self.batch)
+
+        # Daemon
+        daemon = groups.add_parser('daemon', help='manage the background daemon, which keeps the connections and '
+                                                  'caches warm between commands').add_subparsers(title='commands')
+        self._add_command(daemon, 'start', self.daemon_start, 'start the daemon').add_argument(
+            '--foreground', action='store_true', help='do not detach from the terminal')
+        self._add_command(daemon, 'stop', self.daemon_stop, 'stop the daemon')
+        self._add_command(daemon, 'status', self.daemon_status, 'check whether the daemon is running')
+        self._add_command(daemon, 'reload', self.daemon_reload,
+                          'drop the connections and caches of the daemon and read the configuration again')
+
+        return parser
+
+    def execute(self, argv):
+        """
+        Execute a command
+
+        :param argv: Command line arguments (e.g. ['compute', 'stop', 'i-123'])
+        :return: Exit status (0 if the command succeeded)
+        """
+
+        # Parse the arguments (argparse exits when they are invalid or the help is requested)
+        try:
+            args = self.parser.parse_args(argv)
+        except SystemExit as e:
+            return e.code
+
+        # Run the command; only an explicit False means failure
+        if args.f(args) is False:
+            return 1
+        return 0
+
+    def batch(self, args):
+        """
+        Execute the commands contained in a file (or the standard input), one per line
+
+        :param args: Parsed arguments
+        :return: True if all the commands succeeded, false otherwise
+        """
+        stream = sys.stdin if args.file == '-' else open(args.file)
+        failures = 0
+        try:
+            for number, line in enumerate(stream, 1):
+
+                # Skip empty lines and comments
+                argv = shlex.split(line, comments=True)
+                if not argv:
+                    continue
+
+                # Nested batches are not allowed
+                if argv[0] == 'batch':
+                    print >> sys.stderr, 'Line %d: nested batches are not allowed' % number
+                    status = 1
+                else:
+                    # noinspection PyBroadException
+                    try:
+                        status = self.execute(argv)
+                    except Exception as e:
+                        print >> sys.stderr, 'Line %d: %s' % (number, e)
+                        status = 1
+
+                # Error
+                if status:
+                    failures += 1
+                    print >> sys.stderr, 'Line %d failed: %s' % (number, line.strip())
+                    if args.stop_on_error:
+                        break
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        return failures == 0
+
+    @staticmethod
+    def _report(done, success, failure):
+        """
+        Print the result of an operation
+
+        :param done: True if the operation succeeded
+        :param success: Message if it succeeded
+        :param failure: Message if it failed
+        :return: The result of the operation
+        """
+        if done:
+            print success
+        else:
+            print >> sys.stderr, failure
+        return done
+
+    def compute_list(self, args):
+        """
+        List all the EC2 instances
+        """
+        self.session.get('compute').list_instances(self._instance_filters(args), self._regions(args),
+                                                    self._accounts(args))
+
+    def compute_list_running(self, args):
+        """
+        List the running EC2 instances
+        """
+        self.session.get('compute').list_running_instances(self._instance_filters(args), self._regions(args),
+                                                            self._accounts(args))
+
+    def compute_detail(self, args):
+        """
+        Detail a running EC2 instance
+        """
+        self.session.get('compute').detail_running_instance(args.instance_id)
+
+    def compute_bulk_action(self, args):
+        """
+        Start, stop, reboot or terminate EC2 instances
+        """
+
+        # Select the instances (never all of them by accident)
+        filters = self._instance_filters(args)
+        if len([selection for selection in (args.instance_ids, filters, args.query) if selection]) != 1:
+            print >> sys.stderr, 'Provide either the instance IDs, filters or a query selecting them'
+            return False
+        try:
+            results = self.session.get('compute').bulk_action(args.action, args.instance_ids or None, filters,
+                                                              args.query, self._regions(args), self._accounts(args))
+        except ValueError as e:
+            print >> sys.stderr, e
+            return False
+
+        # Report
+        if not results:
+            print 'There are no instances matching the filters'
+        for instance_id, error in sorted(results.items()):
+            self._report(error is None, '%s: %s done' % (instance_id, args.action),
+                         '%s: %s failed (%s)' % (instance_id, args.action, error))
+        done = all(error is None for error in results.values())
+
+        # Wait for the instances which succeeded
+        succeeded = [instance_id for instance_id, error in results.items() if error is None]
+        if args.wait and succeeded:
+            print '# Waiting for the instances'
+            compute = self.session.get('compute')
+            done &= self._report_wait(*compute.wait_for_instances(succeeded, compute.BULK_ACTIONS_STATES[args.action],
+                                                                  args.timeout, self._regions(args),
+                                                                  self._accounts(args)))
+        return done
+
+    def compute_stop_all(self, args):
+        """
+        Stop all the running EC2 instances
+        """
+        print '%d instances were stopped' % self.session.get('compute').stop_all_instances()
+
+    def compute_create_image(self, args):
+        """
+        Start a new EC2 instance given an AMI
+        """
+        return self._report(self.session.get('compute').create_instance_by_image(args.ami),
+                            'Instance started!', 'It was not possible to create an instance with the given AMI')
+
+    def compute_create_os(self, args):
+        """
+        Start a new EC2 instance given its OS
+        """
+        return self._report(self.session.get('compute').create_instance_by_os(args.os == 'linux'),
+                            'Instance started!', 'It was not possible to create an instance with the given OS')
+
+    def compute_select(self, args):
+        """
+        List the EC2 instances matching a query
+        """
+        try:
+            instances = self.session.get('compute').select_instances(' '.join(args.query), False, self._regions(args),
+                                                                     self._accounts(args))
+        except ValueError as e:
+            print >> sys.stderr, e
+            return False
+        for instance in instances:
+            print '%s - %s (AMI: %s) (%s) (%s) [%s] (Launched: %s)%s' % (
+                instance.id, instance.instance_type, instance.image_id, instance.zone,
+                Connection.scope_name(instance.account, instance.region), instance.state, instance.launch_time,
+                ''.join(' %s=%s' % tag for tag in sorted((instance.tags or {}).items())))
+        if not instances:
+            print 'There are no instances matching the query!'
+
+    def compute_launch(self, args):
+        """
+        Launch many EC2 instances at once
+        """
+        compute = self.session.get('compute')
+
+        # Zones to spread the instances across
+        zones = None
+        if args.zones:
+            zones = args.zones.split(',')
+        elif args.spread:
+            zones = compute.get_available_zones()
+
+        # Launch them
+        instance_ids, errors = compute.launch_fleet(args.ami, args.count, args.instance_type, zones, args.wait,
+                                                    args.timeout)
+        for instance_id in instance_ids:
+            print instance_id
+        for source, error in sorted(errors.items()):
+            print >> sys.stderr, '%s: %s' % (source or args.ami, error)
+        return len(instance_ids) == args.count and not errors
+
+    def compute_wait(self, args):
+        """
+        Wait until EC2 instances reach a state
+        """
+        return self._report_wait(*self.session.get('compute').wait_for_instances(args.instance_ids, args.state,
+                                                                                 args.timeout))
+
+    def compute_wait_volumes(self, args):
+        """
+        Wait until volumes reach a status
+        """
+        return self._report_wait(*self.session.get('compute').wait_for_volumes(args.volume_ids, args.status,
+                                                                               args.timeout))
+
+    def compute_volumes(self, args):
+        """
+        List the volumes
+        """
+        self.session.get('compute').list_volumes(self._regions(args), self._accounts(args))
+
+    def compute_attach(self, args):
+        """
+        Attach a volume to an instance
+        """
+        return self._report(self.session.get('compute').attach_volume(args.volume_id, args.instance_id, args.device),
+                            '%s: attached to %s' % (args.volume_id, args.instance_id),
+                            '%s: could not be attached' % args.volume_id)
+
+    def _report_volumes(self, results, action, status, args):
+        """
+        Print the result of a bulk operation over volumes, waiting for them if requested
+
+        :param results: Dictionary with the result of each volume (None if it succeeded, the error otherwise)
+        :param action: Name of the action, for the messages
+        :param status: Status the volumes will reach
+        :param args: Parsed arguments
+        :return: True if all the volumes succeeded (and reached the status, if waiting)
+        """
+        for volume_id, error in sorted(results.items()):
+            self._report(error is None, '%s: %s' % (volume_id, action),
+                         '%s: could not be %s (%s)' % (volume_id, action, error))
+        done = all(error is None for error in results.values())
+
+        # Wait for the volumes which succeeded
+        succeeded = [volume_id for volume_id, error in results.items() if error is None]
+        if args.wait and succeeded:
+            print '# Waiting for the volumes'
+            done &= self._report_wait(*self.session.get('compute').wait_for_volumes(succeeded, status, args.timeout))
+        return done
+
+    def compute_attach_many(self, args):
+        """
+        Attach many volumes concurrently
+        """
+        attachments = []
+        for attachment in args.attachments:
+            volume_id, separator, instance_id = attachment.partition(':')
+            if not separator:
+                print >> sys.stderr, 'Invalid attachment %s (expected VOLUME_ID:INSTANCE_ID)' % attachment
+                return False
+            attachments.append((volume_id, instance_id))
+        return self._report_volumes(self.session.get('compute').bulk_attach_volumes(attachments), 'attached',
+                                    'in-use', args)
+
+    def compute_detach(self, args):
+        """
+        Detach volumes concurrently
+        """
+        return self._report_volumes(self.session.get('compute').bulk_detach_volumes(args.volume_ids), 'detached',
+                                    'available', args)
+
+    def storage_containers(self, args):
+        """
+        List the containers
+        """
+        self.session.get(args.group).list_containers()
+
+    def storage_objects(self, args):
+        """
+        List the objects of a container
+        """
+        self.session.get(args.group).list_objects(args.container, args.prefix, args.delimiter)
+
+    def storage_create_container(self, args):
+        """
+        Create a container
+        """
+        return self._report(self.session.get(args.group).create_container(args.container),
+                            'The container "%s" was created' % args.container,
+                            'The container "%s" cannot be created' % args.container)
+
+    def storage_delete_container(self, args):
+        """
+        Delete a container
+        """
+        return self._report(self.session.get(args.group).delete_container(args.container),
+                            'The container "%s" was deleted' % args.container,
+                            'The container "%s" cannot be deleted' % args.container)
+
+    def storage_delete_prefix(self, args):
+        """
+        Delete the objects whose name starts by a prefix
+        """
+        try:
+            result = self.session.get(args.group).delete_prefix(args.container, args.prefix)
+        except Exception as e:
+            print >> sys.stderr, 'The objects could not be listed (%s)' % e
+            return False
+        if result is None:
+            return self._report(False, None, 'The container "%s" does not exist' % args.container)
+        deleted, errors = result
+        for object_name, error in sorted(errors.items()):
+            print >> sys.stderr, '%s: could not be deleted (%s)' % (object_name, error)
+        return self._report(not errors, '%d objects deleted' % deleted,
+                            '%d objects deleted, %d could not be deleted' % (deleted, len(errors)))
+
+    def storage_upload(self, args):
+        """
+        Upload files to a container
+        """
+        done = True
+        for file_path in args.files:
+            done &= self._report(self.session.get(args.group).upload_object(args.container, file_path),
+                                 '%s: uploaded' % file_path, '%s: could not be uploaded' % file_path)
+        return done
+
+    def storage_download(self, args):
+        """
+        Download an object
+        """
+        return self._report(self.session.get(args.group).download_object(args.container, args.object, args.path),
+                            '%s: downloaded' % args.object, '%s: could not be downloaded' % args.object)
+
+    def storage_delete_object(self, args):
+        """
+        Delete objects
+        """
+        done = True
+        for object_name in args.objects:
+            done &= self._report(self.session.get(args.group).delete_object(args.container, object_name),
+                                 '%s: deleted' % object_name, '%s: could not be deleted' % object_name)
+        return done
+
+    def cloudwatch_monitor(self, args):
+        """
+        Monitor all the instances
+        """
+        self.session.get('cloudwatch').monitor_instances()
+
+    def cloudwatch_metrics(self, args):
+        """
+        List the metrics of an instance
+        """
+        self.session.get('cloudwatch').list_metrics(args.instance_id)
+
+    def cloudwatch_alarms(self, args):
+        """
+        List the CPU alarms
+        """
+        self.session.get('cloudwatch').list_cpu_alarms(self._regions(args), self._accounts(args))
+
+    def cloudwatch_enable_alarm(self, args):
+        """
+        Enable the CPU alarm of an instance
+        """
+        return self._report(self.session.get('cloudwatch').enable_cpu_alarm(args.instance_id),
+                            'The alarm was enabled', 'The alarm could not be enabled')
+
+    def cloudwatch_delete_alarm(self, args):
+        """
+        Delete the CPU alarm of an instance
+        """
+        return self._report(self.session.get('cloudwatch').delete_cpu_alarm(args.instance_id),
+                            'The alarm was deleted', 'The alarm could not be deleted')
+
+    def cloudwatch_delete_all_alarms(self, args):
+        """
+        Delete all the CPU alarms
+        """
+        self.session.get('cloudwatch').delete_all_cpu_alarms()
+
+    def cloudwatch_email(self, args):
+        """
+        Change the email recipient of the CPU alarms
+        """
+        return self._report(self.session.get('cloudwatch').sns.set_only_subscriber_to_cloudwatch(args.email),
+                            'Email changed', 'The email could not be changed')
+
+    def elb_list(self, args):
+        """
+        List the load balancers
+        """
+        self.session.get('elb').list_load_balancers(self._regions(args), self._accounts(args))
+
+    def elb_create(self, args):
+        """
+        Create a load balancer
+        """
+        return self._report(self.session.get('elb').create_load_balancer(args.name),
+                            'Load balancer created!', 'The load balancer could not be created')
+
+    def elb_delete(self, args):
+        """
+        Delete a load balancer
+        """
+        return self._report(self.session.get('elb').delete_load_balancer(args.name),
+                            'Load balancer deleted!', 'The load balancer could not be deleted')
+
+    def elb_register(self, args):
+        """
+        Add an instance to a load balancer
+        """
+        return self._report(self.session.get('elb').register_instance_to_load_balancer(args.name, args.instance_id),
+                            'Instance added!', 'The instance could not be added')
+
+    def elb_deregister(self, args):
+        """
+        Remove an instance from a load balancer
+        """
+        return self._report(
+            self.session.get('elb').deregister_instance_from_load_balancer(args.name, args.instance_id),
+            'Instance removed!', 'The instance could not be removed')
+
+    def cloudformation_web_bucket(self, args):
+        """
+        Generate a web bucket
+        """
+        self.session.get('cloudformation').generate_web_bucket()
+
+    def cloudformation_stacks(self, args):
+        """
+        List the stacks
+        """
+        self.session.get('cloudformation').list_stacks(self._regions(args), self._accounts(args))
+
+    def openstack_compute_list_running(self, args):
+        """
+        List the running OpenStack instances
+        """
+        self.session.get('openstack-compute').list_running_instances(self._openstack_regions(args))
+
+    def openstack_compute_bulk_action(self, args):
+        """
+        Reboot, stop, start or destroy OpenStack nodes
+        """
+
+        # Select the nodes (never all of them by accident)
+        if bool(args.node_ids) == bool(args.name or args.state):
+            print >> sys.stderr, 'Provide either the node IDs, or their name and state'
+            return False
+        compute = self.session.get('openstack-compute')
+        regions = self._openstack_regions(args)
+        results = compute.bulk_action(args.action, args.node_ids or None, args.name, args.state, regions)
+
+        # Report
+        if not results:
+            print 'There are no nodes matching the filters'
+        for node_id, error in sorted(results.items()):
+            self._report(error is None, '%s: %s done' % (node_id, args.action),
+                         '%s: %s failed (%s)' % (node_id, args.action, error))
+        done = all(error is None for error in results.values())
+
+        # Wait for the nodes which succeeded
+        succeeded = [node_id for node_id, error in results.items() if error is None]
+        if args.wait and succeeded:
+            print '# Waiting for the nodes'
+            done &= self._report_wait(*compute.wait_for_nodes(succeeded, compute.BULK_ACTIONS_STATES[args.action],
+                                                              args.timeout, regions))
+        return done
+
+    def openstack_compute_create(self, args):
+        """
+        Create many OpenStack nodes
+        """
+        compute = self.session.get('openstack-compute')
+        node_ids, errors = compute.create_nodes(args.name, args.count, args.image, args.flavor, args.region)
+        for node_id in node_ids:
+            print node_id
+        for name, error in sorted(errors.items()):
+            print >> sys.stderr, '%s: %s' % (name, error)
+        done = len(node_ids) == args.count and not errors
+
+        if args.wait and node_ids:
+            print '# Waiting for the nodes'
+            done &= self._report_wait(*compute.wait_for_nodes(node_ids, 'ACTIVE', args.timeout,
+                                                              [args.region] if args.region else None))
+        return done
+
+    def inventory_refresh(self, args):
+        """
+        Refresh the inventory snapshot
+        """
+        snapshot = lazy_import('logic.inventory').InventorySnapshot()
+        try:
+            unknown = set(args.kinds) - set(snapshot.KINDS)
+            if unknown:
+                print >> sys.stderr, 'Unknown kinds of resources: %s' % ', '.join(sorted(unknown))
+                return False
+            for kind, (changed, removed) in sorted(snapshot.refresh(args.kinds, args.force).items()):
+                print '%s: %d changed, %d removed' % (kind, changed, removed)
+        finally:
+            snapshot.close()
+
+    def inventory_show(self, args):
+        """
+        List resources from the inventory snapshot
+        """
+        snapshot = lazy_import('logic.inventory').InventorySnapshot()
+        try:
+
+            # Refresh it if requested, or if it was never refreshed
+            if args.refresh or snapshot.refreshed_at(args.kind) is None:
+                snapshot.refresh([args.kind])
+
+            count = 0
+            for resource in snapshot.get(args.kind):
+                print '%d: %s' % (count, ', '.join('%s=%s' % (key, value) for key, value in sorted(resource.items())
+                                                   if value not in (None, [], {})))
+                count += 1
+            if not count:
+                print 'There are no %s!' % args.kind.replace('_', ' ')
+        finally:
+            snapshot.close()
+
+    def inventory_status(self, args):
+        """
+        Show when the inventory snapshot was refreshed
+        """
+        snapshot = lazy_import('logic.inventory').InventorySnapshot()
+        try:
+            for kind in snapshot.KINDS:
+                refreshed_at = snapshot.refreshed_at(kind)
+                if refreshed_at is None:
+                    print '%s: never refreshed' % kind
+                else:
+                    print '%s: refreshed %d seconds ago' % (kind, time.time() - refreshed_at)
+        finally:
+            snapshot.close()
+
+    def daemon_start(self, args):
+        """
+        Start the daemon
+        """
+        daemon = lazy_import('cli.daemon')
+        if daemon.DaemonClient().ping():
+            print 'The daemon is already running'
+            return True
+        if args.foreground:
+            daemon.Daemon().serve()
+            return True
+        return self._report(daemon.Daemon().start(), 'The daemon was started', 'The daemon could not be started')
+
+    def daemon_stop(self, args):
+        """
+        Stop the daemon
+        """
+        return self._report(lazy_import('cli.daemon').DaemonClient().control('stop'),
+                            'The daemon was stopped', 'The daemon is not running')
+
+    def daemon_status(self, args):
+        """
+        Check whether the daemon is running
+        """
+        return self._report(lazy_import('cli.daemon').DaemonClient().ping(),
+                            'The daemon is running', 'The daemon is not running')
+
+    def daemon_reload(self, args):
+        """
+        Drop the connections and caches of the daemon
+        """
+        return self._report(lazy_import('cli.daemon').DaemonClient().control('reload'),
+                            'The daemon was reloaded', 'The daemon is not running')
@@ -0,0 +1,228 @@
+import json
+import os
+import socket
+import SocketServer
+import StringIO
+import sys
+import time
+
+from commands import CommandLine
+from logic.connections import Connection
+
+
+class DaemonRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Handle a request sent to the daemon: a JSON line with either a command or a control operation
+    """
+
+    def handle(self):
+        """
+        Read the request, execute it and write back the JSON response
+        """
+        request = json.loads(self.rfile.readline())
+        if 'control' in request:
+            response = self.server.daemon.control(request['control'])
+        else:
+            argv = [arg.encode('utf-8') for arg in request['argv']]
+            response = self.server.daemon.execute(argv, request.get('cwd'))
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class Daemon:
+    """
+    Background process which keeps the logic handlers (with their clients and caches) warm between commands
+
+    The commands are received through a local Unix socket (only accessible by the user) and executed one at a time,
+    capturing their output to send it back to the client
+    """
+
+    # Seconds to wait for the daemon to be ready when it is started in the background
+    START_TIMEOUT = 10
+
+    def __init__(self, socket_path=None):
+        """
+        Init the daemon
+
+        :param socket_path: Path of the Unix socket (the configured one by default)
+        """
+        self.socket_path = socket_path or Connection().DAEMON_SOCKET
+        self.command_line = CommandLine()
+        self.server = None
+
+    def execute(self, argv, cwd=None):
+        """
+        Execute a command, capturing its output
+
+        :param argv: Command line arguments of the command
+        :param cwd: Working directory of the client, so relative paths are resolved as the client would do
+        :return: Response with the exit status and the output of the command
+        """
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        # noinspection PyBroadException
+        try:
+            if cwd:
+                os.chdir(cwd)
+
+            # The daemon cannot be managed through itself
+            if argv and argv[0] == 'daemon':
+                print >> sys.stderr, 'The daemon commands cannot be sent to the daemon'
+                status = 1
+            else:
+                status = self.command_line.execute(argv)
+        except Exception as e:
+            print >> sys.stderr, 'Error: %s' % e
+            status = 1
+        finally:
+            output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+            sys.stdout, sys.stderr = stdout, stderr
+        return {'status': status, 'stdout': output, 'stderr': errors}
+
+    def control(self, operation):
+        """
+        Execute a control operation
+
+        :param operation: 'ping', 'reload' (drop every client and cache, re-reading the configuration) or 'stop'
+        :return: Response of the operation
+        """
+        if operation == 'reload':
+            Connection.invalidate()
+            self.command_line = CommandLine()
+        elif operation == 'stop':
+            self.server.running = False
+        elif operation != 'ping':
+            return {'status': 1, 'stdout': '', 'stderr': 'Unknown operation %s\n' % operation}
+        return {'status': 0, 'stdout': '', 'stderr': '', 'pid': os.getpid()}
+
+    def serve(self):
+        """
+        Serve requests until the daemon is stopped
+        """
+
+        # The configuration must keep being found when the working directory changes
+        Connection.CONFIG_FILE = os.path.abspath(Connection.CONFIG_FILE)
+
+        # Remove the socket left by a previous daemon and create the new one, only accessible by the user
+        folder = os.path.dirname(self.socket_path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, 0700)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        umask = os.umask(0177)
+        try:
+            self.server = SocketServer.UnixStreamServer(self.socket_path, DaemonRequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+        self.server.running = True
+
+        # Serve the requests one by one
+        try:
+            while self.server.running:
+                self.server.handle_request()
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
+
+    def start(self):
+        """
+        Start the daemon in the background, detached from the terminal
+
+        :return: True if the daemon is ready to receive commands, false otherwise
+        """
+
+        # Parent: wait until the daemon answers
+        if os.fork():
+            client = DaemonClient(self.socket_path)
+            deadline = time.time() + self.START_TIMEOUT
+            while time.time() < deadline:
+                if client.ping():
+                    return True
+                time.sleep(0.1)
+            return False
+
+        # Child: detach from the terminal and serve
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+        try:
+            self.serve()
+        finally:
+            os._exit(0)
+
+
+class DaemonClient(CommandLine):
+    """
+    Thin client which sends the commands to the daemon instead of executing them
+    Batches are read by the client, which sends their commands one by one
+    """
+
+    def __init__(self, socket_path=None):
+        """
+        Init the client
+
+        :param socket_path: Path of the Unix socket (the configured one by default)
+        """
+        CommandLine.__init__(self)
+        self.socket_path = socket_path or Connection().DAEMON_SOCKET
+
+    def _send(self, request):
+        """
+        Send a request to the daemon
+
+        :param request: Request (dictionary)
+        :return: Response (dictionary)
+        """
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.socket_path)
+            client.sendall(json.dumps(request) + '\n')
+            client.shutdown(socket.SHUT_WR)
+            return json.loads(client.makefile().readline())
+        finally:
+            client.close()
+
+    def ping(self):
+        """
+        Check whether the daemon is running
+
+        :return: True if the daemon answers, false otherwise
+        """
+        return self.control('ping')
+
+    def control(self, operation):
+        """
+        Send a control operation to the daemon
+
+        :param operation: Control operation ('ping', 'reload' or 'stop')
+        :return: True if the daemon executed the operation, false otherwise
+        """
+        try:
+            return self._send({'control': operation})['status'] == 0
+        except (socket.error, ValueError):
+            return False
+
+    def execute(self, argv):
+        """
+        Send a command to the daemon and print its output
+
+        :param argv: Command line arguments
+        :return: Exit status of the command
+        """
+
+        # Batches are expanded by the client, and the daemon is not managed through itself
+        if argv and argv[0] in ('batch', 'daemon'):
+            return CommandLine.execute(self, argv)
+
+        try:
+            response = self._send({'argv': argv, 'cwd': os.getcwd()})
+        except (socket.error, ValueError) as e:
+            # A truncated or empty answer (e.g. the daemon died during the request) is not valid JSON
+            print >> sys.stderr, 'The daemon is not available (%s): start it with "main.py daemon start"' % e
+            return 1
+        sys.stdout.write(response['stdout'])
+        sys.stderr.write(response['stderr'])
+        return response['status']
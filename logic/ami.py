@@ -0,0 +1,98 @@
+import json
+import os
+import threading
+import time
+
+from logic.connections import Connection
+
+
+class AmiResolver:
+    """
+    Find the latest AMI of an operating system in each region, with the credentials of an AWS profile
+
+    Searching images is one of the slowest EC2 operations, so the results are cached on disk (amis.json within the
+    state folder) for the configured AMI cache TTL, and shared by every execution of the program
+    """
+
+    # Owner and name pattern of the images of each operating system
+    IMAGES = {
+        'linux': ('amazon', 'amzn2-ami-hvm-*-x86_64-gp2'),
+        'windows': ('amazon', 'Windows_Server-2019-English-Full-Base-*'),
+    }
+
+    def __init__(self, profile=None, path=None):
+        """
+        Init the resolver, loading the cached results
+
+        :param profile: AWS profile whose images are searched (None for the [aws] credentials)
+        :param path: Path of the cache file (amis.json within the state folder by default)
+        """
+        connection = Connection(profile)
+        self.profile = profile
+        self.ttl = connection.AWS_AMI_CACHE_TTL
+        self.path = path or connection.state_path('amis.json')
+        self._lock = threading.Lock()
+        self._cache = self._load()
+
+    def _load(self):
+        """
+        Load the cached results from disk
+
+        :return: Dictionary with the image ID and resolution time of each search
+        """
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self):
+        """
+        Save the cached results to disk (replacing the file atomically, so concurrent executions never read half
+        written files)
+        """
+        temporary = '%s.%d' % (self.path, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(self._cache, f)
+        os.rename(temporary, self.path)
+
+    def resolve(self, region, owner, pattern):
+        """
+        Get the latest available image of an owner whose name matches a pattern
+
+        :param region: Region of the image
+        :param owner: Owner of the image (e.g. 'amazon' or an account ID)
+        :param pattern: Name pattern, with wildcards (*)
+        :return: Image ID, None if there are no matching images
+        """
+        key = '%s|%s|%s|%s' % (self.profile or '', region, owner, pattern)
+
+        # Cached result
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry and entry['resolved_at'] + self.ttl > time.time():
+            return entry['image_id']
+
+        # Search the images
+        images = Connection(self.profile).ec2_connection(region).get_all_images(owners=[owner], filters={
+            'name': pattern, 'state': 'available'})
+        if not images:
+            return None
+        image_id = max(images, key=lambda image: image.creationDate).id
+
+        # Store the result
+        with self._lock:
+            self._cache[key] = {'image_id': image_id, 'resolved_at': time.time()}
+            self._save()
+        return image_id
+
+    def resolve_os(self, region, os_name):
+        """
+        Get the latest image of an operating system
+
+        :param region: Region of the image
+        :param os_name: Operating system ('linux' or 'windows')
+        :return: Image ID, None if there are no matching images
+        """
+        owner, pattern = self.IMAGES[os_name]
+        return self.resolve(region, owner, pattern)
@@ -0,0 +1,73 @@
+import threading
+import time
+
+
+class TtlCache:
+    """
+    In-memory cache whose entries expire after a given number of seconds
+
+    It is used to keep the results of slow listing calls (e.g. the EC2 reservations) between operations;
+    the operations which modify the listed resources must invalidate the affected entries
+    """
+
+    def __init__(self, ttl):
+        """
+        Init the (empty) cache
+
+        :param ttl: Seconds each entry is valid (0 disables the cache)
+        """
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """
+        Get an entry, loading it if it is not cached or it has expired
+
+        :param key: Key of the entry
+        :param loader: Function (without arguments) returning the value of the entry
+        :return: Value of the entry
+        """
+        value = self.lookup(key)
+        if value is not None:
+            return value
+        value = loader()
+        self.put(key, value)
+        return value
+
+    def lookup(self, key):
+        """
+        Get an entry without loading it
+
+        :param key: Key of the entry
+        :return: Value of the entry, None if it is not cached or it has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def put(self, key, value):
+        """
+        Store an entry
+
+        :param key: Key of the entry
+        :param value: Value of the entry
+        """
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+
+    def invalidate(self, key=None):
+        """
+        Invalidate an entry, or the whole cache
+
+        :param key: Key of the entry to invalidate (None to invalidate all of them)
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+
+
+class TransferCheckpoint:
+    """
+    Progress of a transfer (e.g. the uploaded parts or the downloaded ranges), stored on disk so a failed transfer can
+    be resumed where it stopped
+
+    The checkpoint belongs to a given transfer, described by its identity (e.g. the file, its size and modification
+    time, and the part size): a stored checkpoint of another transfer, or of a file which changed since, is ignored
+    (its progress is kept as stale, e.g. to abort the upload it started)
+    """
+
+    def __init__(self, path, identity):
+        """
+        Init the checkpoint, loading the stored progress if it belongs to the same transfer
+
+        :param path: Path of the checkpoint file
+        :param identity: Dictionary describing the transfer (serializable as JSON)
+        """
+        self.path = path
+        self.identity = json.loads(json.dumps(identity))
+        self._lock = threading.Lock()
+        self.state, self.stale = self._load()
+
+    def _load(self):
+        """
+        Load the stored progress
+
+        :return: Dictionary with the progress (empty if there is not a checkpoint of the transfer), and dictionary
+                 with the progress of a stored checkpoint of another transfer (empty if there is not one)
+        """
+        try:
+            with open(self.path) as f:
+                checkpoint = json.load(f)
+        except (IOError, ValueError):
+            return {}, {}
+        if checkpoint.get('identity') != self.identity:
+            return {}, checkpoint.get('state', {})
+        return checkpoint.get('state', {}), {}
+
+    def _save(self):
+        """
+        Store the progress, only readable by the user (replacing the file atomically)
+        """
+        temporary = '%s.%d' % (self.path, os.getpid())
+        with os.fdopen(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w') as f:
+            json.dump({'identity': self.identity, 'state': self.state}, f)
+        os.rename(temporary, self.path)
+
+    def update(self, **values):
+        """
+        Set some values of the progress, and store it
+
+        :param values: Values to set
+        """
+        with self._lock:
+            self.state.update(values)
+            self._save()
+
+    def record(self, key, item, value=True):
+        """
+        Record an item as done (e.g. a part), and store the progress
+
+        :param key: Key of the dictionary of done items in the progress (e.g. 'parts')
+        :param item: Done item (e.g. the number of the part)
+        :param value: Value of the item (e.g. the ETag of the part)
+        """
+        with self._lock:
+            self.state.setdefault(key, {})[str(item)] = value
+            self._save()
+
+    def delete(self):
+        """
+        Delete the checkpoint (when the transfer finished, or it cannot be resumed)
+        """
+        with self._lock:
+            self.state = {}
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
@@ -1,6 +1,8 @@
+import sys
 import time
 
 from logic.connections import Connection
+from logic.parallel import fan_out
 
 
 class CloudFormation:
@@ -12,12 +14,25 @@ class CloudFormation:
     https://s3-us-west-2.amazonaws.com/cloudformation-templates-us-west-2/S3_Website_Bucket_With_Retain_On_Delete.template
     """
 
-    def __init__(self):
+    # Statuses of the stacks which are listed (the deleted ones are not)
+    LISTED_STATUSES = ['CREATE_IN_PROGRESS', 'CREATE_FAILED', 'CREATE_COMPLETE', 'ROLLBACK_IN_PROGRESS',
+                       'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE', 'DELETE_IN_PROGRESS', 'DELETE_FAILED',
+                       'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_COMPLETE',
+                       'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED',
+                       'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE']
+
+    def __init__(self, region=None, profile=None):
         """
         Store the connection and init the web bucket template
-        :param conn: CloudFormation (boto) connection
+
+        :param region: Region of the stacks (the region of the profile by default)
+        :param profile: AWS profile (None for the [aws] credentials)
         """
-        self.conn = Connection().cloudformation_connection()
+        connection = Connection(profile)
+        self.profile = profile
+        self.region = region or connection.AWS_REGION
+        self.conn = connection.cloudformation_connection(self.region)
+        self.workers = connection.WORKERS
         self.web_bucket_template = '{"AWSTemplateFormatVersion":"2010-09-09","Description":"AWS CloudFormation Sample Template S3_Website_Bucket_With_Retain_On_Delete: Sample template showing how to create a publicly accessible S3 bucket configured for website access with a deletion policy of retail on delete. **WARNING** This template creates an S3 bucket that will NOT be deleted when the stack is deleted. You will be billed for the AWS resources used if you create a stack from this template.","Resources":{"S3Bucket":{"Type":"AWS::S3::Bucket","Properties":{"AccessControl":"PublicRead","WebsiteConfiguration":{"IndexDocument":"index.html","ErrorDocument":"error.html"}},"DeletionPolicy":"Retain"}},"Outputs":{"WebsiteURL":{"Value":{"Fn::GetAtt":["S3Bucket","WebsiteURL"]},"Description":"URL for website hosted on S3"},"S3BucketSecureURL":{"Value":{"Fn::Join":["",["https://",{"Fn::GetAtt":["S3Bucket","DomainName"]}]]},"Description":"Name of S3 bucket to hold website content"}}}'
 
     def generate_web_bucket(self):
@@ -48,3 +63,43 @@ class CloudFormation:
         # Delete the created stack (the created bucket will not be deleted)
         print '- Stack created, removing...'
         self.conn.delete_stack(name)
+
+    def _get_stacks(self, scope):
+        """
+        Get the (not deleted) stacks of a region, page by page
+
+        :param scope: (profile, region) tuple
+        :return: Stack summaries
+        """
+        conn = Connection(scope[0]).cloudformation_connection(scope[1])
+        stacks = []
+        next_token = None
+        while True:
+            page = conn.list_stacks(self.LISTED_STATUSES, next_token)
+            stacks.extend(page)
+            next_token = getattr(page, 'next_token', None)
+            if not next_token:
+                return stacks
+
+    def list_stacks(self, regions=None, accounts=None):
+        """
+        List (print) the stacks
+
+        :param regions: Region names, queried concurrently (None for the region of each account)
+        :param accounts: Profile names, queried concurrently (None for the profile of the handler)
+        """
+        scopes = [(self.profile, self.region)]
+        if regions or accounts:
+            scopes = Connection(self.profile).get_scopes(regions, accounts)
+        count = 0
+        for scope, stacks, error in fan_out(self._get_stacks, scopes, self.workers):
+            if error is not None:
+                print >> sys.stderr, '%s: %s' % (Connection.scope_name(*scope), error)
+                continue
+            for stack in stacks:
+                print '%d: %s [%s] (Created: %s) (%s)' % (count, stack.stack_name, stack.stack_status,
+                                                         stack.creation_time, Connection.scope_name(*scope))
+                count += 1
+
+        if not count:
+            print 'There are no stacks!'
@@ -1,5 +1,8 @@
+import sys
+
 from logic.compute_aws import AwsCompute
 from logic.connections import Connection
+from logic.parallel import fan_out
 from logic.sns import Sns
 
 
@@ -10,12 +13,31 @@ class CloudWatch:
 
     CPU_ALARM_THRESHOLD = 40.0
 
-    def __init__(self):
+    def __init__(self, region=None, profile=None):
         """
         Store the connection and inner the Sns handler (for email notifications)
+
+        :param region: Region of the metrics and alarms (the region of the profile by default)
+        :param profile: AWS profile (None for the [aws] credentials)
         """
-        self.conn = Connection().cloudwatch_connection()
+        connection = Connection(profile)
+        self.profile = profile
+        self.region = region or connection.AWS_REGION
+        self.conn = connection.cloudwatch_connection(self.region)
+        self.workers = connection.WORKERS
         self.sns = Sns()
+        self._compute = None
+
+    @property
+    def compute(self):
+        """
+        EC2 handler, created the first time it is needed and reused afterwards
+
+        :return: AwsCompute handler
+        """
+        if self._compute is None:
+            self._compute = AwsCompute(self.region, self.profile)
+        return self._compute
 
     def _get_metrics(self, instance_id):
         """
@@ -82,7 +104,7 @@ class CloudWatch:
         """
         Monitor all the instances
         """
-        AwsCompute().monitor_intances()
+        self.compute.monitor_intances()
 
     def list_metrics(self, instance_id):
         """
@@ -93,22 +115,34 @@ class CloudWatch:
         for i, metric in enumerate(self._get_metrics(instance_id)):
             print '%d: %s (%s)' % (i, metric.name, metric.namespace)
 
-    def list_cpu_alarms(self):
+    def list_cpu_alarms(self, regions=None, accounts=None):
         """
         List (print) all the existing CPU alarms
+
+        :param regions: Region names, queried concurrently (None for the region of each account)
+        :param accounts: Profile names, queried concurrently (None for the profile of the handler)
         """
 
-        # Get the alarms
-        alarms = self._get_cpu_alarms()
+        def fetch(scope):
+            alarms = Connection(scope[0]).cloudwatch_connection(scope[1]).describe_alarms()
+            return filter(lambda alarm: alarm.metric == 'CPUUtilization', alarms)
+
+        # Print the alarms as each region and account answers
+        scopes = [(self.profile, self.region)]
+        if regions or accounts:
+            scopes = Connection(self.profile).get_scopes(regions, accounts)
+        count = 0
+        for scope, alarms, error in fan_out(fetch, scopes, self.workers):
+            if error is not None:
+                print >> sys.stderr, '%s: %s' % (Connection.scope_name(*scope), error)
+                continue
+            for alarm in alarms:
+                print '%d: %s (%s)' % (count, str(alarm), Connection.scope_name(*scope))
+                count += 1
 
         # Message if there are no alarms
-        if not len(alarms):
+        if not count:
             print 'There are not alarms configured!'
-            return
-
-        # Print them
-        for i, alarm in enumerate(alarms):
-            print '%d: %s' % (i, str(alarm))
 
     def delete_all_cpu_alarms(self):
         """
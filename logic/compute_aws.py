@@ -1,4 +1,273 @@
+import bisect
+import fnmatch
+import sys
+
+from logic.ami import AmiResolver
+from logic.cache import TtlCache
 from logic.connections import Connection
+from logic.parallel import fan_out, parallel_map
+from logic.waiters import Waiter
+
+
+# Values shared by the instance records (types, AMIs, zones...), so each distinct value is stored only once
+# The byte strings are interned; the rest are kept in a map which is emptied when it reaches _SHARED_VALUES_LIMIT
+# values, so a long-running daemon does not keep every value it has ever seen
+_shared_values = {}
+
+# Maximum number of values in the map of shared values
+_SHARED_VALUES_LIMIT = 10000
+
+
+def _share(value):
+    """
+    Get the shared copy of a value
+
+    :param value: Value (hashable)
+    :return: Equal value, shared by all the records using it
+    """
+    if isinstance(value, str):
+        return intern(value)
+    shared = _shared_values.get(value)
+    if shared is None:
+        if len(_shared_values) >= _SHARED_VALUES_LIMIT:
+            _shared_values.clear()
+        shared = _shared_values.setdefault(value, value)
+    return shared
+
+
+class InstanceRecord(object):
+    """
+    Compact record of an EC2 instance, with only the fields the program uses
+
+    The boto instances keep all the parsed attributes, a reference to the connection and more; the listings project
+    them into these records as the pages arrive, so large inventories can be kept in memory
+    """
+
+    __slots__ = ('id', 'instance_type', 'image_id', 'region', 'zone', 'launch_time', 'state', 'tags', 'account')
+
+    def __init__(self, instance_id, instance_type, image_id, region, zone, launch_time, state, tags=None,
+                 account=None):
+        """
+        Init the record
+
+        :param instance_id: Instance ID
+        :param instance_type: Instance type
+        :param image_id: AMI of the instance
+        :param region: Region name
+        :param zone: Availability zone
+        :param launch_time: Launch time (ISO 8601)
+        :param state: State of the instance
+        :param tags: Dictionary of tags (None if it does not have any)
+        :param account: AWS profile the instance belongs to (None for the [aws] credentials)
+        """
+        self.id = instance_id
+        self.instance_type = _share(instance_type)
+        self.image_id = _share(image_id)
+        self.region = _share(region)
+        self.zone = _share(zone)
+        self.launch_time = launch_time
+        self.state = _share(state)
+        self.tags = tags or None
+        self.account = _share(account)
+
+    @classmethod
+    def from_boto(cls, instance, account=None):
+        """
+        Project a boto instance into a record
+
+        :param instance: EC2 (boto) instance
+        :param account: AWS profile the instance belongs to (None for the [aws] credentials)
+        :return: Instance record
+        """
+        return cls(instance.id, instance.instance_type, instance.image_id, instance.region.name, instance.placement,
+                   instance.launch_time, instance.state, dict(instance.tags), account)
+
+
+class InstanceIndex:
+    """
+    Instance records indexed by state, type, zone, AMI, tags and launch time
+
+    The indexes are queried with expressions made of space separated terms, all of which must match:
+
+    - state=running, type=m5.*, zone=eu-west-1a, ami=ami-123, region=eu-west-1, account=prod (the values can
+      contain wildcards)
+    - tag:team=search (tag value), tag:team (the instance has the tag)
+    - launched>=2016-01-01, launched<2016-02-01T12:00 (launch time range, also with > and <=)
+
+    A term may list several comma separated values, any of which is accepted (e.g. state=running,stopped). Exact
+    values are resolved with a single lookup, and the wildcards are only matched against the distinct values of the
+    field; only the instances of the most selective term are iterated (and checked against the rest), so a query
+    costs time proportional to that term rather than to the number of instances
+    """
+
+    # Indexed fields of the records, by their name in the queries
+    FIELDS = {
+        'state': 'state',
+        'type': 'instance_type',
+        'zone': 'zone',
+        'ami': 'image_id',
+        'region': 'region',
+        'account': 'account',
+    }
+
+    # Comparison operators of the launch time terms (the longest ones first)
+    LAUNCH_OPERATORS = ['>=', '<=', '>', '<']
+
+    # Comparison of a launch time with the bound of a range, for each operator
+    LAUNCH_COMPARISONS = {
+        '>=': lambda launch_time, bound: launch_time >= bound,
+        '<=': lambda launch_time, bound: launch_time <= bound,
+        '>': lambda launch_time, bound: launch_time > bound,
+        '<': lambda launch_time, bound: launch_time < bound,
+    }
+
+    def __init__(self, records):
+        """
+        Index the instance records
+
+        :param records: Instance records
+        """
+        self.records = {}
+        self.by_field = dict((field, {}) for field in self.FIELDS.values())
+        self.by_tag = {}
+        self.launch_times = []
+        for record in records:
+            self.records[record.id] = record
+            for field, index in self.by_field.items():
+                index.setdefault(getattr(record, field), set()).add(record.id)
+            for key, value in (record.tags or {}).items():
+                self.by_tag.setdefault(key, {}).setdefault(value, set()).add(record.id)
+            self.launch_times.append((record.launch_time, record.id))
+        self.launch_times.sort()
+        self.launch_keys = [launch_time for launch_time, instance_id in self.launch_times]
+
+    @staticmethod
+    def _match(index, patterns):
+        """
+        Get the groups of IDs whose value matches any of the patterns
+
+        :param index: Dictionary with the IDs of each value
+        :param patterns: Values, which can contain wildcards
+        :return: List of sets of IDs
+        """
+        groups = []
+        for pattern in patterns:
+            if not any(wildcard in pattern for wildcard in '*?['):
+                if pattern in index:
+                    groups.append(index[pattern])
+                continue
+            for value, value_ids in index.items():
+                if value is not None and fnmatch.fnmatchcase(value, pattern):
+                    groups.append(value_ids)
+        return groups
+
+    def _launched(self, operator, limit):
+        """
+        Get the instances launched in a range of time
+
+        :param operator: Comparison operator ('>=', '<=', '>' or '<')
+        :param limit: Limit of the range (ISO 8601 date or prefix of it)
+        :return: Number of instances, function iterating their IDs, and function checking whether an ID is in the range
+        """
+        if operator in ('>=', '<'):
+            bound = limit
+            position = bisect.bisect_left(self.launch_keys, bound)
+        else:
+            # Any launch time starting by the limit (e.g. 2016-01-01T10:00:00.000Z for 2016-01-01) is equal to it
+            bound = limit + u'\uffff'
+            position = bisect.bisect_right(self.launch_keys, bound)
+
+        compare = self.LAUNCH_COMPARISONS[operator]
+        if operator[0] == '>':
+            return (len(self.launch_times) - position,
+                    lambda: (instance_id for launch_time, instance_id in self.launch_times[position:]),
+                    lambda instance_id: compare(self.records[instance_id].launch_time, bound))
+        return (position,
+                lambda: (instance_id for launch_time, instance_id in self.launch_times[:position]),
+                lambda instance_id: compare(self.records[instance_id].launch_time, bound))
+
+    def _resolve(self, term):
+        """
+        Resolve a term without building the set of its IDs (only the smallest term of a query is iterated)
+
+        :param term: Term of a query
+        :return: Number of matching instances, function iterating their IDs, and function checking whether an ID
+                 matches
+        """
+
+        # Launch time range
+        if term.startswith('launched'):
+            for operator in self.LAUNCH_OPERATORS:
+                if term[len('launched'):].startswith(operator):
+                    return self._launched(operator, term[len('launched') + len(operator):])
+            raise ValueError('Invalid launch time term %s' % term)
+
+        key, separator, values = term.partition('=')
+
+        # Tags
+        if key.startswith('tag:'):
+            tag_values = self.by_tag.get(key[len('tag:'):], {})
+            groups = self._match(tag_values, values.split(',')) if separator else tag_values.values()
+
+        # Fields
+        elif key not in self.FIELDS or not separator:
+            raise ValueError('Invalid term %s' % term)
+        else:
+            groups = self._match(self.by_field[self.FIELDS[key]], values.split(','))
+
+        # Each instance has a single value per field or tag, so the groups do not overlap
+        return (sum(len(group) for group in groups),
+                lambda: (instance_id for group in groups for instance_id in group),
+                lambda instance_id: any(instance_id in group for group in groups))
+
+    def query(self, expression):
+        """
+        Get the instances matching a query
+
+        :param expression: Query (see the class description); an empty query matches every instance
+        :return: Instance records, sorted by ID
+        """
+        terms = expression.split()
+        if not terms:
+            return [self.records[instance_id] for instance_id in sorted(self.records)]
+
+        # Iterate the smallest term, checking the rest for each of its instances
+        resolved = sorted((self._resolve(term) for term in terms), key=lambda result: result[0])
+        count, iterate, contains = resolved[0]
+        checks = [other_contains for other_count, other_iterate, other_contains in resolved[1:]]
+        ids = [instance_id for instance_id in iterate() if all(check(instance_id) for check in checks)]
+        return [self.records[instance_id] for instance_id in sorted(ids)]
+
+
+class VolumeInventory:
+    """
+    All the volumes of the region, obtained with a single request and indexed by status and by instance
+    """
+
+    def __init__(self, volumes):
+        """
+        Index the volumes
+
+        :param volumes: EC2 (boto) volumes
+        """
+        self.volumes = volumes
+        self.by_status = {}
+        self.by_instance = {}
+        for v in volumes:
+            self.by_status.setdefault(v.status, []).append(v)
+            if v.attach_data and v.attach_data.instance_id:
+                self.by_instance.setdefault(v.attach_data.instance_id, []).append(v)
+
+    def used_devices(self, instance_id):
+        """
+        Get the devices used by the volumes attached to an instance
+        The Xen names (/dev/xvdf) are normalized to their equivalent /dev/sdf names
+
+        :param instance_id: Instance ID
+        :return: Set of devices
+        """
+        return set(v.attach_data.device.replace('/dev/xvd', '/dev/sd')
+                   for v in self.by_instance.get(instance_id, []) if v.attach_data.device)
 
 
 # noinspection PyBroadException
@@ -7,57 +276,298 @@ class AwsCompute:
     AWS EC2 operations
     """
 
-    # Default AMI for Linux machines
+    # Default AMI for Linux machines in eu-west-1, used if it cannot be resolved
     DEFAULT_LINUX_AMI = 'ami-8b8c57f8'
 
-    # Default AMI for Windows machines
+    # Default AMI for Windows machines in eu-west-1, used if it cannot be resolved
     DEFAULT_WINDOWS_AMI = 'ami-c6972fb5'
 
-    def __init__(self):
+    # Instance type of the launched instances if it is not provided
+    DEFAULT_INSTANCE_TYPE = 't2.micro'
+
+    # Maximum number of seconds to wait for instances or volumes to change their state
+    DEFAULT_WAIT_TIMEOUT = Waiter.DEFAULT_TIMEOUT
+
+    # States from which an instance will not reach each state
+    FAILURE_STATES = {
+        'pending': ['shutting-down', 'terminated'],
+        'running': ['shutting-down', 'terminated'],
+        'stopping': ['terminated'],
+        'stopped': ['terminated'],
+    }
+
+    # Devices which can be allocated to the attached volumes
+    VOLUME_DEVICES = ['/dev/sd%s' % letter for letter in 'fghijklmnop']
+
+    # Maximum number of IDs per filter (e.g. when checking the state of many instances)
+    FILTER_CHUNK_SIZE = 200
+
+    # Maximum number of instances per page when listing them
+    PAGE_SIZE = 1000
+
+    # Maximum number of instances per EC2 request in the bulk operations
+    BULK_CHUNK_SIZE = 500
+
+    # Maximum number of seconds to retry a throttled bulk request
+    BULK_RETRY_TIMEOUT = 120
+
+    # EC2 error codes which only mean that the request has to be retried later
+    RETRYABLE_ERRORS = ['RequestLimitExceeded', 'Throttling', 'InternalError', 'Unavailable', 'ServiceUnavailable']
+
+    # EC2 error codes which affect a whole request, whatever its instances (the others are caused by some instance)
+    REQUEST_ERRORS = ['AuthFailure', 'UnauthorizedOperation', 'Blocked', 'OptInRequired', 'PendingVerification',
+                      'SignatureDoesNotMatch', 'InvalidClientTokenId', 'RequestExpired', 'MissingAuthenticationToken']
+
+    # EC2 (boto) connection method of each bulk action
+    BULK_ACTIONS = {
+        'start': 'start_instances',
+        'stop': 'stop_instances',
+        'reboot': 'reboot_instances',
+        'terminate': 'terminate_instances',
+    }
+
+    # State reached by the instances after each bulk action
+    BULK_ACTIONS_STATES = {
+        'start': 'running',
+        'stop': 'stopped',
+        'reboot': 'running',
+        'terminate': 'terminated',
+    }
+
+    # States of the instances which are not running
+    NOT_RUNNING_STATES = ['pending', 'shutting-down', 'terminated', 'stopping', 'stopped']
+
+    def __init__(self, region=None, profile=None):
         """
-        EC2Instance Constructor, initiating the EC2 (boto) connection
+        EC2Instance Constructor, initiating the EC2 (boto) connection and the inventory cache
+
+        :param region: Region of the instances (the region of the profile by default)
+        :param profile: AWS profile (None for the [aws] credentials)
+        """
+        connection = Connection(profile)
+        self.profile = profile
+        self.region = region or connection.AWS_REGION
+        self.conn = connection.ec2_connection(self.region)
+        self.inventory = TtlCache(connection.AWS_INVENTORY_TTL)
+        self.ami_resolver = None
+        self.workers = connection.WORKERS
+        self._scoped = {(self.profile, self.region): self}
+
+    def for_scope(self, profile, region):
         """
-        self.conn = Connection().ec2_connection()
+        Get the handler of another profile and region, created the first time and reused afterwards (with its own
+        clients and caches)
 
-    def _get_instances(self):
+        :param profile: AWS profile (None for the [aws] credentials)
+        :param region: Region name
+        :return: AwsCompute handler
         """
-        Get all the instances
-        :return: Instances
+        handler = self._scoped.get((profile, region))
+        if handler is None:
+            handler = self._scoped.setdefault((profile, region), AwsCompute(region, profile))
+        return handler
+
+    def _scopes(self, regions=None, accounts=None):
         """
+        Get the (profile, region) pairs selected by a set of regions and accounts
 
-        # ouput list
-        output = []
+        :param regions: Region names (None for the region of each account)
+        :param accounts: Profile names (None for the profile of the handler)
+        :return: List of (profile, region) tuples, None if neither the regions nor the accounts are provided
+        """
+        if not regions and not accounts:
+            return None
+        if not accounts:
+            return [(self.profile, region) for region in regions]
+        return Connection(self.profile).get_scopes(regions, accounts)
+
+    def _iter_scopes(self, f, scopes):
+        """
+        Query many profiles and regions concurrently, merging their results into one stream as each of them answers
+
+        The errors of a profile or region are printed and do not stop the rest
+
+        :param f: Function receiving the handler of a profile and region, and returning its resources
+        :param scopes: (profile, region) tuples
+        :return: Generator of resources
+        """
+        for scope, resources, error in fan_out(lambda scope: f(self.for_scope(*scope)), scopes, self.workers):
+            if error is not None:
+                print >> sys.stderr, '%s: %s' % (Connection.scope_name(*scope), error)
+                continue
+            for resource in resources:
+                yield resource
+
+    def _iter_scopes_instances(self, filters=None, regions=None, accounts=None):
+        """
+        Iterate the instances of many regions and accounts, tagged with them (see _iter_instances)
 
-        # get all instance reservations associated with this AWS account
-        reservations = self.conn.get_all_reservations()
+        :param filters: EC2 filters (see make_filters)
+        :param regions: Region names (None for the region of each account)
+        :param accounts: Profile names (None for the profile of the handler)
+        :return: Generator of instance records
+        """
+        scopes = self._scopes(regions, accounts)
+        if not scopes:
+            return self._iter_instances(filters)
+        return self._iter_scopes(lambda compute: compute._get_instances(filters), scopes)
 
-        # loop through reservations and extract instance information
-        for r in reservations:
+    @staticmethod
+    def make_filters(state=None, instance_type=None, zone=None, image_id=None, tags=None):
+        """
+        Build the EC2 filters used to select instances
+        Each value can be a single value or a list of them (any of which is accepted), and may contain wildcards (*)
+
+        :param state: State of the instances (e.g. 'running')
+        :param instance_type: Instance type (e.g. 't2.micro')
+        :param zone: Availability zone (e.g. 'eu-west-1a')
+        :param image_id: AMI of the instances
+        :param tags: Dictionary of tags; a None value only requires the instance to have the tag
+        :return: EC2 filters
+        """
+        filters = {}
+        if state:
+            filters['instance-state-name'] = state
+        if instance_type:
+            filters['instance-type'] = instance_type
+        if zone:
+            filters['availability-zone'] = zone
+        if image_id:
+            filters['image-id'] = image_id
+        for key, value in (tags or {}).items():
+            if value is None:
+                filters.setdefault('tag-key', []).append(key)
+            else:
+                filters['tag:%s' % key] = value
+        return filters
+
+    @staticmethod
+    def _with_state(filters, state):
+        """
+        Add the instance state to some filters
 
-            # get all instances from the reservation
-            instances = r.instances
+        :param filters: EC2 filters (can be None)
+        :param state: State or list of states
+        :return: New EC2 filters
+        """
+        filters = dict(filters or {})
+        filters['instance-state-name'] = state
+        return filters
 
-            # loop through instances and print instance information
-            for i in instances:
-                output.append(i)
+    def _iter_instances(self, filters=None, instance_ids=None):
+        """
+        Iterate over the instances, filtered by EC2 itself
 
-        return output
+        The instances are yielded as each page of results arrives, so the memory used does not depend on the number of
+        instances; unless the inventory cache is disabled, they are also kept (for the configured inventory TTL) so
+        consecutive operations do not fetch them again
 
-    def _get_running_instances(self):
+        :param filters: EC2 filters (see make_filters), None for all the instances
+        :param instance_ids: IDs of the instances to get, None for all of them
+        :return: Generator of instance records
         """
-        Filter the instances and return those running (or pending to run)
+        key = ('instances',
+               tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in (filters or {}).items())),
+               tuple(instance_ids or ()))
+
+        # Cached instances
+        cached = self.inventory.lookup(key)
+        if cached is not None:
+            for instance in cached:
+                yield instance
+            return
+
+        # Fetch them (and cache them once the last page has been received)
+        collected = [] if self.inventory.ttl > 0 else None
+        for instance in self._fetch_instances(filters, instance_ids):
+            if collected is not None:
+                collected.append(instance)
+            yield instance
+        if collected is not None:
+            self.inventory.put(key, collected)
+
+    def _get_instances(self, filters=None, instance_ids=None):
+        """
+        Get the instances, filtered by EC2 itself
+
+        :param filters: EC2 filters (see make_filters), None for all the instances
+        :param instance_ids: IDs of the instances to get, None for all of them
+        :return: Instance records
+        """
+        return list(self._iter_instances(filters, instance_ids))
+
+    def _fetch_instances(self, filters=None, instance_ids=None):
+        """
+        Fetch the instances from EC2, page by page
+
+        :param filters: EC2 filters, None for all the instances
+        :param instance_ids: IDs of the instances to fetch, None for all of them
+        :return: Generator of instance records
+        """
+
+        # EC2 does not paginate the requests of specific instances
+        page_size = None if instance_ids else self.PAGE_SIZE
+
+        next_token = None
+        while True:
+
+            # get a page of instance reservations associated with this AWS account
+            reservations = self.conn.get_all_reservations(instance_ids=instance_ids, filters=filters,
+                                                          max_results=page_size, next_token=next_token)
+
+            # loop through reservations and extract instance information
+            for r in reservations:
+                for i in r.instances:
+                    yield InstanceRecord.from_boto(i, self.profile)
 
+            # last page
+            next_token = reservations.next_token
+            if not next_token:
+                break
+
+    def _get_instance(self, instance_id, filters=None):
+        """
+        Get a single instance given its ID
+
+        :param instance_id: Instance ID
+        :param filters: EC2 filters the instance must match
+        :return: Instance, None if it does not exist (or it does not match the filters)
+        """
+        try:
+            instances = self._get_instances(filters, [instance_id])
+        except Exception:
+            # EC2 fails when the ID does not exist
+            return None
+        if not instances:
+            return None
+        return instances[0]
+
+    def _get_running_instances(self, filters=None):
+        """
+        Get the running instances
+
+        :param filters: Additional EC2 filters
         :return: Running instances
         """
-        return filter(lambda i: i.state == 'running', self._get_instances())
+        return self._get_instances(self._with_state(filters, 'running'))
 
-    def _get_not_running_instances(self):
+    def _get_not_running_instances(self, filters=None):
         """
-        Filter the instances and return those which are not running
+        Get the instances which are not running
 
+        :param filters: Additional EC2 filters
         :return: Not running instances
         """
-        return filter(lambda i: i.state != 'running', self._get_instances())
+        return self._get_instances(self._with_state(filters, self.NOT_RUNNING_STATES))
+
+    def _get_volume_inventory(self):
+        """
+        Get the volumes, indexed by status and instance
+        They are fetched with a single request and cached (for the configured inventory TTL)
+
+        :return: Volume inventory
+        """
+        return self.inventory.get('volumes', lambda: VolumeInventory(self.conn.get_all_volumes()))
 
     def _get_volumes(self):
         """
@@ -65,7 +575,7 @@ class AwsCompute:
 
         :return: Volumes
         """
-        return self.conn.get_all_volumes()
+        return self._get_volume_inventory().volumes
 
     def _get_available_volumes(self):
         """
@@ -73,7 +583,7 @@ class AwsCompute:
 
         :return: Available volumes
         """
-        return self.conn.get_all_volumes(filters={'status': 'available'})
+        return self._get_volume_inventory().by_status.get('available', [])
 
     def _get_used_volumes(self):
         """
@@ -81,7 +591,7 @@ class AwsCompute:
 
         :return: Used volumes
         """
-        return self.conn.get_all_volumes(filters={'status': 'in-use'})
+        return self._get_volume_inventory().by_status.get('in-use', [])
 
     def get_available_volumes_ids(self):
         """
@@ -99,39 +609,118 @@ class AwsCompute:
         """
         return map(lambda i: i.id, self._get_used_volumes())
 
-    def get_instances_ids(self):
+    def _get_used_devices(self, instance_ids):
+        """
+        Get the devices used by the volumes attached to some instances
+        They are asked to EC2 (instead of the cached inventory), with one request per FILTER_CHUNK_SIZE instances, so
+        the recent attachments are taken into account
+
+        :param instance_ids: IDs of the instances
+        :return: Dictionary with the set of used devices of each instance
+        """
+        volumes = []
+        for i in range(0, len(instance_ids), self.FILTER_CHUNK_SIZE):
+            volumes.extend(self.conn.get_all_volumes(
+                filters={'attachment.instance-id': instance_ids[i:i + self.FILTER_CHUNK_SIZE]}))
+        inventory = VolumeInventory(volumes)
+        return dict((instance_id, inventory.used_devices(instance_id)) for instance_id in instance_ids)
+
+    def _allocate_devices(self, used, count):
+        """
+        Choose free device names to attach volumes to an instance
+
+        :param used: Devices already used by the instance (or reserved for other attachments)
+        :param count: Number of devices
+        :return: Devices, None if there are not enough free devices
+        """
+        free = [device for device in self.VOLUME_DEVICES if device not in used]
+        if len(free) < count:
+            return None
+        return free[:count]
+
+    def _get_index(self):
+        """
+        Get the index of all the instances
+        It is cached (for the configured inventory TTL) along with the instances
+
+        :return: Instance index
+        """
+        return self.inventory.get('index', lambda: InstanceIndex(self._iter_instances()))
+
+    def select_instances(self, query, fresh=False, regions=None, accounts=None):
+        """
+        Select instances with a query over the indexed inventory (see InstanceIndex)
+
+        :param query: Query (e.g. 'state=running type=m5.* tag:team=search')
+        :param fresh: True to describe the selected instances again (by chunks of FILTER_CHUNK_SIZE) and keep only
+                      those which still match, since the cached index may be outdated (e.g. before terminating them)
+        :param regions: Region names, whose indexes are queried concurrently (None for the region of each account)
+        :param accounts: Profile names, whose indexes are queried concurrently (None for the profile of the handler)
+        :return: Instance records, sorted by ID
+        """
+
+        # Many regions or accounts: each of them queries its own index
+        scopes = self._scopes(regions, accounts)
+        if scopes:
+            return sorted(self._iter_scopes(lambda compute: compute.select_instances(query, fresh), scopes),
+                          key=lambda instance: instance.id)
+
+        records = self._get_index().query(query)
+        if not fresh or not records:
+            return records
+        return InstanceIndex(self._find_instances([record.id for record in records])).query(query)
+
+    def _find_instances(self, instance_ids):
+        """
+        Describe some instances, with one request per FILTER_CHUNK_SIZE instances (those which do not exist, e.g.
+        because they belong to another region or account, are just not returned)
+
+        :param instance_ids: IDs of the instances
+        :return: Instance records
+        """
+        instance_ids = list(instance_ids)
+        instances = []
+        for i in range(0, len(instance_ids), self.FILTER_CHUNK_SIZE):
+            instances.extend(self._fetch_instances({'instance-id': instance_ids[i:i + self.FILTER_CHUNK_SIZE]}))
+        return instances
+
+    def get_instances_ids(self, filters=None):
         """
         Map the instances to their IDs
 
-        :return: IDs of the instances
+        :param filters: EC2 filters (see make_filters), None for all the instances
+        :return: IDs of the instances (generator)
         """
-        return map(lambda i: i.id, self._get_instances())
+        return (i.id for i in self._iter_instances(filters))
 
-    def get_running_instances_ids(self):
+    def get_running_instances_ids(self, filters=None):
         """
         Map the running instances to their IDs
 
-        :return: IDs of the running instances
+        :param filters: Additional EC2 filters (see make_filters)
+        :return: IDs of the running instances (generator)
         """
-        return map(lambda i: i.id, self._get_running_instances())
+        return (i.id for i in self._iter_instances(self._with_state(filters, 'running')))
 
-    def get_not_running_instances_ids(self):
+    def get_not_running_instances_ids(self, filters=None):
         """
         Map the not running instances to their IDs
 
-        :return: IDs of the not running instances
+        :param filters: Additional EC2 filters (see make_filters)
+        :return: IDs of the not running instances (generator)
         """
-        return map(lambda i: i.id, self._get_not_running_instances())
+        return (i.id for i in self._iter_instances(self._with_state(filters, self.NOT_RUNNING_STATES)))
 
     def _get_instance_details(self, instance):
         """
         Get an string containing the details of a provided instance
 
-        :param instance: EC2 Instance object
+        :param instance: Instance record
         :return: Details of the instance
         """
         return '{0} - {1} (AMI: {2}) ({3}): (Running since: {4})'.format(
-            instance.id, instance.instance_type, instance.image_id, instance.region, instance.launch_time)
+            instance.id, instance.instance_type, instance.image_id,
+            Connection.scope_name(instance.account, instance.region), instance.launch_time)
 
     def monitor_intances(self):
         """
@@ -139,42 +728,48 @@ class AwsCompute:
 
         :return: Number of instances which have been started to be monitored (even if they were already been monitored)
         """
-        instances_ids = self.get_instances_ids()
+        instances_ids = list(self.get_instances_ids())
         if len(instances_ids):
             self.conn.monitor_instances(instances_ids)
         return len(instances_ids)
 
-    def list_instances(self):
+    def list_instances(self, filters=None, regions=None, accounts=None):
         """
         List (print) all the EC2 Instances
+
+        :param filters: EC2 filters (see make_filters), None for all the instances
+        :param regions: Region names, queried concurrently (None for the region of each account)
+        :param accounts: Profile names, queried concurrently (None for the profile of the handler)
         """
 
-        instances = self._get_instances()
+        # Print the details as they arrive
+        count = 0
+        for instance in self._iter_scopes_instances(filters, regions, accounts):
+            print '%d: %s [%s]' % (count, self._get_instance_details(instance), instance.state)
+            count += 1
 
-        # Return if there are not instances
-        if not instances:
+        # Message if there are not instances
+        if not count:
             print 'There are no instances!'
-            return
 
-        # Print the details
-        for i, instance in enumerate(instances):
-            print '%d: %s [%s]' % (i, self._get_instance_details(instance), instance.state)
-
-    def list_running_instances(self):
+    def list_running_instances(self, filters=None, regions=None, accounts=None):
         """
         List (print) all the running instances
+
+        :param filters: Additional EC2 filters (see make_filters)
+        :param regions: Region names, queried concurrently (None for the region of each account)
+        :param accounts: Profile names, queried concurrently (None for the profile of the handler)
         """
 
-        instances = self._get_running_instances()
+        # Print the details as they arrive
+        count = 0
+        for instance in self._iter_scopes_instances(self._with_state(filters, 'running'), regions, accounts):
+            print '%d: %s' % (count, self._get_instance_details(instance))
+            count += 1
 
-        # Return if there are not instances
-        if not instances:
+        # Message if there are not instances
+        if not count:
             print 'There are no running instances!'
-            return
-
-        # Print the details
-        for i, instance in enumerate(instances):
-            print '%d: %s' % (i, self._get_instance_details(instance))
 
     def detail_running_instance(self, instance_id):
         """
@@ -184,15 +779,150 @@ class AwsCompute:
         """
 
         # Get the instance
-        instances = filter(lambda i: i.id == instance_id, self._get_running_instances())
+        instance = self._get_instance(instance_id, self._with_state(None, 'running'))
 
         # If the instance is not running
-        if len(instances) == 0:
+        if not instance:
             print 'The supplied ID does not exist!'
             return
 
         # Print the details
-        print self._get_instance_details(instances[0])
+        print self._get_instance_details(instance)
+
+    def get_available_zones(self):
+        """
+        Get the names of the available zones of the region
+
+        :return: Names of the availability zones
+        """
+        return [zone.name for zone in self.conn.get_all_zones(filters={'state': 'available'})]
+
+    def _describe_instances_states(self, instance_ids):
+        """
+        Get the state of many instances, with one request per FILTER_CHUNK_SIZE instances
+        They are selected with a filter (instead of their IDs) so the IDs which are not visible yet do not fail
+
+        :param instance_ids: IDs of the instances
+        :return: Dictionary with the state of each (visible) instance
+        """
+        states = {}
+        for i in range(0, len(instance_ids), self.FILTER_CHUNK_SIZE):
+            chunk = instance_ids[i:i + self.FILTER_CHUNK_SIZE]
+            for instance in self._fetch_instances({'instance-id': chunk}):
+                states[instance.id] = instance.state
+        return states
+
+    def _describe_volumes_states(self, volume_ids):
+        """
+        Get the status of many volumes, with one request per FILTER_CHUNK_SIZE volumes
+
+        :param volume_ids: IDs of the volumes
+        :return: Dictionary with the status of each (visible) volume
+        """
+        states = {}
+        for i in range(0, len(volume_ids), self.FILTER_CHUNK_SIZE):
+            chunk = volume_ids[i:i + self.FILTER_CHUNK_SIZE]
+            for volume in self.conn.get_all_volumes(filters={'volume-id': chunk}):
+                states[volume.id] = volume.status
+        return states
+
+    def wait_for_instances(self, instance_ids, state='running', timeout=DEFAULT_WAIT_TIMEOUT, regions=None,
+                           accounts=None):
+        """
+        Wait until some instances reach a state
+        All the pending instances are checked together, with an exponential backoff between checks
+
+        :param instance_ids: IDs of the instances
+        :param state: State to reach
+        :param timeout: Maximum number of seconds to wait
+        :param regions: Region names, checked concurrently (None for the region of each account)
+        :param accounts: Profile names, checked concurrently (None for the profile of the handler)
+        :return: True if all the instances reached the state, and dictionary with the last state of each instance
+        """
+        describe = self._describe_instances_states
+        scopes = self._scopes(regions, accounts)
+        if scopes:
+            # Each check asks every region and account for the pending instances, which are only visible in theirs
+            def describe(ids):
+                states = {}
+                for scope_states in self._iter_scopes(lambda compute: [compute._describe_instances_states(ids)],
+                                                      scopes):
+                    states.update(scope_states)
+                return states
+
+        done, states = Waiter(describe).wait(instance_ids, state, self.FAILURE_STATES.get(state, ()), timeout)
+        for handler in self._scoped.values():
+            handler.inventory.invalidate()
+        return done, states
+
+    def wait_for_volumes(self, volume_ids, status='available', timeout=DEFAULT_WAIT_TIMEOUT):
+        """
+        Wait until some volumes reach a status (e.g. 'available' or 'in-use')
+        All the pending volumes are checked together, with an exponential backoff between checks
+
+        :param volume_ids: IDs of the volumes
+        :param status: Status to reach
+        :param timeout: Maximum number of seconds to wait
+        :return: True if all the volumes reached the status, and dictionary with the last status of each volume
+        """
+        return Waiter(self._describe_volumes_states).wait(volume_ids, status, ['deleting', 'deleted', 'error'],
+                                                          timeout)
+
+    def launch_fleet(self, ami, count, instance_type=DEFAULT_INSTANCE_TYPE, zones=None, wait=False,
+                     timeout=DEFAULT_WAIT_TIMEOUT):
+        """
+        Launch many instances at once
+
+        The instances are spread (as evenly as possible) across the given availability zones, with one request per zone
+        (sent concurrently); then, the monitoring of all of them is enabled with a single request
+
+        :param ami: AMI of the instances
+        :param count: Number of instances
+        :param instance_type: Instance type
+        :param zones: Availability zones to spread the instances across (None to let EC2 choose)
+        :param wait: True to wait until all the instances are running
+        :param timeout: Maximum number of seconds to wait
+        :return: IDs of the launched instances, and dictionary with the error of each zone which failed
+        """
+        zones = zones or [None]
+
+        # Number of instances of each zone
+        requests = [(zone, count // len(zones) + (1 if i < count % len(zones) else 0)) for i, zone in enumerate(zones)]
+        requests = [(zone, number) for zone, number in requests if number]
+
+        def launch(request):
+            zone, number = request
+            try:
+                reservation = self.conn.run_instances(ami, min_count=number, max_count=number,
+                                                      instance_type=instance_type, placement=zone)
+                return [i.id for i in reservation.instances], None
+            except Exception as e:
+                return [], str(e)
+
+        # Launch them
+        instance_ids = []
+        errors = {}
+        for (zone, number), (launched, error) in zip(requests, parallel_map(launch, requests, self.workers)):
+            instance_ids.extend(launched)
+            if error:
+                errors[zone] = error
+        self.inventory.invalidate()
+
+        # Monitor them all at once
+        if instance_ids:
+            try:
+                self.conn.monitor_instances(instance_ids)
+            except Exception as e:
+                errors['monitoring'] = str(e)
+
+        # Wait until they are running
+        if wait and instance_ids:
+            done, states = self.wait_for_instances(instance_ids, 'running', timeout)
+            if not done:
+                errors['wait'] = '%d instances are not running' % len(
+                    [state for state in states.values() if state != 'running'])
+
+        return instance_ids, errors
 
     def create_instance_by_image(self, ami):
         """
@@ -201,13 +931,8 @@ class AwsCompute:
         :param ami:
         :return: True if created, false otherwise
         """
-        try:
-            reservation = self.conn.run_instances(ami, instance_type='t2.micro')
-            instance = reservation.instances[0]
-            instance.monitor()
-            return True
-        except Exception:
-            return False
+        instance_ids, errors = self.launch_fleet(ami, 1)
+        return len(instance_ids) == 1
 
     def create_instance_by_os(self, is_linux):
         """
@@ -216,10 +941,135 @@ class AwsCompute:
         :param is_linux: True if the machine is Linux, False if Windows
         :return: True if created, false otherwise
         """
-        if is_linux:
-            return self.create_instance_by_image(self.DEFAULT_LINUX_AMI)
-        else:
-            return self.create_instance_by_image(self.DEFAULT_WINDOWS_AMI)
+        ami = self.resolve_os_image('linux' if is_linux else 'windows')
+        if not ami:
+            return False
+        return self.create_instance_by_image(ami)
+
+    def resolve_os_image(self, os_name):
+        """
+        Get the latest AMI of an operating system in the region and profile of the handler (see AmiResolver)
+
+        :param os_name: Operating system ('linux' or 'windows')
+        :return: Image ID, None if it cannot be resolved
+        """
+        if self.ami_resolver is None:
+            self.ami_resolver = AmiResolver(self.profile)
+        try:
+            ami = self.ami_resolver.resolve_os(self.region, os_name)
+        except Exception:
+            ami = None
+
+        # The default images are only valid in eu-west-1
+        if not ami and self.region == 'eu-west-1':
+            ami = self.DEFAULT_LINUX_AMI if os_name == 'linux' else self.DEFAULT_WINDOWS_AMI
+        return ami
+
+    @staticmethod
+    def _is_retryable(error):
+        """
+        Check whether an EC2 error is transient (throttling or a server error)
+
+        :param error: Error raised by boto
+        :return: True if the request can be retried
+        """
+        return getattr(error, 'error_code', None) in AwsCompute.RETRYABLE_ERRORS or \
+            getattr(error, 'status', 0) >= 500
+
+    @staticmethod
+    def _is_request_error(error):
+        """
+        Check whether an EC2 error affects the whole request (throttling, server, authorization or connection
+        errors) rather than some of its instances (e.g. an invalid ID, or an instance in an incorrect state)
+
+        :param error: Error raised by boto
+        :return: True if the error is not caused by any instance
+        """
+        error_code = getattr(error, 'error_code', None)
+        return not error_code or error_code in AwsCompute.REQUEST_ERRORS or AwsCompute._is_retryable(error)
+
+    def _bulk_chunk(self, method, instance_ids):
+        """
+        Execute a bulk action over a chunk of instances with a single request
+        Throttled requests (and server errors) are retried with an exponential backoff; if the request fails because
+        of some instance (e.g. an invalid ID, an instance in an incorrect state or an unsupported operation), the
+        chunk is split in halves which are retried, so the error is only reported for the instances which caused it
+
+        :param method: EC2 (boto) connection method of the action
+        :param instance_ids: IDs of the instances
+        :return: Dictionary with the result of each instance: None if it succeeded, the error otherwise
+        """
+        try:
+            Waiter().retry(lambda: getattr(self.conn, method)(instance_ids), self._is_retryable,
+                           self.BULK_RETRY_TIMEOUT)
+            return dict((instance_id, None) for instance_id in instance_ids)
+        except Exception as e:
+            if len(instance_ids) == 1 or self._is_request_error(e):
+                return dict((instance_id, str(e)) for instance_id in instance_ids)
+        half = len(instance_ids) // 2
+        results = self._bulk_chunk(method, instance_ids[:half])
+        results.update(self._bulk_chunk(method, instance_ids[half:]))
+        return results
+
+    def bulk_action(self, action, instance_ids=None, filters=None, query=None, regions=None, accounts=None):
+        """
+        Execute an action over many instances at once
+        The instances are grouped in requests of up to BULK_CHUNK_SIZE instances, which are sent concurrently
+
+        :param action: Action to execute: 'start', 'stop', 'reboot' or 'terminate'
+        :param instance_ids: IDs of the instances (None to select them with the query or the filters)
+        :param filters: EC2 filters selecting the instances if the IDs are not provided (see make_filters)
+        :param query: Query selecting the instances if the IDs are not provided (see InstanceIndex)
+        :param regions: Region names, whose instances are selected concurrently (None for the region of each account)
+        :param accounts: Profile names, whose instances are selected concurrently (None for the profile of the
+                         handler)
+        :return: Dictionary with the result of each instance: None if it succeeded, the error otherwise; with many
+                 regions or accounts, the error of each one which failed is also reported (by its scope name, see
+                 Connection.scope_name), and the given IDs which were not found in any of them
+        """
+
+        # Many regions or accounts: each of them acts on its own instances
+        scopes = self._scopes(regions, accounts)
+        if scopes:
+            def act(compute):
+                if instance_ids is None:
+                    return compute.bulk_action(action, None, filters, query)
+                found = [instance.id for instance in compute._find_instances(instance_ids)]
+                return compute.bulk_action(action, found) if found else {}
+
+            results = {}
+            failed = False
+            for scope, scope_results, error in fan_out(lambda scope: act(self.for_scope(*scope)), scopes,
+                                                       self.workers):
+                if error is not None:
+                    results[Connection.scope_name(*scope)] = str(error)
+                    failed = True
+                    continue
+                results.update(scope_results)
+
+            # The given instances which no region or account acted on
+            for instance_id in instance_ids or []:
+                if instance_id not in results:
+                    results[instance_id] = 'not found' + (' (some regions or accounts failed)' if failed else '')
+            return results
+
+        method = self.BULK_ACTIONS[action]
+
+        # Select the instances (described again, since the cached inventory may be outdated)
+        if instance_ids is None and query is not None:
+            instance_ids = [instance.id for instance in self.select_instances(query, fresh=True)]
+        elif instance_ids is None:
+            instance_ids = [instance.id for instance in self._fetch_instances(filters)]
+        instance_ids = list(instance_ids)
+
+        # Execute the action by chunks
+        chunks = [instance_ids[i:i + self.BULK_CHUNK_SIZE] for i in range(0, len(instance_ids), self.BULK_CHUNK_SIZE)]
+        results = {}
+        for chunk_results in parallel_map(lambda chunk: self._bulk_chunk(method, chunk), chunks, self.workers):
+            results.update(chunk_results)
+
+        self.inventory.invalidate()
+        return results
 
     def stop_all_instances(self):
         """
@@ -227,10 +1077,8 @@ class AwsCompute:
 
         :return: Number of instances that have been stopped
         """
-        instances = self._get_running_instances()
-        for i in instances:
-            i.stop()
-        return len(instances)
+        results = self.bulk_action('stop', filters=self._with_state(None, 'running'))
+        return len([error for error in results.values() if error is None])
 
     def start_instance(self, instance_id):
         """
@@ -241,6 +1089,7 @@ class AwsCompute:
         """
         try:
             self.conn.start_instances([instance_id])
+            self.inventory.invalidate()
             return True
         except Exception:
             return False
@@ -253,16 +1102,27 @@ class AwsCompute:
         """
         try:
             self.conn.stop_instances([instance_id])
+            self.inventory.invalidate()
             return True
         except Exception:
             return False
 
-    def list_volumes(self):
+    def list_volumes(self, regions=None, accounts=None):
         """
         List (print) all the volumes
+
+        :param regions: Region names, queried concurrently (None for the region of each account)
+        :param accounts: Profile names, queried concurrently (None for the profile of the handler)
         """
 
-        volumes = self._get_volumes()
+        def get_volumes(compute):
+            return [(compute.profile, v) for v in compute._get_volumes()]
+
+        scopes = self._scopes(regions, accounts)
+        if scopes:
+            volumes = list(self._iter_scopes(get_volumes, scopes))
+        else:
+            volumes = get_volumes(self)
 
         # if volumes found
         if not volumes:
@@ -270,25 +1130,23 @@ class AwsCompute:
             return
 
         # loop through volumes
-        for i, v in enumerate(volumes):
+        for i, (profile, v) in enumerate(volumes):
             instance = ''
-            if v.attach_data:
-                instance = ' - Attached to: %s' % v.attach_data.instance_id
-            print '%d: %s, %sGB (%s) [%s] %s' % (i, v.id, v.size, v.zone, v.status, instance)
+            if v.attach_data and v.attach_data.instance_id:
+                instance = ' - Attached to: %s (%s)' % (v.attach_data.instance_id, v.attach_data.device)
+            print '%d: %s, %sGB (%s) [%s] %s' % (i, v.id, v.size, Connection.scope_name(profile, v.zone), v.status,
+                                                 instance)
 
-    def attach_volume(self, volume_id, instance_id):
+    def attach_volume(self, volume_id, instance_id, device=None):
         """
         Attach a volume to an instance
 
         :param volume_id: Volume ID
         :param instance_id: Instance ID
+        :param device: Device name (the first free one by default)
         :return: True if attached, false otherwise
         """
-        try:
-            self.conn.attach_volume(volume_id, instance_id, '/dev/sdx')
-            return True
-        except Exception:
-            return False
+        return self.bulk_attach_volumes([(volume_id, instance_id, device)])[volume_id] is None
 
     def detach_volume(self, volume_id):
         """
@@ -297,8 +1155,72 @@ class AwsCompute:
         :param volume_id: Volume ID
         :return: True if detached, false otherwise
         """
+        return self.bulk_detach_volumes([volume_id])[volume_id] is None
+
+    def bulk_attach_volumes(self, attachments):
+        """
+        Attach many volumes at once
+        Free devices are allocated for each instance first (besides the devices in use and the ones given in the
+        same batch), and then the volumes are attached concurrently
+
+        :param attachments: List of (volume ID, instance ID) or (volume ID, instance ID, device) tuples;
+                            a None device is allocated automatically
+        :return: Dictionary with the result of each volume: None if it was attached, the error otherwise
+        """
+        results = {}
+
+        # Allocate the devices of each instance
+        requests = []
+        by_instance = {}
+        reserved = {}
+        for attachment in attachments:
+            volume_id, instance_id, device = (tuple(attachment) + (None,))[:3]
+            if device:
+                requests.append((volume_id, instance_id, device))
+                reserved.setdefault(instance_id, set()).add(device.replace('/dev/xvd', '/dev/sd'))
+            else:
+                by_instance.setdefault(instance_id, []).append(volume_id)
         try:
-            self.conn.detach_volume(volume_id)
-            return True
-        except Exception:
-            return False
+            used = self._get_used_devices(sorted(by_instance)) if by_instance else {}
+        except Exception as e:
+            for volume_ids in by_instance.values():
+                results.update((volume_id, str(e)) for volume_id in volume_ids)
+            by_instance = {}
+        for instance_id, volume_ids in by_instance.items():
+            devices = self._allocate_devices(used[instance_id] | reserved.get(instance_id, set()), len(volume_ids))
+            if devices is None:
+                results.update((volume_id, 'There are not enough free devices in %s' % instance_id)
+                               for volume_id in volume_ids)
+                continue
+            requests.extend(zip(volume_ids, [instance_id] * len(volume_ids), devices))
+
+        # Attach the volumes
+        def attach(request):
+            volume_id, instance_id, device = request
+            try:
+                self.conn.attach_volume(volume_id, instance_id, device)
+                return None
+            except Exception as e:
+                return str(e)
+
+        results.update(zip([request[0] for request in requests], parallel_map(attach, requests, self.workers)))
+        self.inventory.invalidate('volumes')
+        return results
+
+    def bulk_detach_volumes(self, volume_ids):
+        """
+        Detach many volumes concurrently
+
+        :param volume_ids: IDs of the volumes
+        :return: Dictionary with the result of each volume: None if it was detached, the error otherwise
+        """
+        def detach(volume_id):
+            try:
+                self.conn.detach_volume(volume_id)
+                return None
+            except Exception as e:
+                return str(e)
+
+        results = dict(zip(volume_ids, parallel_map(detach, volume_ids, self.workers)))
+        self.inventory.invalidate('volumes')
+        return results
@@ -1,21 +1,382 @@
+import fnmatch
+import sys
+import urlparse
+
+from logic.cache import TtlCache
 from logic.connections import Connection
+from logic.imports import lazy_import
+from logic.parallel import fan_out_streams, parallel_map
+from logic.waiters import Waiter
+
+
+class NodeRecord(object):
+    """
+    Compact record of an OpenStack node, with the names of its image and flavor
+
+    The records are projected from the pages of servers returned by Nova, so large tenants can be kept in memory
+    """
+
+    __slots__ = ('id', 'name', 'state', 'region', 'zone', 'image', 'flavor', 'created')
+
+    def __init__(self, node_id, name, state, region, zone, image, flavor, created):
+        """
+        Init the record
+
+        :param node_id: Node ID
+        :param name: Node name
+        :param state: Nova status (e.g. 'ACTIVE')
+        :param region: Region name
+        :param zone: Availability zone
+        :param image: Name of the image (its ID if it is not known, None if it booted from a volume)
+        :param flavor: Name of the flavor (its ID if it is not known)
+        :param created: Creation time (ISO 8601)
+        """
+        self.id = node_id
+        self.name = name
+        self.state = state
+        self.region = region
+        self.zone = zone
+        self.image = image
+        self.flavor = flavor
+        self.created = created
+
+    @classmethod
+    def from_server(cls, server, region, images, flavors):
+        """
+        Project a Nova server into a record
+
+        :param server: Server (dictionary returned by Nova)
+        :param region: Region name
+        :param images: Dictionary with the name of each image ID
+        :param flavors: Dictionary with the name of each flavor ID
+        :return: Node record
+        """
+        image_id = (server.get('image') or {}).get('id')
+        flavor_id = (server.get('flavor') or {}).get('id')
+        return cls(server['id'], server.get('name'), server.get('status'), region,
+                   server.get('OS-EXT-AZ:availability_zone'), images.get(image_id, image_id),
+                   flavors.get(flavor_id, flavor_id), server.get('created'))
 
 
 class OpenStackCompute:
     """
     OpenStack compute operations
+
+    The nodes are listed page by page, and each region is queried concurrently; the node records of each region are
+    cached for the configured inventory TTL, and the image and flavor names for CATALOG_TTL seconds
     """
 
-    def __init__(self):
+    # Maximum number of servers of each page
+    PAGE_SIZE = 1000
+
+    # Seconds the image and flavor names are reused
+    CATALOG_TTL = 3600
+
+    # Driver method of each bulk action
+    BULK_ACTIONS = {
+        'reboot': 'reboot_node',
+        'stop': 'ex_stop_node',
+        'start': 'ex_start_node',
+        'destroy': 'destroy_node',
+    }
+
+    # State reached by the nodes after each bulk action (the destroyed nodes are no longer listed)
+    BULK_ACTIONS_STATES = {
+        'reboot': 'ACTIVE',
+        'stop': 'SHUTOFF',
+        'start': 'ACTIVE',
+        'destroy': 'DELETED',
+    }
+
+    # States which will never lead to the desired ones
+    FAILURE_STATES = ['ERROR']
+
+    def __init__(self, region=None):
         """
-        Init the OpenStack connection
+        Init the OpenStack connection and the caches
+
+        :param region: Region of the nodes (the configured one by default)
+        """
+        connection = Connection()
+        self.region = region or connection.OPENSTACK_REGION
+        self.conn = connection.openstack_connection(self.region)
+        self.inventory = TtlCache(connection.OPENSTACK_INVENTORY_TTL)
+        self.catalog = TtlCache(self.CATALOG_TTL)
+        self.workers = connection.WORKERS
+
+    def _get_names(self, region, kind):
+        """
+        Get the names of the images or flavors of a region (memoized)
+
+        :param region: Region name
+        :param kind: 'images' or 'sizes' (flavors)
+        :return: Dictionary with the name of each ID
+        """
+        def load():
+            items = getattr(Connection().openstack_connection(region), 'list_' + kind)()
+            return dict((item.id, item.name) for item in items)
+        return self.catalog.get((kind, region), load)
+
+    @staticmethod
+    def _fetch_servers(region):
+        """
+        Fetch the servers of a region, page by page
+
+        Nova caps the page size at its osapi_max_limit (which may be lower than PAGE_SIZE), so the pages are followed
+        through their next link rather than stopping at the first short one
+
+        :param region: Region name
+        :return: Generator of servers (dictionaries returned by Nova)
         """
-        self.conn = Connection().openstack_connection()
+        conn = Connection().openstack_connection(region)
+        marker = None
+        while True:
+            params = {'limit': OpenStackCompute.PAGE_SIZE}
+            if marker:
+                params['marker'] = marker
+            page = conn.with_driver(
+                lambda driver: driver.connection.request('/servers/detail', params=params).object)
+            servers = page.get('servers', [])
+            for server in servers:
+                yield server
 
-    def list_running_instances(self):
+            # Last page (there is not a next link, or the page is empty)
+            links = [link['href'] for link in page.get('servers_links', []) if link.get('rel') == 'next']
+            if not servers or not links:
+                break
+            marker = urlparse.parse_qs(urlparse.urlparse(links[0]).query).get('marker', [servers[-1]['id']])[0]
+
+    def _iter_nodes(self, region=None):
+        """
+        Iterate the node records of a region as the pages arrive (they are cached, for the configured inventory
+        TTL, once the last page has been received)
+
+        :param region: Region name (the region of the handler by default)
+        :return: Generator of node records
+        """
+        region = region or self.region
+        key = ('nodes', region)
+
+        # Cached nodes
+        cached = self.inventory.lookup(key)
+        if cached is not None:
+            for node in cached:
+                yield node
+            return
+
+        # Fetch them
+        images = self._get_names(region, 'images')
+        flavors = self._get_names(region, 'sizes')
+        collected = [] if self.inventory.ttl > 0 else None
+        for server in self._fetch_servers(region):
+            node = NodeRecord.from_server(server, region, images, flavors)
+            if collected is not None:
+                collected.append(node)
+            yield node
+        if collected is not None:
+            self.inventory.put(key, collected)
+
+    def _iter_regions_nodes(self, regions=None):
+        """
+        Iterate the node records of many regions, queried concurrently
+
+        :param regions: Region names (None for the region of the handler)
+        :return: Generator of node records, as the pages of each region arrive
+        """
+        for region, node, error in fan_out_streams(self._iter_nodes, regions or [self.region], self.workers):
+            if error is not None:
+                print >> sys.stderr, '%s: %s' % (region, error)
+                continue
+            yield node
+
+    def list_running_instances(self, regions=None):
         """
         List (print) all the running instances
+
+        :param regions: Region names, queried concurrently (None for the region of the handler)
+        """
+        count = 0
+        for node in self._iter_regions_nodes(regions):
+            if node.state == 'ACTIVE':
+                print '%d: %s - %s (Zone: %s) (Image: %s) (Flavor: %s) (%s)' % (
+                    count, node.name, node.id, node.zone, node.image, node.flavor, node.region)
+                count += 1
+
+        if not count:
+            print 'There are no running instances!'
+
+    def select_nodes(self, node_ids=None, name=None, state=None, regions=None):
+        """
+        Select nodes given their IDs, or a name pattern and a state
+
+        :param node_ids: IDs of the nodes (None to select them with the name and the state)
+        :param name: Name of the nodes, which may contain wildcards (*)
+        :param state: Nova status of the nodes (e.g. 'ACTIVE' or 'SHUTOFF')
+        :param regions: Region names, queried concurrently (None for the region of the handler)
+        :return: Node records
+        """
+        wanted = set(node_ids or [])
+        nodes = []
+        for node in self._iter_regions_nodes(regions):
+            if node_ids is not None:
+                if node.id in wanted:
+                    nodes.append(node)
+            elif (name is None or fnmatch.fnmatchcase(node.name or '', name)) and \
+                    (state is None or node.state == state.upper()):
+                nodes.append(node)
+        return nodes
+
+    @staticmethod
+    def _node_action(method, node):
+        """
+        Execute an action over a node
+
+        :param method: Driver method of the action
+        :param node: Node record
+        :return: None if it succeeded, the error otherwise
+        """
+        def execute(driver):
+            base = lazy_import('libcloud.compute.base')
+            return getattr(driver, method)(base.Node(node.id, node.name, None, [], [], driver))
+
+        # noinspection PyBroadException
+        try:
+            if Connection().openstack_connection(node.region).with_driver(execute) is False:
+                return 'rejected'
+            return None
+        except Exception as e:
+            return str(e)
+
+    def bulk_action(self, action, node_ids=None, name=None, state=None, regions=None):
+        """
+        Execute an action over many nodes at once
+        Nova only accepts one node per request, so the requests are sent concurrently
+
+        :param action: Action to execute: 'reboot', 'stop', 'start' or 'destroy'
+        :param node_ids: IDs of the nodes (None to select them with the name and the state)
+        :param name: Name of the nodes, which may contain wildcards (*)
+        :param state: Nova status of the nodes
+        :param regions: Region names whose nodes are selected (None for the region of the handler)
+        :return: Dictionary with the result of each node: None if it succeeded, the error otherwise
+        """
+        method = self.BULK_ACTIONS[action]
+        nodes = self.select_nodes(node_ids, name, state, regions)
+        results = dict((node_id, 'not found') for node_id in node_ids or [])
+        errors = parallel_map(lambda node: self._node_action(method, node), nodes, self.workers)
+        results.update((node.id, error) for node, error in zip(nodes, errors))
+
+        for region in regions or [self.region]:
+            self.inventory.invalidate(('nodes', region))
+        return results
+
+    def create_nodes(self, name, count, image, flavor, region=None):
+        """
+        Create many nodes at once, named <name>-1 to <name>-<count>
+        The requests (one per node) are sent concurrently
+
+        :param name: Prefix of the names of the nodes
+        :param count: Number of nodes
+        :param image: Name or ID of the image
+        :param flavor: Name or ID of the flavor
+        :param region: Region of the nodes (the region of the handler by default)
+        :return: List of IDs of the created nodes, and dictionary with the error of each node which failed (by name)
+        """
+        region = region or self.region
+
+        # Resolve the image and the flavor
+        images = self._get_names(region, 'images')
+        flavors = self._get_names(region, 'sizes')
+        image_id = image if image in images else dict((v, k) for k, v in images.items()).get(image)
+        flavor_id = flavor if flavor in flavors else dict((v, k) for k, v in flavors.items()).get(flavor)
+        if image_id is None or flavor_id is None:
+            return [], {name: 'unknown %s' % ('image' if image_id is None else 'flavor')}
+
+        def create(node_name):
+            def execute(driver):
+                base = lazy_import('libcloud.compute.base')
+                return driver.create_node(name=node_name,
+                                          image=base.NodeImage(image_id, images[image_id], driver),
+                                          size=base.NodeSize(flavor_id, flavors[flavor_id], None, None, None, None,
+                                                             driver))
+
+            # noinspection PyBroadException
+            try:
+                return Connection().openstack_connection(region).with_driver(execute).id, None
+            except Exception as e:
+                return None, str(e)
+
+        names = ['%s-%d' % (name, i) for i in range(1, count + 1)]
+        node_ids = []
+        errors = {}
+        for node_name, (node_id, error) in zip(names, parallel_map(create, names, self.workers)):
+            if error is None:
+                node_ids.append(node_id)
+            else:
+                errors[node_name] = error
+
+        self.inventory.invalidate(('nodes', region))
+        return node_ids, errors
+
+    @staticmethod
+    def _get_node_state(node_id, region):
+        """
+        Get the state of a node with a single request
+
+        :param node_id: Node ID
+        :param region: Region name
+        :return: Nova status, 'DELETED' if Nova answers that the node does not exist (404), None if it could not be
+                 checked
+        """
+        def get(driver):
+            return driver.connection.request('/servers/%s' % node_id).object['server'].get('status')
+
+        # noinspection PyBroadException
+        try:
+            return Connection().openstack_connection(region).with_driver(get)
+        except Exception as e:
+            if getattr(e, 'code', None) == 404 or getattr(e, 'status', None) == 404:
+                return 'DELETED'
+            return None
+
+    def _describe_nodes_states(self, node_ids, regions, located):
+        """
+        Get the state of many nodes, with one request per node (sent concurrently)
+        The nodes whose region is not known yet are looked for in every region
+
+        :param node_ids: IDs of the nodes
+        :param regions: Region names of the nodes
+        :param located: Dictionary with the region of each node, updated as the nodes are found
+        :return: Dictionary with the state of each node which could be checked ('DELETED' only if Nova answered that
+                 it does not exist in any of its possible regions)
+        """
+        def describe(node_id):
+            deleted = True
+            for region in [located[node_id]] if node_id in located else regions:
+                state = self._get_node_state(node_id, region)
+                if state is None:
+                    deleted = False
+                elif state != 'DELETED':
+                    located[node_id] = region
+                    return state
+            return 'DELETED' if deleted else None
+
+        states = parallel_map(describe, node_ids, self.workers)
+        return dict((node_id, state) for node_id, state in zip(node_ids, states) if state is not None)
+
+    def wait_for_nodes(self, node_ids, state='ACTIVE', timeout=Waiter.DEFAULT_TIMEOUT, regions=None):
+        """
+        Wait until some nodes reach a state
+        All the pending nodes are checked together, with an exponential backoff between checks
+
+        :param node_ids: IDs of the nodes
+        :param state: State to reach ('DELETED' to wait until they are destroyed)
+        :param timeout: Maximum number of seconds to wait
+        :param regions: Region names of the nodes (None for the region of the handler)
+        :return: True if all the nodes reached the state, and dictionary with the last state of each node
         """
-        for i, node in enumerate(self.conn.list_nodes()):
-            if not node.state:
-                print '%d: %s - %s (Zone: %s)' % (i, node.name, node.id, node.extra['availability_zone'])
+        located = {}
+        done, states = Waiter(lambda ids: self._describe_nodes_states(ids, regions or [self.region], located)).wait(
+            node_ids, state.upper(), self.FAILURE_STATES, timeout)
+        for region in regions or [self.region]:
+            self.inventory.invalidate(('nodes', region))
+        return done, states
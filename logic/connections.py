@@ -1,121 +1,409 @@
-from libcloud.compute.types import Provider
-from libcloud.compute.providers import get_driver
-from libcloud.storage.providers import get_driver as get_storage_driver
-from libcloud.storage.types import Provider as StorageProvider
-import boto
-import boto.ec2
-import boto.ec2.elb
-import boto.ec2.cloudwatch
-import boto.sns
-import boto.cloudformation
+import os
+import threading
 from ConfigParser import ConfigParser
 
+from logic.imports import lazy_import
+
 
 class Connection:
     """
     The connection class take care of managing the user credentials and authenticating the user
     in the different providers
+
+    The configuration file is parsed only once per process, and the clients are kept in a shared registry
+    (per service, profile and region), so creating several Connection objects is cheap and every logic handler reuses
+    the same underlying boto/libcloud clients
+
+    Besides the [aws] credentials (or those of the boto config file), other AWS accounts can be configured as named
+    profiles, in [profile NAME] sections; each profile gets its own clients
+
+    The boto and libcloud modules of each service are imported the first time a client of that service is created
     """
 
-    def __init__(self):
+    # Configuration file
+    CONFIG_FILE = 'config.ini'
+
+    # Seconds the inventories (e.g. EC2 instances) are reused if it is not configured
+    DEFAULT_INVENTORY_TTL = 60
+
+    # OpenStack region if it is not configured
+    DEFAULT_OPENSTACK_REGION = 'RegionOne'
+
+    # Seconds the resolved AMIs are reused if it is not configured
+    DEFAULT_AMI_CACHE_TTL = 24 * 3600
+
+    # Number of concurrent requests of the bulk operations if it is not configured
+    DEFAULT_WORKERS = 8
+
+    # Size (in MB) from which the files are uploaded in parts if it is not configured
+    DEFAULT_MULTIPART_THRESHOLD = 64
+
+    # Size (in MB) of the parts of the transfers if it is not configured
+    DEFAULT_PART_SIZE = 16
+
+    # Folder where the program keeps its state (caches, sockets...) if it is not configured
+    DEFAULT_STATE_DIR = '~/.cloud-cli'
+
+    # Parsed configuration, shared by every Connection
+    _config = None
+
+    # Prefixes of the regions of the isolated AWS partitions (GovCloud and China), which need their own credentials
+    ISOLATED_REGIONS_PREFIXES = ('us-gov-', 'cn-')
+
+    # Prefix of the sections of the named profiles
+    PROFILE_PREFIX = 'profile '
+
+    # Registry of clients, indexed by (service, profile, region)
+    _clients = {}
+
+    # Lock protecting the configuration and the registry
+    _lock = threading.RLock()
+
+    def __init__(self, profile=None):
         """
-        The constructor will read the config.ini file and load the properties as class constants
+        The constructor will read the config.ini file (if it has not been read yet) and load the properties
+        as class constants
+
+        :param profile: Name of the AWS profile (None for the [aws] credentials)
         """
 
         # Read the file
-        cloud_config = ConfigParser()
-        cloud_config.read("config.ini")
+        cloud_config = self._get_config()
+        if profile is not None and not cloud_config.has_section(self.PROFILE_PREFIX + profile):
+            raise ValueError('Unknown profile %s' % profile)
 
         # AWS configuration
         self.AWS_ACCESS_ID = cloud_config.get('aws', 'aws_access_key_id')
         self.AWS_SECRET_KEY = cloud_config.get('aws', 'aws_secret_access_key')
         self.AWS_REGION = cloud_config.get('aws', 'aws_region')
+        self.AWS_REGIONS = [region.strip() for region in self._get_option('aws', 'aws_regions', '').split(',')
+                            if region.strip()]
+        self.AWS_INVENTORY_TTL = float(self._get_option('aws', 'inventory_ttl', self.DEFAULT_INVENTORY_TTL))
+        self.AWS_AMI_CACHE_TTL = float(self._get_option('aws', 'ami_cache_ttl', self.DEFAULT_AMI_CACHE_TTL))
+
+        # AWS profile (its options replace those of the [aws] section)
+        self.PROFILE = profile
+        if profile is not None:
+            section = self.PROFILE_PREFIX + profile
+            self.AWS_ACCESS_ID = cloud_config.get(section, 'aws_access_key_id')
+            self.AWS_SECRET_KEY = cloud_config.get(section, 'aws_secret_access_key')
+            self.AWS_REGION = self._get_option(section, 'aws_region', self.AWS_REGION)
 
         # OpenStack configuration
         self.OPENSTACK_USER = cloud_config.get('openstack', 'openstack_user')
         self.OPENSTACK_PASS = cloud_config.get('openstack', 'openstack_password')
         self.OPENSTACK_URL = cloud_config.get('openstack', 'openstack_url')
+        self.OPENSTACK_REGION = self._get_option('openstack', 'openstack_region', self.DEFAULT_OPENSTACK_REGION)
+        self.OPENSTACK_INVENTORY_TTL = float(self._get_option('openstack', 'inventory_ttl',
+                                                              self.DEFAULT_INVENTORY_TTL))
 
         # Other config
         self.DEFAULT_ALERT_EMAIL = cloud_config.get('general', 'default_alert_email')
+        self.WORKERS = int(self._get_option('general', 'workers', self.DEFAULT_WORKERS))
+        self.MULTIPART_THRESHOLD = int(self._get_option('general', 'multipart_threshold',
+                                                        self.DEFAULT_MULTIPART_THRESHOLD)) * 1024 * 1024
+        self.PART_SIZE = int(self._get_option('general', 'part_size', self.DEFAULT_PART_SIZE)) * 1024 * 1024
+        self.TRANSFER_WORKERS = int(self._get_option('general', 'transfer_workers', self.WORKERS))
+        self.STATE_DIR = os.path.expanduser(self._get_option('general', 'state_dir', self.DEFAULT_STATE_DIR))
+        self.DAEMON_SOCKET = os.path.expanduser(
+            self._get_option('general', 'daemon_socket', os.path.join(self.STATE_DIR, 'daemon.sock')))
+
+    def _get_option(self, section, option, default):
+        """
+        Get an optional property of the configuration
+
+        :param section: Section of the property
+        :param option: Name of the property
+        :param default: Value if the property is not configured (or it is empty)
+        :return: Value of the property
+        """
+        cloud_config = self._get_config()
+        if not cloud_config.has_option(section, option) or not cloud_config.get(section, option):
+            return default
+        return cloud_config.get(section, option)
+
+    def state_path(self, *names):
+        """
+        Get the path of a file within the state folder, creating the folder (only accessible by the user) if needed
+
+        :param names: Components of the path within the state folder
+        :return: Path
+        """
+        path = os.path.join(self.STATE_DIR, *names)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder, 0700)
+            except OSError:
+                # It may have been created by another thread meanwhile
+                if not os.path.isdir(folder):
+                    raise
+        return path
+
+    def get_regions(self, regions=None):
+        """
+        Get the names of a set of AWS regions
+
+        :param regions: Comma separated names (or list of them), 'all' for the configured aws_regions (or every EC2
+                        region of the standard partition if they are not configured), None for the configured region
+        :return: List of region names
+        """
+        if not regions:
+            return [self.AWS_REGION]
+        if isinstance(regions, basestring):
+            if regions == 'all':
+                return self.AWS_REGIONS or [region.name for region in lazy_import('boto.ec2').regions()
+                                            if not region.name.startswith(self.ISOLATED_REGIONS_PREFIXES)]
+            regions = regions.split(',')
+        return [region.strip() for region in regions if region.strip()]
+
+    def get_openstack_regions(self, regions=None):
+        """
+        Get the names of a set of OpenStack regions
+
+        :param regions: Comma separated names (or list of them), 'all' for every compute region of the Keystone
+                        catalog, None for the configured region
+        :return: List of region names
+        """
+        if not regions:
+            return [self.OPENSTACK_REGION]
+        if isinstance(regions, basestring):
+            if regions == 'all':
+                return self.keystone_session().get_regions('compute')
+            regions = regions.split(',')
+        return [region.strip() for region in regions if region.strip()]
 
-    def ec2_connection(self):
+    def get_profiles(self, profiles):
+        """
+        Get the names of a set of AWS profiles
+
+        :param profiles: Comma separated names (or list of them), 'all' for every configured profile
+        :return: List of profile names
+        :raise ValueError: If a profile is not configured
+        """
+        if isinstance(profiles, basestring):
+            if profiles == 'all':
+                return sorted(section[len(self.PROFILE_PREFIX):] for section in self._get_config().sections()
+                              if section.startswith(self.PROFILE_PREFIX))
+            profiles = profiles.split(',')
+        profiles = [profile.strip() for profile in profiles if profile.strip()]
+        for profile in profiles:
+            if not self._get_config().has_section(self.PROFILE_PREFIX + profile):
+                raise ValueError('Unknown profile %s' % profile)
+        return profiles
+
+    def get_scopes(self, regions=None, profiles=None):
+        """
+        Get the (profile, region) pairs to query
+
+        :param regions: Region names (None for the region of each profile)
+        :param profiles: Profile names (None for the profile of this connection)
+        :return: List of (profile, region) tuples
+        """
+        scopes = []
+        for profile in profiles or [self.PROFILE]:
+            for region in regions or [Connection(profile).AWS_REGION]:
+                scopes.append((profile, region))
+        return scopes
+
+    @staticmethod
+    def scope_name(profile, region):
+        """
+        Get the name of a (profile, region) pair, to tag the resources of merged listings
+
+        :param profile: Profile name (None for the [aws] credentials)
+        :param region: Region name
+        :return: Name
+        """
+        return region if profile is None else '%s/%s' % (profile, region)
+
+    @classmethod
+    def _get_config(cls):
+        """
+        Get the parsed configuration, reading the config file the first time
+
+        :return: Configuration (ConfigParser)
+        """
+        with cls._lock:
+            if cls._config is None:
+                cloud_config = ConfigParser()
+                cloud_config.read(cls.CONFIG_FILE)
+                cls._config = cloud_config
+            return cls._config
+
+    @classmethod
+    def invalidate(cls, service=None, region=None, profile=None):
+        """
+        Invalidate the cached clients, so they are created again the next time they are requested
+        If neither the service, the region nor the profile are provided, the configuration file is read again too
+        (which allows rotating the credentials without restarting the program)
+
+        :param service: Service whose clients will be invalidated (None for any service)
+        :param region: Region whose clients will be invalidated (None for any region)
+        :param profile: Profile whose clients will be invalidated (None for any profile)
+        """
+        with cls._lock:
+            for key in cls._clients.keys():
+                if (service is None or key[0] == service) and (profile is None or key[1] == profile) and \
+                        (region is None or key[2] == region):
+                    del cls._clients[key]
+            if service is None and region is None and profile is None:
+                cls._config = None
+
+    def _get_client(self, service, region, factory):
+        """
+        Get a client from the registry, creating it if it does not exist yet
+
+        :param service: Service name
+        :param region: Region of the client
+        :param factory: Function creating the client
+        :return: Client
+        """
+        key = (service, self.PROFILE, region)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = factory()
+                self._clients[key] = client
+            return client
+
+    def _get_aws_client(self, service, module, region):
+        """
+        Get a boto client from the registry, creating it if it does not exist yet
+
+        :param service: Service name
+        :param module: Boto module of the service
+        :param region: Region to connect to (the configured one by default)
+        :return: Client
+        """
+        region = region or self.AWS_REGION
+
+        def create():
+            if self.PROFILE is None:
+                return lazy_import(module).connect_to_region(region)
+            return lazy_import(module).connect_to_region(region, aws_access_key_id=self.AWS_ACCESS_ID,
+                                                         aws_secret_access_key=self.AWS_SECRET_KEY)
+        return self._get_client(service, region, create)
+
+    def ec2_connection(self, region=None):
         """
         Obtain a EC2 connection
-        The credentials are directly extracted from the boto config file
+        The credentials are those of the profile, or the boto config file ones if there is no profile
 
+        :param region: Region to connect to (the configured one by default)
         :return: EC2 (boto) connection
         """
-        return boto.ec2.connect_to_region(self.AWS_REGION)
+        return self._get_aws_client('ec2', 'boto.ec2', region)
 
-    def ec2_elb_connection(self):
+    def ec2_elb_connection(self, region=None):
         """
         Obtain a EC2 elastic load balancer connection
-        The credentials are directly extracted from the boto config file
+        The credentials are those of the profile, or the boto config file ones if there is no profile
 
+        :param region: Region to connect to (the configured one by default)
         :return: EC2 ELB (boto) connection
         """
-        return boto.ec2.elb.connect_to_region(self.AWS_REGION)
+        return self._get_aws_client('elb', 'boto.ec2.elb', region)
 
-    def cloudwatch_connection(self):
+    def cloudwatch_connection(self, region=None):
         """
         Obtain a CloudWatch (boto) connection
-        The credentials are directly extracted from the boto config file
+        The credentials are those of the profile, or the boto config file ones if there is no profile
 
+        :param region: Region to connect to (the configured one by default)
         :return: CloudWatch (boto) connection
         """
-        return boto.ec2.cloudwatch.connect_to_region(self.AWS_REGION)
+        return self._get_aws_client('cloudwatch', 'boto.ec2.cloudwatch', region)
 
-    def sns_connection(self):
+    def sns_connection(self, region=None):
         """
         Obtain a SNS (boto) connection
-        The credentials are directly extracted from the boto config file
+        The credentials are those of the profile, or the boto config file ones if there is no profile
 
+        :param region: Region to connect to (the configured one by default)
         :return: SNS (boto) connection
         """
-        return boto.sns.connect_to_region(self.AWS_REGION)
+        return self._get_aws_client('sns', 'boto.sns', region)
 
-    def cloudformation_connection(self):
+    def cloudformation_connection(self, region=None):
         """
         Obtain a CloudFormation connection
-        The credentials are directly extracted from the boto config file
+        The credentials are those of the profile, or the boto config file ones if there is no profile
 
+        :param region: Region to connect to (the configured one by default)
         :return: CloudFormation (boto) connection
         """
-        return boto.cloudformation.connect_to_region(self.AWS_REGION)
+        return self._get_aws_client('cloudformation', 'boto.cloudformation', region)
 
     def s3_connection(self):
         """
         Obtain a S3 connection
+        Every thread uses its own driver, so the concurrent transfers do not share the HTTP connection
 
         :return: S3 (libcloud) connection
         """
-        driver = get_storage_driver(StorageProvider.S3_EU_WEST)
-        return driver(self.AWS_ACCESS_ID, self.AWS_SECRET_KEY)
+        def create():
+            providers = lazy_import('libcloud.storage.providers')
+            types = lazy_import('libcloud.storage.types')
+            driver = providers.get_driver(types.Provider.S3_EU_WEST)
+            return driver(self.AWS_ACCESS_ID, self.AWS_SECRET_KEY)
+        return self._get_client('s3', 'eu-west-1', lambda: lazy_import('logic.drivers').ThreadLocalDriver(create))
+
+    def keystone_session(self):
+        """
+        Obtain the Keystone session shared by the OpenStack drivers, whose token is stored in the state folder
 
+        :return: Keystone session
+        """
+        def create():
+            return lazy_import('logic.keystone').KeystoneSession(self.OPENSTACK_URL, self.OPENSTACK_USER,
+                                                                 self.OPENSTACK_PASS, self.OPENSTACK_USER,
+                                                                 self.state_path('keystone-token.json'))
+        return self._get_client('keystone', None, create)
 
-    def openstack_connection(self):
+    def openstack_connection(self, region=None):
         """
         Obtain a OpenStack connection
+        It authenticates with the token of the shared Keystone session
 
+        :param region: Region to connect to (the configured one by default)
         :return: OpenStack (libcloud) connection
         """
-        driver = get_driver(Provider.OPENSTACK)
-        return driver(self.OPENSTACK_USER, self.OPENSTACK_PASS,
-                      ex_force_auth_url=self.OPENSTACK_URL,
-                      ex_force_auth_version='2.0_password',
-                      ex_tenant_name=self.OPENSTACK_USER,
-                      ex_force_service_region='RegionOne')
+        region = region or self.OPENSTACK_REGION
+        providers = lazy_import('libcloud.compute.providers')
+        types = lazy_import('libcloud.compute.types')
+
+        def factory(token, endpoint):
+            driver = providers.get_driver(types.Provider.OPENSTACK)
+            return driver(self.OPENSTACK_USER, self.OPENSTACK_PASS,
+                          ex_force_auth_url=self.OPENSTACK_URL,
+                          ex_force_auth_version='2.0_password',
+                          ex_tenant_name=self.OPENSTACK_USER,
+                          ex_force_service_region=region,
+                          ex_force_auth_token=token,
+                          ex_force_base_url=endpoint)
+        return self._get_client('openstack', region,
+                                lambda: self.keystone_session().driver(factory, 'compute', region))
 
     def openstack_swift_connection(self):
         """
         Obtain a OpenStack Swift connection
+        It authenticates with the token of the shared Keystone session
 
         :return: OpenStack Swift (libcloud) connection
         """
-        driver = get_storage_driver(StorageProvider.OPENSTACK_SWIFT)
-        return driver(self.OPENSTACK_USER, self.OPENSTACK_PASS,
-                      ex_force_auth_url=self.OPENSTACK_URL,
-                      ex_force_auth_version='2.0_password',
-                      ex_tenant_name=self.OPENSTACK_USER,
-                      ex_force_service_region='RegionOne')
+        providers = lazy_import('libcloud.storage.providers')
+        types = lazy_import('libcloud.storage.types')
+
+        def factory(token, endpoint):
+            driver = providers.get_driver(types.Provider.OPENSTACK_SWIFT)
+            return driver(self.OPENSTACK_USER, self.OPENSTACK_PASS,
+                          ex_force_auth_url=self.OPENSTACK_URL,
+                          ex_force_auth_version='2.0_password',
+                          ex_tenant_name=self.OPENSTACK_USER,
+                          ex_force_service_region=self.OPENSTACK_REGION,
+                          ex_force_auth_token=token,
+                          ex_force_base_url=endpoint)
+        return self._get_client('swift', self.OPENSTACK_REGION,
+                                lambda: self.keystone_session().driver(factory, 'object-store',
+                                                                       self.OPENSTACK_REGION))
@@ -0,0 +1,88 @@
+import threading
+import types
+
+
+class ThreadLocalDriver(object):
+    """
+    Proxy of a libcloud driver, with a driver per thread
+
+    Libcloud connections keep the HTTP connection (and the response being read) in the connection object, so
+    concurrent requests through the same driver could read each other's responses; each thread using the proxy gets
+    its own driver instead. The containers and objects returned by the driver are bound to the proxy, so their own
+    methods (e.g. container.upload_object or obj.delete) also use the driver of the calling thread
+    """
+
+    def __init__(self, factory):
+        """
+        Init the proxy (the driver of each thread is created the first time it is used)
+
+        :param factory: Function without arguments returning a libcloud driver
+        """
+        self._factory = factory
+        self._local = threading.local()
+
+    def _get_driver(self):
+        """
+        Get the driver of the current thread, creating it if there is not one
+
+        :return: Libcloud driver
+        """
+        driver = getattr(self._local, 'driver', None)
+        if driver is None:
+            driver = self._local.driver = self._factory()
+        return driver
+
+    def _bind(self, result):
+        """
+        Make the containers, objects, nodes... returned by the driver use the proxy
+
+        :param result: Result of a method of the driver
+        :return: The same result
+        """
+        for item in (result if isinstance(result, list) else [result]):
+            for owner in (item, getattr(item, 'container', None)):
+                if owner is not None and getattr(owner, 'driver', None) is not None and owner.driver is not self:
+                    try:
+                        owner.driver = self
+                    except AttributeError:
+                        pass
+        return result
+
+    def _iterate(self, items):
+        """
+        Iterate the items of a generator, binding them to the proxy
+
+        :param items: Generator
+        :return: Generator of items
+        """
+        for item in items:
+            yield self._bind(item)
+
+    def with_driver(self, f):
+        """
+        Call a function with the driver of the current thread (e.g. to send raw requests through its connection)
+
+        :param f: Function receiving the driver
+        :return: Result of the function
+        """
+        return f(self._get_driver())
+
+    def __getattr__(self, name):
+        """
+        Get an attribute of the driver of the current thread
+
+        :param name: Name of the attribute
+        :return: Attribute
+        """
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attribute = getattr(self._get_driver(), name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            result = getattr(self._get_driver(), name)(*args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                return self._iterate(result)
+            return self._bind(result)
+        return call
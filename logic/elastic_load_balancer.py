@@ -1,6 +1,8 @@
-from boto.ec2.elb import HealthCheck
+import sys
 
 from logic.connections import Connection
+from logic.imports import lazy_import
+from logic.parallel import fan_out
 
 
 # noinspection PyBroadException
@@ -15,11 +17,18 @@ class ElasticLoadBalancing:
     It's effectiveness can be tested by executing requests to the load balancer and observing how they are redirected
     """
 
-    def __init__(self):
+    def __init__(self, region=None, profile=None):
         """
         Init the ELB (boto) connection
+
+        :param region: Region of the load balancers (the region of the profile by default)
+        :param profile: AWS profile (None for the [aws] credentials)
         """
-        self.conn = Connection().ec2_elb_connection()
+        connection = Connection(profile)
+        self.profile = profile
+        self.region = region or connection.AWS_REGION
+        self.conn = connection.ec2_elb_connection(self.region)
+        self.workers = connection.WORKERS
 
     def _get_load_balancers(self):
         """
@@ -29,6 +38,27 @@ class ElasticLoadBalancing:
         """
         return self.conn.get_all_load_balancers()
 
+    def _iter_scopes_load_balancers(self, regions=None, accounts=None):
+        """
+        Get the load balancers of many regions and accounts, queried concurrently
+
+        :param regions: Region names (None for the region of each account)
+        :param accounts: Profile names (None for the profile of the handler)
+        :return: Generator of (scope name, load balancer) tuples, as each region and account answers
+        """
+        def fetch(scope):
+            return Connection(scope[0]).ec2_elb_connection(scope[1]).get_all_load_balancers()
+
+        scopes = [(self.profile, self.region)]
+        if regions or accounts:
+            scopes = Connection(self.profile).get_scopes(regions, accounts)
+        for scope, balancers, error in fan_out(fetch, scopes, self.workers):
+            if error is not None:
+                print >> sys.stderr, '%s: %s' % (Connection.scope_name(*scope), error)
+                continue
+            for lb in balancers:
+                yield Connection.scope_name(*scope), lb
+
     def get_load_balancers_names(self):
         """
         Map the list of load balancers to their names
@@ -49,19 +79,21 @@ class ElasticLoadBalancing:
             return None
         return balancers[0]
 
-    def list_load_balancers(self):
+    def list_load_balancers(self, regions=None, accounts=None):
         """
         List (print) all the load balancers
+
+        :param regions: Region names, queried concurrently (None for the region of each account)
+        :param accounts: Profile names, queried concurrently (None for the profile of the handler)
         """
-        balancers = self._get_load_balancers()
+        count = 0
+        for scope, lb in self._iter_scopes_load_balancers(regions, accounts):
+            print '%d: %s (Instances: %s) (DNS: %s) (Zones: %s) (%s)' % (
+                count, lb.name, lb.instances, lb.dns_name, lb.availability_zones, scope)
+            count += 1
 
-        if len(balancers) == 0:
+        if not count:
             print 'There are no load balancers created!'
-            return
-
-        for i, lb in enumerate(balancers):
-            print '%d: %s (Instances: %s) (DNS: %s) (Zones: %s)' % (
-                i, lb.name, lb.instances, lb.dns_name, lb.availability_zones)
 
     def create_load_balancer(self, load_balancer_name):
         """
@@ -78,7 +110,7 @@ class ElasticLoadBalancing:
             lb = self.conn.create_load_balancer(load_balancer_name, zones, ports)
 
             # Then, a health check is created and associated with it
-            hc = HealthCheck(
+            hc = lazy_import('boto.ec2.elb').HealthCheck(
                 interval=20,
                 healthy_threshold=3,
                 unhealthy_threshold=5,
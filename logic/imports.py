@@ -0,0 +1,43 @@
+import importlib
+import sys
+import time
+
+
+# Time (in milliseconds) spent importing each module loaded through lazy_import, in loading order
+IMPORT_TIMES = []
+
+
+def lazy_import(name):
+    """
+    Import a module the first time it is needed, recording how long the import took
+
+    The provider SDKs (boto and libcloud) are slow to import, so they are only loaded when the menu or command
+    which needs them is used
+
+    :param name: Full name of the module (e.g. 'boto.ec2')
+    :return: Module
+    """
+
+    # Already loaded: nothing to measure
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    # Import it and store the elapsed time
+    start = time.time()
+    module = importlib.import_module(name)
+    IMPORT_TIMES.append((name, (time.time() - start) * 1000))
+    return module
+
+
+def print_import_report():
+    """
+    Print (to stderr) the time spent importing each lazily loaded module
+    The times are inclusive: a module includes the modules it imported itself
+    """
+    if not IMPORT_TIMES:
+        print >> sys.stderr, 'No modules were lazily imported'
+        return
+    print >> sys.stderr, '# Import times'
+    for name, elapsed in IMPORT_TIMES:
+        print >> sys.stderr, '%9.1f ms  %s' % (elapsed, name)
@@ -0,0 +1,251 @@
+import datetime
+import json
+import sqlite3
+import time
+
+from logic.compute_aws import AwsCompute
+from logic.connections import Connection
+
+
+class InventorySnapshot:
+    """
+    Local (SQLite) snapshot of the AWS inventory: instances, volumes, load balancers and alarms
+
+    Each resource is stored as a JSON document; a refresh stores only the resources which changed and removes the
+    ones which no longer exist, and records when each kind of resource was refreshed. The alarms are refreshed
+    incrementally (only those with history since the previous refresh are described again); the rest of the
+    resources are listed page by page and compared with the snapshot
+    """
+
+    # Kinds of resources in the snapshot
+    KINDS = ['instances', 'volumes', 'load_balancers', 'alarms']
+
+    # Maximum age (in seconds) of the previous refresh to refresh the alarms incrementally
+    INCREMENTAL_MAX_AGE = 24 * 3600
+
+    # Database schema
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS resources (
+            kind TEXT NOT NULL,
+            region TEXT NOT NULL,
+            id TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (kind, region, id)
+        );
+        CREATE TABLE IF NOT EXISTS refreshes (
+            kind TEXT NOT NULL,
+            region TEXT NOT NULL,
+            refreshed_at REAL NOT NULL,
+            changed INTEGER NOT NULL,
+            removed INTEGER NOT NULL,
+            PRIMARY KEY (kind, region)
+        );
+    '''
+
+    def __init__(self, path=None):
+        """
+        Open (or create) the snapshot of the configured region
+
+        :param path: Path of the database (inventory.sqlite within the state folder by default)
+        """
+        connection = Connection()
+        self.region = connection.AWS_REGION
+        self.db = sqlite3.connect(path or connection.state_path('inventory.sqlite'))
+        self.db.executescript(self.SCHEMA)
+        self.compute = None
+
+    def _get_compute(self):
+        """
+        Get the EC2 handler, created the first time it is needed
+
+        :return: AwsCompute handler
+        """
+        if self.compute is None:
+            self.compute = AwsCompute()
+        return self.compute
+
+    def refreshed_at(self, kind):
+        """
+        Get when a kind of resource was refreshed for the last time
+
+        :param kind: Kind of resource
+        :return: Timestamp of the last refresh, None if it was never refreshed
+        """
+        row = self.db.execute('SELECT refreshed_at FROM refreshes WHERE kind = ? AND region = ?',
+                              (kind, self.region)).fetchone()
+        return row[0] if row else None
+
+    def get(self, kind):
+        """
+        Get the resources of a kind from the snapshot
+
+        :param kind: Kind of resource
+        :return: Generator of resources (dictionaries)
+        """
+        cursor = self.db.execute('SELECT data FROM resources WHERE kind = ? AND region = ? ORDER BY id',
+                                 (kind, self.region))
+        for row in cursor:
+            yield json.loads(row[0])
+
+    def _store(self, kind, resources, complete=True, removed_ids=(), started_at=None):
+        """
+        Store the resources which changed
+
+        :param kind: Kind of resource
+        :param resources: Iterable of (id, dictionary) tuples
+        :param complete: True if the resources are all the existing ones (so the rest are removed)
+        :param removed_ids: IDs of resources known to have been removed
+        :param started_at: Timestamp when the fetch of the resources started, recorded as the time of the refresh
+                           (now by default, before iterating the resources)
+        :return: Number of changed and removed resources
+        """
+        if started_at is None:
+            started_at = time.time()
+        stored = dict(self.db.execute('SELECT id, data FROM resources WHERE kind = ? AND region = ?',
+                                      (kind, self.region)))
+        changed = 0
+        seen = set()
+        with self.db:
+
+            # Insert or update the resources which changed
+            for resource_id, resource in resources:
+                seen.add(resource_id)
+                data = json.dumps(resource, sort_keys=True)
+                if stored.get(resource_id) != data:
+                    self.db.execute('INSERT OR REPLACE INTO resources (kind, region, id, data) VALUES (?, ?, ?, ?)',
+                                    (kind, self.region, resource_id, data))
+                    changed += 1
+
+            # Remove the resources which no longer exist
+            removed = set(removed_ids) & set(stored)
+            if complete:
+                removed |= set(stored) - seen
+            self.db.executemany('DELETE FROM resources WHERE kind = ? AND region = ? AND id = ?',
+                                [(kind, self.region, resource_id) for resource_id in removed])
+
+            # Record the refresh (with the time when the fetch started, so the next incremental refresh covers the
+            # changes made while fetching)
+            self.db.execute('INSERT OR REPLACE INTO refreshes (kind, region, refreshed_at, changed, removed) '
+                            'VALUES (?, ?, ?, ?, ?)', (kind, self.region, started_at, changed, len(removed)))
+
+        return changed, len(removed)
+
+    def _fetch_instances(self):
+        """
+        Fetch the instances, page by page
+
+        :return: Generator of (id, dictionary) tuples
+        """
+        for instance in self._get_compute()._fetch_instances():
+            yield instance.id, dict((field, getattr(instance, field)) for field in instance.__slots__)
+
+    def _fetch_volumes(self):
+        """
+        Fetch the volumes
+
+        :return: Generator of (id, dictionary) tuples
+        """
+        for v in self._get_compute().conn.get_all_volumes():
+            yield v.id, {
+                'id': v.id, 'size': v.size, 'zone': v.zone, 'status': v.status,
+                'instance_id': v.attach_data.instance_id if v.attach_data else None,
+                'device': v.attach_data.device if v.attach_data else None,
+            }
+
+    def _fetch_load_balancers(self):
+        """
+        Fetch the load balancers
+
+        :return: Generator of (name, dictionary) tuples
+        """
+        for lb in Connection().ec2_elb_connection(self.region).get_all_load_balancers():
+            yield lb.name, {
+                'name': lb.name, 'dns_name': lb.dns_name, 'zones': list(lb.availability_zones),
+                'instances': [instance.id for instance in lb.instances],
+            }
+
+    @staticmethod
+    def _alarm_to_dict(alarm):
+        """
+        Convert an alarm into a dictionary
+
+        :param alarm: CloudWatch (boto) alarm
+        :return: Dictionary
+        """
+        return {
+            'name': alarm.name, 'metric': alarm.metric, 'namespace': alarm.namespace, 'state': alarm.state_value,
+            'comparison': alarm.comparison, 'threshold': alarm.threshold, 'dimensions': dict(alarm.dimensions or {}),
+        }
+
+    def _fetch_alarms(self, names=None):
+        """
+        Fetch the alarms, page by page
+
+        :param names: Names of the alarms to fetch (None for all of them)
+        :return: Generator of (name, dictionary) tuples
+        """
+        conn = Connection().cloudwatch_connection(self.region)
+        next_token = None
+        while True:
+            alarms = conn.describe_alarms(alarm_names=names, next_token=next_token)
+            for alarm in alarms:
+                yield alarm.name, self._alarm_to_dict(alarm)
+            next_token = getattr(alarms, 'next_token', None)
+            if not next_token:
+                break
+
+    def _refresh_alarms(self, force):
+        """
+        Refresh the alarms
+        If the previous refresh is recent, only the alarms with history since then are described again
+
+        :param force: True to describe all the alarms
+        :return: Number of changed and removed alarms
+        """
+        last = self.refreshed_at('alarms')
+        started_at = time.time()
+        if force or last is None or time.time() - last > self.INCREMENTAL_MAX_AGE:
+            return self._store('alarms', self._fetch_alarms(), started_at=started_at)
+
+        # Alarms with history since the last refresh
+        conn = Connection().cloudwatch_connection(self.region)
+        start = datetime.datetime.utcfromtimestamp(last)
+        names = set()
+        next_token = None
+        while True:
+            items = conn.describe_alarm_history(start_date=start, next_token=next_token)
+            names.update(item.name for item in items)
+            next_token = getattr(items, 'next_token', None)
+            if not next_token:
+                break
+
+        # Describe them again; those which are not returned were deleted
+        names = sorted(names)
+        alarms = []
+        for i in range(0, len(names), 100):
+            alarms.extend(self._fetch_alarms(names[i:i + 100]))
+        removed = set(names) - set(name for name, alarm in alarms)
+        return self._store('alarms', alarms, complete=False, removed_ids=removed,
+                           started_at=started_at)
+
+    def refresh(self, kinds=None, force=False):
+        """
+        Refresh the snapshot
+
+        :param kinds: Kinds of resources to refresh (all of them by default)
+        :param force: True to describe every resource, instead of refreshing incrementally where possible
+        :return: Dictionary with the number of changed and removed resources of each kind
+        """
+        results = {}
+        for kind in kinds or self.KINDS:
+            if kind == 'alarms':
+                results[kind] = self._refresh_alarms(force)
+            else:
+                results[kind] = self._store(kind, getattr(self, '_fetch_' + kind)())
+        return results
+
+    def close(self):
+        """
+        Close the database
+        """
+        self.db.close()
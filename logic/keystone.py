@@ -0,0 +1,254 @@
+import calendar
+import json
+import os
+import threading
+import time
+import types
+
+from logic.drivers import ThreadLocalDriver
+from logic.imports import lazy_import
+
+
+class KeystoneSession:
+    """
+    Keystone (identity v2.0) session shared by every OpenStack driver
+
+    The token and the service catalog are obtained once and stored on disk (only readable by the user) until
+    shortly before the token expires, so the compute and Swift drivers of every execution reuse them instead of
+    authenticating again. The drivers are created with the token and their endpoint from the catalog; if a request is
+    rejected because the token is no longer valid, the session authenticates again and the request is retried once
+    """
+
+    # Seconds before the expiration of the token when it is not used anymore
+    EXPIRY_MARGIN = 300
+
+    def __init__(self, auth_url, user, password, tenant, path):
+        """
+        Init the session, loading the stored token if it is still valid
+
+        :param auth_url: Keystone URL
+        :param user: User name
+        :param password: Password
+        :param tenant: Tenant name
+        :param path: Path of the file where the token is stored
+        """
+        self.auth_url = auth_url
+        self.user = user
+        self.password = password
+        self.tenant = tenant
+        self.path = path
+        self._lock = threading.Lock()
+        self._token = self._load()
+
+    def _load(self):
+        """
+        Load the stored token, if it is valid for the same user and Keystone
+
+        :return: Dictionary with the token, its expiration (timestamp) and the service catalog; None if there is not
+                 a valid one
+        """
+        try:
+            with open(self.path) as f:
+                token = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if token.get('auth_url') != self.auth_url or token.get('user') != self.user or not self._is_valid(token):
+            return None
+        return token
+
+    def _save(self, token):
+        """
+        Store the token, only readable by the user (replacing the file atomically)
+
+        :param token: Dictionary with the token
+        """
+        temporary = '%s.%d' % (self.path, os.getpid())
+        with os.fdopen(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w') as f:
+            json.dump(token, f)
+        os.rename(temporary, self.path)
+
+    def _is_valid(self, token):
+        """
+        Check whether a token can still be used
+
+        :param token: Dictionary with the token
+        :return: True if it does not expire soon
+        """
+        return token is not None and token['expires'] - self.EXPIRY_MARGIN > time.time()
+
+    def _authenticate(self):
+        """
+        Authenticate against Keystone
+
+        :return: Dictionary with the token, its expiration (timestamp) and the service catalog
+        """
+        identity = lazy_import('libcloud.common.openstack_identity').OpenStackIdentity_2_0_Connection(
+            auth_url=self.auth_url, user_id=self.user, key=self.password, tenant_name=self.tenant)
+        identity.authenticate()
+        token = {
+            'auth_url': self.auth_url,
+            'user': self.user,
+            'token': identity.auth_token,
+            'expires': calendar.timegm(identity.auth_token_expires.utctimetuple()),
+            'catalog': identity.urls,
+        }
+        self._save(token)
+        return token
+
+    def get_token(self, rejected=None):
+        """
+        Get a valid token, authenticating if needed
+
+        :param rejected: Token which was rejected by a service (so it is not used again)
+        :return: Dictionary with the token, its expiration (timestamp) and the service catalog
+        """
+        with self._lock:
+            token = self._token
+            if not self._is_valid(token) or (rejected is not None and token['token'] == rejected):
+                token = self._token = self._authenticate()
+            return token
+
+    @staticmethod
+    def get_endpoint(token, service_type, region):
+        """
+        Get the public URL of a service from the catalog
+
+        :param token: Dictionary with the token
+        :param service_type: Type of the service (e.g. 'compute' or 'object-store')
+        :param region: Region of the service
+        :return: URL
+        """
+        for service in token['catalog']:
+            if service.get('type') == service_type:
+                for endpoint in service.get('endpoints', []):
+                    if endpoint.get('region') == region:
+                        return endpoint['publicURL']
+        raise ValueError('There is no %s endpoint in %s' % (service_type, region))
+
+    def get_regions(self, service_type):
+        """
+        Get the regions of a service from the catalog
+
+        :param service_type: Type of the service (e.g. 'compute')
+        :return: Region names
+        """
+        regions = set()
+        for service in self.get_token()['catalog']:
+            if service.get('type') == service_type:
+                regions.update(endpoint['region'] for endpoint in service.get('endpoints', []) if 'region' in endpoint)
+        return sorted(regions)
+
+    def driver(self, factory, service_type, region):
+        """
+        Get a driver which uses the session
+
+        :param factory: Function receiving the token and the endpoint, and returning a libcloud driver
+        :param service_type: Type of the service of the driver
+        :param region: Region of the service
+        :return: Driver (see AuthenticatedDriver)
+        """
+        return AuthenticatedDriver(self, factory, service_type, region)
+
+
+class AuthenticatedDriver(ThreadLocalDriver):
+    """
+    Proxy of a libcloud driver created with the token of a Keystone session
+
+    The methods of the driver are called as usual; if one of them fails because the token was rejected, the driver is
+    created again with a new token and the call is retried once (the generators, like iterate_container_objects, are
+    only retried if they fail before producing anything). The containers and objects returned by the driver are
+    bound to the proxy, so their own methods are retried as well. Every thread uses its own driver (see
+    ThreadLocalDriver)
+    """
+
+    def __init__(self, session, factory, service_type, region):
+        """
+        Init the proxy (the driver is created the first time it is used)
+
+        :param session: Keystone session
+        :param factory: Function receiving the token and the endpoint, and returning a libcloud driver
+        :param service_type: Type of the service of the driver
+        :param region: Region of the service
+        """
+        ThreadLocalDriver.__init__(self, factory)
+        self._session = session
+        self._service_type = service_type
+        self._region = region
+
+    def _get_driver(self, rejected=None):
+        """
+        Get the driver of the current thread, creating it if there is not one or its token was rejected
+
+        :param rejected: Token which was rejected
+        :return: Libcloud driver, and the token it uses
+        """
+        token = self._session.get_token(rejected)
+        local = self._local
+        if getattr(local, 'driver', None) is None or local.token != token['token']:
+            endpoint = self._session.get_endpoint(token, self._service_type, self._region)
+            local.driver = self._factory(token['token'], endpoint)
+            local.token = token['token']
+        return local.driver, local.token
+
+    def with_driver(self, f):
+        """
+        Call a function with the driver (e.g. to send raw requests through its connection), calling it again with a
+        new driver if the token is rejected
+
+        :param f: Function receiving the driver
+        :return: Result of the function
+        """
+        driver, token = self._get_driver()
+        try:
+            return f(driver)
+        except lazy_import('libcloud.common.types').InvalidCredsError:
+            return f(self._get_driver(token)[0])
+
+    def __getattr__(self, name):
+        """
+        Get an attribute of the driver, wrapping its methods so they are retried with a new token when the
+        current one is rejected
+
+        :param name: Name of the attribute
+        :return: Attribute
+        """
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attribute = getattr(self._get_driver()[0], name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            driver, token = self._get_driver()
+
+            def retry():
+                return getattr(self._get_driver(token)[0], name)(*args, **kwargs)
+
+            try:
+                result = getattr(driver, name)(*args, **kwargs)
+            except lazy_import('libcloud.common.types').InvalidCredsError:
+                return self._bind(retry())
+            if isinstance(result, types.GeneratorType):
+                return self._iterate_retrying(result, retry)
+            return self._bind(result)
+        return call
+
+    def _iterate_retrying(self, items, retry):
+        """
+        Iterate the items of a generator, retrying it if the token is rejected before the first item
+
+        :param items: Generator
+        :param retry: Function creating the generator again with a new token
+        :return: Generator of items
+        """
+        try:
+            first = next(items)
+        except StopIteration:
+            return
+        except lazy_import('libcloud.common.types').InvalidCredsError:
+            for item in retry():
+                yield self._bind(item)
+            return
+        yield self._bind(first)
+        for item in items:
+            yield self._bind(item)
@@ -0,0 +1,194 @@
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+def parallel_map(f, items, workers):
+    """
+    Apply a function to every item concurrently, on a bounded pool of threads
+
+    It is meant for I/O bound operations (API calls), so the function should handle its own errors:
+    an exception aborts the whole operation
+
+    :param f: Function to apply
+    :param items: Items
+    :param workers: Maximum number of concurrent threads
+    :return: Results, in the same order as the items
+    """
+    items = list(items)
+
+    # Nothing to parallelize
+    if len(items) <= 1 or workers <= 1:
+        return map(f, items)
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(f, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fan_out(f, items, workers):
+    """
+    Apply a function to every item concurrently, yielding each result as soon as it is ready
+
+    It is meant to query many regions (or accounts) at once: the whole operation takes about as long as the slowest
+    item, and an error in one item does not abort the rest
+
+    :param f: Function to apply
+    :param items: Items
+    :param workers: Maximum number of concurrent threads
+    :return: Generator of (item, result, error) tuples, in completion order (error is None if it succeeded)
+    """
+    def apply(item):
+        # noinspection PyBroadException
+        try:
+            return item, f(item), None
+        except Exception as e:
+            return item, None, e
+
+    items = list(items)
+
+    # Nothing to parallelize
+    if len(items) <= 1 or workers <= 1:
+        for item in items:
+            yield apply(item)
+        return
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        for result in pool.imap_unordered(apply, items):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fan_out_streams(f, items, workers, pending=1000):
+    """
+    Iterate the streams of many items concurrently (e.g. the pages of the listing of each region), merging their
+    values into one stream as they arrive
+
+    At most pending values are buffered, so the memory does not depend on the length of the streams; an error in
+    one stream does not stop the rest
+
+    :param f: Function receiving an item and returning an iterable of values
+    :param items: Items
+    :param workers: Maximum number of concurrent threads
+    :param pending: Maximum number of values produced and not consumed yet
+    :return: Generator of (item, value, error) tuples, in arrival order: each value of the stream of an item, or the
+             error which stopped it (with a None value)
+    """
+    items = list(items)
+
+    # Nothing to parallelize
+    if len(items) <= 1 or workers <= 1:
+        for item in items:
+            # noinspection PyBroadException
+            try:
+                for value in f(item):
+                    yield item, value, None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    results = Queue.Queue(pending)
+    stopped = threading.Event()
+    finished = object()
+
+    def put(result):
+        # Give up if the consumer stopped iterating (so the threads do not block forever)
+        while not stopped.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce(item):
+        # noinspection PyBroadException
+        try:
+            for value in f(item):
+                if not put((item, value, None)):
+                    return
+        except Exception as e:
+            put((item, None, e))
+        put(finished)
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        for item in items:
+            pool.apply_async(produce, (item,))
+        remaining = len(items)
+        while remaining:
+            result = results.get()
+            if result is finished:
+                remaining -= 1
+                continue
+            yield result
+    finally:
+        stopped.set()
+        pool.close()
+        pool.join()
+
+
+def stream_map(f, items, workers, pending=2):
+    """
+    Apply a function to items concurrently while they are still being produced (e.g. read from a paginated listing)
+
+    The items are read in the calling thread, so an error producing them is raised to the caller; at most
+    pending * workers items are read ahead of the ones being processed, so the memory does not depend on the number
+    of items. The function should handle its own errors, as in parallel_map
+
+    :param f: Function to apply
+    :param items: Iterable of items (consumed lazily)
+    :param workers: Maximum number of concurrent threads
+    :param pending: Items read ahead per worker
+    :return: Generator of results, in completion order
+    """
+    slots = threading.BoundedSemaphore(max(1, workers) * pending)
+    results = Queue.Queue()
+
+    def apply(item):
+        # noinspection PyBroadException
+        try:
+            results.put((f(item), None))
+        except Exception as e:
+            results.put((None, e))
+        finally:
+            slots.release()
+
+    def collect(block):
+        result, error = results.get(block)
+        if error is not None:
+            raise error
+        return result
+
+    pool = ThreadPool(max(1, workers))
+    submitted = 0
+    received = 0
+    try:
+        for item in items:
+            slots.acquire()
+            pool.apply_async(apply, (item,))
+            submitted += 1
+
+            # Yield the results which are already available
+            while True:
+                try:
+                    result = collect(False)
+                except Queue.Empty:
+                    break
+                received += 1
+                yield result
+
+        # Wait for the rest
+        while received < submitted:
+            result = collect(True)
+            received += 1
+            yield result
+    finally:
+        pool.close()
+        pool.join()
@@ -17,14 +17,15 @@ class Sns:
         Init the (boto) SNS connection and prepare the cloudwatch topic
         """
 
-        self.conn = Connection().sns_connection()
+        connection = Connection()
+        self.conn = connection.sns_connection()
 
         # Create the cloudwatch topic if not exists, and store its ARN
         self.cloudwatch_arn = self._create_topic_if_not_exists(self.CLOUDWATCH_TOPIC)
 
         # If there are no subscriptions, subscribe the default email
         if not len(self.get_cloudwatch_email_subscriptions()):
-            self.subscribe_email_to_cloudwatch(Connection().DEFAULT_ALERT_EMAIL)
+            self.subscribe_email_to_cloudwatch(connection.DEFAULT_ALERT_EMAIL)
 
     def _create_topic_if_not_exists(self, topic_name):
         """
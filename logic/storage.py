@@ -1,19 +1,75 @@
+import hashlib
 import os
+import re
+import urllib
+
+from logic.checkpoints import TransferCheckpoint
+from logic.connections import Connection
+from logic.imports import lazy_import
+from logic.parallel import parallel_map, stream_map
 
 
 # noinspection PyBroadException
 class Storage:
     """
     This class abstracts Storage operation, common for any provider
+
+    The files bigger than the multipart threshold are uploaded in parts, which are read from the file by the workers
+    themselves (so at most one part per worker is in memory) and uploaded concurrently; the providers supporting it
+    implement the _initiate_upload, _upload_part, _complete_upload and _abort_upload operations
+
+    Likewise, the big objects are downloaded by byte ranges, concurrently; each worker streams its range into its
+    offset of a preallocated file, through its own file handle
+
+    The objects of a container (or prefix) are deleted by batches, sent concurrently while the listing is still
+    streaming; the providers with a bulk deletion API implement _delete_batch, and the rest delete the objects of each
+    batch one by one
+
+    Both transfers record their progress in checkpoints (the upload ID and the ETags of the uploaded parts in the
+    state folder, the downloaded ranges next to the downloaded file), so a failed transfer is resumed by the next
+    attempt instead of starting again
     """
 
+    # Minimum size of the parts (except the last one) accepted by the providers
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    # Maximum number of parts of an upload (the part size grows for bigger files)
+    MAX_PARTS = 10000
+
+    # Attempts to transfer each part
+    PART_ATTEMPTS = 3
+
+    # Maximum number of objects of each deletion batch
+    DELETE_BATCH_SIZE = 1000
+
+    # Size of the chunks read from the ranged downloads
+    CHUNK_SIZE = 1024 * 1024
+
+    # Function getting the path of an object in the API of the provider, given the container object and the object
+    # name (for the raw requests); None if the provider does not implement it
+    _object_path = None
+
     def __init__(self, conn):
         """
-        Store the connection that will be used
+        Store the connection that will be used, and the transfer configuration
 
         :param conn: Storage (libcloud) connection
         """
         self.conn = conn
+        connection = Connection()
+        self.multipart_threshold = connection.MULTIPART_THRESHOLD
+        self.part_size = max(connection.PART_SIZE, self.MIN_PART_SIZE)
+        self.transfer_workers = connection.TRANSFER_WORKERS
+
+    @staticmethod
+    def _quote(name):
+        """
+        Quote a container or object name for a request path
+
+        :param name: Name
+        :return: Quoted name (UTF-8)
+        """
+        return urllib.quote(name.encode('utf-8') if isinstance(name, unicode) else name)
 
     def _find_container(self, container_name):
         """
@@ -76,8 +132,9 @@ class Storage:
         try:
 
             # First, delete all the objects within the container
-            for o in container.list_objects():
-                o.delete()
+            deleted, errors = self._delete_objects(container)
+            if errors:
+                return False
 
             # Finally delete the container
             container.delete()
@@ -86,12 +143,113 @@ class Storage:
         except Exception:
             return False
 
-    def get_objects_names(self, container_name):
+    def delete_prefix(self, container_name, prefix):
+        """
+        Delete the objects whose name starts by a prefix
+
+        :param container_name: Name of the container
+        :param prefix: Prefix of the names of the objects
+        :return: Number of deleted objects, and dictionary with the error of each object which could not be deleted
+                 (None if the container does not exist)
+        """
+        container = self._find_container(container_name)
+        if not container:
+            return None
+        return self._delete_objects(container, prefix)
+
+    def _iterate_objects(self, container, prefix=None):
+        """
+        Iterate the objects of a container, as the pages of the listing arrive
+
+        :param container: Container object
+        :param prefix: Prefix of the names of the objects (None for all of them)
+        :return: Generator of objects
+        """
+        if prefix:
+            return self.conn.iterate_container_objects(container, ex_prefix=prefix)
+        return self.conn.iterate_container_objects(container)
+
+    def _delete_objects(self, container, prefix=None):
+        """
+        Delete the objects of a container (or a prefix) by batches, sent concurrently while they are listed
+
+        :param container: Container object
+        :param prefix: Prefix of the names of the objects (None for all of them)
+        :return: Number of deleted objects, and dictionary with the error of each object which could not be deleted
+        """
+        def batches():
+            batch = []
+            for obj in self._iterate_objects(container, prefix):
+                batch.append(obj)
+                if len(batch) == self.DELETE_BATCH_SIZE:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        def delete(batch):
+            try:
+                return len(batch), self._delete_batch(container, batch)
+            except Exception as e:
+                return len(batch), dict((obj.name, str(e)) for obj in batch)
+
+        deleted = 0
+        errors = {}
+        for count, batch_errors in stream_map(delete, batches(), self.transfer_workers):
+            deleted += count - len(batch_errors)
+            errors.update(batch_errors)
+        return deleted, errors
+
+    def _delete_batch(self, container, objects):
+        """
+        Delete a batch of objects (one by one; the providers with a bulk deletion API override it)
+
+        :param container: Container object
+        :param objects: Objects
+        :return: Dictionary with the error of each object which could not be deleted
+        """
+        errors = {}
+        for obj in objects:
+            try:
+                if not obj.delete():
+                    errors[obj.name] = 'not deleted'
+            except Exception as e:
+                errors[obj.name] = str(e)
+        return errors
+
+    def _iterate_entries(self, container, prefix=None, delimiter=None):
+        """
+        Iterate the objects of a container as the pages of the listing arrive, grouping by pseudo-directories the
+        objects whose name (after the prefix) contains the delimiter
+
+        The listing is sorted by name, so the objects of each pseudo-directory are consecutive and only the last
+        pseudo-directory has to be remembered
+
+        :param container: Container object
+        :param prefix: Prefix of the names of the objects (None for all of them)
+        :param delimiter: Delimiter of the pseudo-directories (e.g. '/'; None to list every object)
+        :return: Generator of (name, object) tuples; the object is None for the pseudo-directories
+        """
+        last = None
+        for obj in self._iterate_objects(container, prefix):
+            if delimiter:
+                position = obj.name.find(delimiter, len(prefix or ''))
+                if position >= 0:
+                    directory = obj.name[:position + len(delimiter)]
+                    if directory != last:
+                        last = directory
+                        yield directory, None
+                    continue
+            yield obj.name, obj
+
+    def get_objects_names(self, container_name, prefix=None, delimiter=None):
         """
         Get the names of the objects within a container
 
         :param container_name: Container name
-        :return: Name of the objects
+        :param prefix: Prefix of the names of the objects (None for all of them)
+        :param delimiter: Delimiter of the pseudo-directories, whose names are returned instead of their objects
+        :return: Generator of names of the objects (None if the container does not exist)
         """
 
         # First, find the container and return if it does not exist
@@ -100,13 +258,15 @@ class Storage:
             return None
 
         # Map each object to its name
-        return map(lambda o: o.name, container.list_objects())
+        return (name for name, obj in self._iterate_entries(container, prefix, delimiter))
 
-    def list_objects(self, container_name):
+    def list_objects(self, container_name, prefix=None, delimiter=None):
         """
-        List the objects within a container
+        List the objects within a container, printing them as the pages of the listing arrive
 
         :param container_name: Name of the container
+        :param prefix: Prefix of the names of the objects (None for all of them)
+        :param delimiter: Delimiter of the pseudo-directories, which are listed instead of their objects
         """
 
         # First, find the container and return if it does not exist
@@ -115,12 +275,15 @@ class Storage:
             return
 
         # Print each object information
-        objects = container.list_objects()
-        if not len(objects):
+        count = 0
+        for name, obj in self._iterate_entries(container, prefix, delimiter):
+            if obj is None:
+                print '- %s (directory)' % name
+            else:
+                print '- %s (%d bytes)' % (name, obj.size)
+            count += 1
+        if not count:
             print 'The container does not have any object!'
-            return
-        for o in objects:
-            print '- %s (%d bytes)' % (o.name, o.size)
 
     def delete_object(self, container_name, object_name):
         """
@@ -168,14 +331,129 @@ class Storage:
         if not obj:
             return False
 
-        # Try to download the file
+        # Try to download the file (by ranges if it is big)
         try:
             download_path = os.path.join(download_path, object_name)
-            obj.download(download_path, True)
+            if self._supports_ranges(obj) and obj.size >= self.multipart_threshold:
+                self._download_ranges(obj, download_path)
+            else:
+                obj.download(download_path, True)
             return True
         except Exception:
             return False
 
+    def _download_ranges(self, obj, path):
+        """
+        Download an object by byte ranges, concurrently
+        The ranges are written into a preallocated temporary file (<path>.part), which replaces the file when all of
+        them have been downloaded
+
+        :param obj: Object
+        :param path: Path of the file
+        """
+        ranges = [(start, min(start + self.part_size, obj.size)) for start in range(0, obj.size, self.part_size)]
+        temporary = path + '.part'
+
+        # Resume the previous attempt if its checkpoint and its file remain; otherwise, preallocate the file
+        checkpoint = TransferCheckpoint(temporary + '.json', {
+            'container': obj.container.name, 'object': obj.name, 'size': obj.size, 'hash': obj.hash,
+            'part_size': self.part_size})
+        done = checkpoint.state.get('ranges', {})
+        if not done or not os.path.isfile(temporary) or os.path.getsize(temporary) != obj.size:
+            with open(temporary, 'wb') as f:
+                f.truncate(obj.size)
+            checkpoint.update(ranges={})
+            done = {}
+        ranges = [byte_range for byte_range in ranges if str(byte_range[0]) not in done]
+
+        def download(byte_range):
+            start, end = byte_range
+            for attempt in range(self.PART_ATTEMPTS):
+                try:
+                    # Each worker writes through its own handle, at the offset of its range (and never beyond it,
+                    # so a response longer than the range cannot overwrite the neighbouring ones)
+                    with open(temporary, 'r+b') as f:
+                        f.seek(start)
+                        written = 0
+                        for chunk in self._download_range(obj, start, end):
+                            if written + len(chunk) > end - start:
+                                raise IOError('Too long range %d-%d' % (start, end))
+                            f.write(chunk)
+                            written += len(chunk)
+                    if written != end - start:
+                        raise IOError('Incomplete range %d-%d' % (start, end))
+                    checkpoint.record('ranges', start)
+                    return
+                except Exception:
+                    if attempt == self.PART_ATTEMPTS - 1:
+                        raise
+
+        parallel_map(download, ranges, self.transfer_workers)
+        os.rename(temporary, path)
+        checkpoint.delete()
+
+        # Check the whole file against the object
+        if not self._verify_download(obj, path):
+            os.remove(path)
+            raise IOError('The downloaded file does not match the object %s' % obj.name)
+
+    def _verify_download(self, obj, path):
+        """
+        Check a downloaded file against its object: its size, and its MD5 if the hash of the object is one (the ETags
+        of multipart uploads and large objects are not)
+
+        :param obj: Object
+        :param path: Path of the file
+        :return: True if the file matches the object
+        """
+        if os.path.getsize(path) != obj.size:
+            return False
+        if not re.match(r'^[0-9a-f]{32}$', obj.hash or ''):
+            return True
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), ''):
+                md5.update(chunk)
+        return md5.hexdigest() == obj.hash
+
+    def _supports_ranges(self, obj):
+        """
+        Check whether an object can be downloaded by ranges
+
+        :param obj: Object
+        :return: True if the driver supports ranged downloads, or the provider implements _object_path
+        """
+        return hasattr(self.conn, 'download_object_range_as_stream') or self._object_path is not None
+
+    def _download_range(self, obj, start, end):
+        """
+        Download a byte range of an object
+        The libcloud versions without ranged downloads are sent a raw request with the Range header, whose response
+        must be a partial content (206) one with that range
+
+        The request is sent through the driver of the calling thread (the response is read lazily from the connection
+        of the driver, so it cannot be shared with the other workers), and retried if the token is rejected
+
+        :param obj: Object
+        :param start: First byte
+        :param end: Byte after the last one
+        :return: Iterator of chunks of data
+        """
+        def request(driver):
+            if hasattr(driver, 'download_object_range_as_stream'):
+                return driver.download_object_range_as_stream(obj, start, end)
+            response = driver.connection.request(self._object_path(obj.container, obj.name), method='GET',
+                                                 headers={'Range': 'bytes=%d-%d' % (start, end - 1)}, raw=True)
+
+            # A server (or proxy) ignoring the range answers the whole object instead
+            content_range = (response.headers or {}).get('content-range')
+            if response.status != 206 or \
+                    (content_range and not content_range.startswith('bytes %d-%d/' % (start, end - 1))):
+                raise IOError('The range %d-%d was not returned (status %s, range %s)' % (
+                    start, end, response.status, content_range))
+            return lazy_import('libcloud.utils.files').read_in_chunks(response.response, self.CHUNK_SIZE)
+        return self.conn.with_driver(request)
+
     def upload_object(self, container_name, file_path):
         """
         Upload a file to a container
@@ -190,10 +468,105 @@ class Storage:
         if not container:
             return False
 
-        # Try to upload the file
+        # Try to upload the file (in parts if it is big)
         try:
             filename = os.path.basename(file_path)
-            container.upload_object(file_path=file_path, object_name=filename)
+            if self._supports_multipart() and os.path.getsize(file_path) >= self.multipart_threshold:
+                self._upload_multipart(container, file_path, filename)
+            else:
+                container.upload_object(file_path=file_path, object_name=filename)
             return True
         except Exception:
             return False
+
+    def _upload_multipart(self, container, file_path, object_name):
+        """
+        Upload a file in parts, concurrently
+        If it fails, the upload is kept along with its checkpoint, so the next attempt only uploads the missing parts
+
+        :param container: Container object
+        :param file_path: Path of the file
+        :param object_name: Name of the object
+        """
+        size = os.path.getsize(file_path)
+        part_size = max(self.part_size, -(-size // self.MAX_PARTS))
+        count = max(1, -(-size // part_size))
+
+        # Resume the previous attempt, or start a new upload
+        checkpoint = self._upload_checkpoint(container, file_path, object_name, part_size)
+        upload_id = checkpoint.state.get('upload_id')
+        resumed = upload_id is not None
+        if not resumed:
+            # The upload of a previous version of the file cannot be resumed: abort it, so its parts are not kept
+            if checkpoint.stale.get('upload_id'):
+                try:
+                    self._abort_upload(container, object_name, checkpoint.stale['upload_id'])
+                except Exception:
+                    pass
+            upload_id = self._initiate_upload(container, object_name)
+            checkpoint.update(upload_id=upload_id, parts={})
+        parts = [(int(number), etag, part) for number, (etag, part) in checkpoint.state.get('parts', {}).items()]
+        uploaded = [number for number, etag, part in parts]
+        resumed_count = len(uploaded)
+
+        def upload(number):
+            # Each worker reads its own part, so only one part per worker is in memory
+            with open(file_path, 'rb') as f:
+                f.seek((number - 1) * part_size)
+                data = f.read(part_size)
+            for attempt in range(self.PART_ATTEMPTS):
+                try:
+                    etag = self._upload_part(container, object_name, upload_id, number, data)
+                    checkpoint.record('parts', number, [etag, len(data)])
+                    uploaded.append(number)
+                    return number, etag, len(data)
+                except Exception:
+                    if attempt == self.PART_ATTEMPTS - 1:
+                        raise
+
+        done = set(uploaded)
+        pending = [number for number in range(1, count + 1) if number not in done]
+        try:
+            parts.extend(parallel_map(upload, pending, self.transfer_workers))
+            self._complete_upload(container, object_name, upload_id, sorted(parts))
+        except Exception:
+            # If a resumed upload does not progress at all, it is probably no longer valid: start again next time
+            if resumed and len(uploaded) == resumed_count:
+                checkpoint.delete()
+                try:
+                    self._abort_upload(container, object_name, upload_id)
+                except Exception:
+                    pass
+            raise
+        checkpoint.delete()
+
+    def _upload_checkpoint(self, container, file_path, object_name, part_size):
+        """
+        Get the checkpoint of an upload, stored in the state folder
+
+        :param container: Container object
+        :param file_path: Path of the file
+        :param object_name: Name of the object
+        :param part_size: Size of the parts
+        :return: Transfer checkpoint
+        """
+        stat = os.stat(file_path)
+        identity = {
+            'provider': self.__class__.__name__, 'container': container.name, 'object': object_name,
+            'file': os.path.abspath(file_path), 'size': stat.st_size, 'modified': stat.st_mtime,
+            'part_size': part_size,
+        }
+        key = hashlib.sha1('%s/%s/%s' % (identity['provider'], container.name, object_name)).hexdigest()
+        return TransferCheckpoint(Connection().state_path('transfers', key + '.json'), identity)
+
+    def _supports_multipart(self):
+        """
+        Check whether the provider supports uploads in parts
+        The providers which do implement the multipart operations: _initiate_upload(container, object_name), returning
+        the upload ID; _upload_part(container, object_name, upload_id, number, data), returning the ETag of the part;
+        _complete_upload(container, object_name, upload_id, parts), given the (number, ETag, size) tuples of the parts
+        sorted by number; and _abort_upload(container, object_name, upload_id)
+
+        :return: True if the multipart operations are implemented
+        """
+        return False
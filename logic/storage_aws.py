@@ -1,3 +1,7 @@
+import base64
+import hashlib
+from xml.sax.saxutils import escape
+
 from connections import Connection
 from storage import Storage
 
@@ -5,6 +9,9 @@ from storage import Storage
 class AwsStorage(Storage):
     """
     AWS (S3) Storage
+
+    The big files are uploaded with the S3 multipart upload API, and the objects are deleted by batches with the
+    multi-object delete API (requests sent through the libcloud connection)
     """
 
     def __init__(self):
@@ -12,3 +19,117 @@ class AwsStorage(Storage):
         Create an storage instance passing an Amazon S3 connection
         """
         Storage.__init__(self, Connection().s3_connection())
+
+    @staticmethod
+    def _object_path(container, object_name):
+        """
+        Get the path of an object in the S3 API
+
+        :param container: Container object
+        :param object_name: Name of the object
+        :return: Path
+        """
+        return '/%s/%s' % (Storage._quote(container.name), Storage._quote(object_name))
+
+    @staticmethod
+    def _find_text(element, tag):
+        """
+        Get the text of the first descendant of an XML element with a given tag (ignoring the namespace)
+
+        :param element: XML element
+        :param tag: Tag name
+        :return: Text, None if there is not such element
+        """
+        for child in element.iter():
+            if child.tag.split('}')[-1] == tag:
+                return child.text
+        return None
+
+    def _delete_batch(self, container, objects):
+        """
+        Delete a batch of objects (up to 1,000) with a single multi-object delete request
+
+        :param container: Container object
+        :param objects: Objects
+        :return: Dictionary with the error of each object which could not be deleted
+        """
+        body = '<Delete><Quiet>true</Quiet>%s</Delete>' % ''.join(
+            '<Object><Key>%s</Key></Object>' % escape(obj.name) for obj in objects)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        response = self.conn.connection.request('/%s' % self._quote(container.name), method='POST',
+                                                params={'delete': ''}, data=body, headers={
+                                                    'Content-MD5': base64.b64encode(hashlib.md5(body).digest()),
+                                                    'Content-Length': str(len(body))})
+
+        # In quiet mode, only the objects which could not be deleted are reported
+        errors = {}
+        for element in response.object.iter():
+            if element.tag.split('}')[-1] == 'Error':
+                errors[self._find_text(element, 'Key')] = self._find_text(element, 'Message')
+        return errors
+
+    def _supports_multipart(self):
+        """
+        S3 supports uploads in parts
+
+        :return: True
+        """
+        return True
+
+    def _initiate_upload(self, container, object_name):
+        """
+        Start a multipart upload
+
+        :param container: Container object
+        :param object_name: Name of the object
+        :return: ID of the upload
+        """
+        response = self.conn.connection.request(self._object_path(container, object_name), method='POST',
+                                                params={'uploads': ''})
+        return self._find_text(response.object, 'UploadId')
+
+    def _upload_part(self, container, object_name, upload_id, number, data):
+        """
+        Upload a part of a multipart upload
+
+        :param container: Container object
+        :param object_name: Name of the object
+        :param upload_id: ID of the upload
+        :param number: Number of the part (starting by 1)
+        :param data: Content of the part
+        :return: ETag of the part
+        """
+        response = self.conn.connection.request(self._object_path(container, object_name), method='PUT',
+                                                params={'partNumber': number, 'uploadId': upload_id}, data=data,
+                                                headers={'Content-Length': str(len(data))})
+        return response.headers['etag']
+
+    def _complete_upload(self, container, object_name, upload_id, parts):
+        """
+        Complete a multipart upload
+
+        :param container: Container object
+        :param object_name: Name of the object
+        :param upload_id: ID of the upload
+        :param parts: List of (number, ETag, size) tuples, sorted by number
+        """
+        body = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % ''.join(
+            '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (number, etag) for number, etag, size in parts)
+        response = self.conn.connection.request(self._object_path(container, object_name), method='POST',
+                                                params={'uploadId': upload_id}, data=body)
+
+        # S3 may report errors of the completion with a 200 status
+        if self._find_text(response.object, 'Code') is not None:
+            raise Exception(self._find_text(response.object, 'Message'))
+
+    def _abort_upload(self, container, object_name, upload_id):
+        """
+        Abort a multipart upload
+
+        :param container: Container object
+        :param object_name: Name of the object
+        :param upload_id: ID of the upload
+        """
+        self.conn.connection.request(self._object_path(container, object_name), method='DELETE',
+                                     params={'uploadId': upload_id})
@@ -1,3 +1,8 @@
+import json
+import threading
+import time
+import urllib
+
 from connections import Connection
 from storage import Storage
 
@@ -5,10 +10,182 @@ from storage import Storage
 class OpenStackStorage(Storage):
     """
     OpenStack storage
+
+    The big files are uploaded as static large objects: the parts are uploaded as segments to the <container>_segments
+    container, and then joined by a manifest; the objects are deleted by batches with the bulk delete middleware, if
+    the cluster has it (requests sent through the libcloud connection)
     """
 
+    # Statuses answered to a bulk delete request when the cluster does not have the middleware
+    BULK_DELETE_MISSING_STATUSES = (404, 405, 501)
+
     def __init__(self):
         """
         Create an storage instance with an OpenStack (Swift) storage connection
         """
         Storage.__init__(self, Connection().openstack_swift_connection())
+        self.bulk_delete = True
+        self._segments = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _object_path(container, object_name):
+        """
+        Get the path of an object in the Swift API
+
+        :param container: Container object
+        :param object_name: Name of the object
+        :return: Path
+        """
+        return '/%s/%s' % (Storage._quote(container.name), Storage._quote(object_name))
+
+    @staticmethod
+    def _segment_name(object_name, upload_id, number):
+        """
+        Get the name of a segment of a static large object
+
+        :param object_name: Name of the object
+        :param upload_id: ID of the upload
+        :param number: Number of the part (starting by 1)
+        :return: Name of the segment
+        """
+        return '%s/%s/%08d' % (object_name, upload_id, number)
+
+    def _get_segments_container(self, container):
+        """
+        Get the container of the segments, creating it if it does not exist (it is only looked up once, even by
+        concurrent workers)
+
+        :param container: Container object
+        :return: Container object of the segments
+        """
+        name = '%s_segments' % container.name
+        with self._lock:
+            segments = self._segments.get(name)
+            if segments is None:
+                try:
+                    segments = self.conn.get_container(name)
+                except Exception:
+                    segments = self.conn.create_container(name)
+                self._segments[name] = segments
+        return segments
+
+    def _delete_batch(self, container, objects):
+        """
+        Delete a batch of objects with a single bulk delete request
+        If the cluster does not have the bulk delete middleware, the objects are deleted one by one (and so the next
+        batches)
+
+        :param container: Container object
+        :param objects: Objects
+        :return: Dictionary with the error of each object which could not be deleted
+        """
+        if not self.bulk_delete:
+            return Storage._delete_batch(self, container, objects)
+
+        body = '\n'.join(self._object_path(container, obj.name) for obj in objects)
+        try:
+            response = self.conn.with_driver(lambda driver: driver.connection.request(
+                '/', method='POST', params={'bulk-delete': ''}, data=body, headers={
+                    'Content-Type': 'text/plain', 'Accept': 'application/json', 'Content-Length': str(len(body))}))
+        except Exception as e:
+            # Transient errors (e.g. 5xx or timeouts) fail the batch, but do not disable the bulk deletion
+            if (getattr(e, 'code', None) or getattr(e, 'status', None)) not in self.BULK_DELETE_MISSING_STATUSES:
+                raise
+            return self._delete_batch_without_bulk_delete(container, objects)
+
+        # Without the middleware, the request is answered by the account itself (with an error, or without the
+        # JSON report)
+        if getattr(response, 'status', None) in self.BULK_DELETE_MISSING_STATUSES:
+            return self._delete_batch_without_bulk_delete(container, objects)
+        try:
+            result = json.loads(response.body)
+        except ValueError:
+            return self._delete_batch_without_bulk_delete(container, objects)
+
+        # Errors of the objects, reported as [path, status] pairs
+        errors = {}
+        prefix = '/%s/' % container.name
+        for path, status in result.get('Errors', []):
+            path = urllib.unquote(path)
+            errors[path[len(prefix):] if path.startswith(prefix) else path] = status
+        if not errors and result.get('Response Status', '200').split()[0] not in ('200', '201'):
+            raise Exception(result.get('Response Body') or result.get('Response Status'))
+        return errors
+
+    def _delete_batch_without_bulk_delete(self, container, objects):
+        """
+        Disable the bulk deletion, since the cluster does not have the middleware, and delete a batch one by one
+
+        :param container: Container object
+        :param objects: Objects
+        :return: Dictionary with the error of each object which could not be deleted
+        """
+        with self._lock:
+            self.bulk_delete = False
+        return Storage._delete_batch(self, container, objects)
+
+    def _supports_multipart(self):
+        """
+        Swift supports static large objects
+
+        :return: True
+        """
+        return True
+
+    def _initiate_upload(self, container, object_name):
+        """
+        Start an upload of a static large object (which only requires the segments container)
+
+        :param container: Container object
+        :param object_name: Name of the object
+        :return: ID of the upload
+        """
+        self._get_segments_container(container)
+        return '%.6f' % time.time()
+
+    def _upload_part(self, container, object_name, upload_id, number, data):
+        """
+        Upload a segment
+
+        :param container: Container object
+        :param object_name: Name of the object
+        :param upload_id: ID of the upload
+        :param number: Number of the part (starting by 1)
+        :param data: Content of the part
+        :return: ETag of the segment
+        """
+        segments = self._get_segments_container(container)
+        return self.conn.upload_object_via_stream(iter([data]), segments,
+                                                  self._segment_name(object_name, upload_id, number)).hash
+
+    def _complete_upload(self, container, object_name, upload_id, parts):
+        """
+        Create the manifest of the static large object
+
+        :param container: Container object
+        :param object_name: Name of the object
+        :param upload_id: ID of the upload
+        :param parts: List of (number, ETag, size) tuples, sorted by number
+        """
+        manifest = json.dumps([{
+            'path': '/%s_segments/%s' % (container.name, self._segment_name(object_name, upload_id, number)),
+            'etag': etag,
+            'size_bytes': size,
+        } for number, etag, size in parts])
+        self.conn.with_driver(lambda driver: driver.connection.request(
+            self._object_path(container, object_name), method='PUT', params={'multipart-manifest': 'put'},
+            data=manifest, headers={'Content-Type': 'application/json', 'Content-Length': str(len(manifest))}))
+
+    def _abort_upload(self, container, object_name, upload_id):
+        """
+        Delete the uploaded segments
+
+        :param container: Container object
+        :param object_name: Name of the object
+        :param upload_id: ID of the upload
+        """
+        segments = self._get_segments_container(container)
+        prefix = '%s/%s/' % (object_name, upload_id)
+        for segment in self.conn.iterate_container_objects(segments, ex_prefix=prefix):
+            segment.delete()
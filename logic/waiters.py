@@ -0,0 +1,99 @@
+import random
+import time
+
+
+class Waiter:
+    """
+    Wait until many resources (e.g. instances or volumes) reach a state
+
+    Every check asks for all the pending resources at once (through the describe function), and the time between
+    checks grows exponentially (with random jitter, so many waiters do not poll in lockstep) up to a maximum;
+    the wait finishes as soon as every resource has reached the state, or failed, or the deadline is over
+    """
+
+    # Seconds before the first check
+    INITIAL_DELAY = 1.0
+
+    # Maximum seconds between checks
+    MAX_DELAY = 30.0
+
+    # Maximum seconds to wait if it is not provided
+    DEFAULT_TIMEOUT = 600
+
+    def __init__(self, describe=None, initial_delay=INITIAL_DELAY, max_delay=MAX_DELAY):
+        """
+        Init the waiter
+
+        :param describe: Function receiving a list of IDs and returning a dictionary with the state of each of them
+                         (the resources which are not visible yet can be missing; only needed to wait)
+        :param initial_delay: Seconds before the first check
+        :param max_delay: Maximum seconds between checks
+        """
+        self.describe = describe
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+    def wait(self, ids, states, failure_states=(), timeout=DEFAULT_TIMEOUT):
+        """
+        Wait until the resources reach one of the desired states
+
+        :param ids: IDs of the resources
+        :param states: Desired state, or list of them
+        :param failure_states: States which will never lead to the desired ones (e.g. 'terminated' when waiting for
+                               'running'), so the resources in them are not waited for anymore
+        :param timeout: Maximum number of seconds to wait
+        :return: True if all the resources reached the desired states, and dictionary with the last known state
+                 of each resource (None if it was never seen)
+        """
+        if isinstance(states, basestring):
+            states = [states]
+        last_states = dict((resource_id, None) for resource_id in ids)
+        pending = set(last_states)
+        deadline = time.time() + timeout
+        delay = self.initial_delay
+
+        while pending:
+
+            # Wait (without going over the deadline)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+            delay = min(delay * 2, self.max_delay)
+
+            # Check all the pending resources at once
+            try:
+                current = self.describe(list(pending))
+            except Exception:
+                # Transient errors are retried in the next check
+                continue
+            for resource_id, state in current.items():
+                if resource_id in pending:
+                    last_states[resource_id] = state
+                    if state in states or state in failure_states:
+                        pending.discard(resource_id)
+
+        done = all(state in states for state in last_states.values())
+        return done, last_states
+
+    def retry(self, f, retryable, timeout=DEFAULT_TIMEOUT):
+        """
+        Call a function until it does not fail with a retryable error (e.g. throttling), with the same backoff
+        as between checks
+
+        :param f: Function without arguments
+        :param retryable: Function receiving an error and returning True if the call can be retried
+        :param timeout: Maximum number of seconds to retry
+        :return: Result of the function (the last error is raised if it cannot be retried anymore)
+        """
+        deadline = time.time() + timeout
+        delay = self.initial_delay
+        while True:
+            try:
+                return f()
+            except Exception as e:
+                remaining = deadline - time.time()
+                if not retryable(e) or remaining <= 0:
+                    raise
+            time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+            delay = min(delay * 2, self.max_delay)
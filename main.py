@@ -1,5 +1,42 @@
-from cli.cli import Cli
+import argparse
+import atexit
+import sys
+
+from logic.imports import lazy_import, print_import_report
+
+
+def main():
+    """
+    Parse the program flags and run the interactive CLI, or the given command if there is one
+    """
+    parser = argparse.ArgumentParser(description='Cloud CLI for Amazon Web Services and OpenStack',
+                                     epilog='Run "main.py <service> -h" to list the commands of a service, '
+                                            'or "main.py batch -h" to run many commands at once')
+    parser.add_argument('--import-times', action='store_true',
+                        help='print the time (in milliseconds) spent importing each module when exiting')
+    parser.add_argument('--daemon', action='store_true',
+                        help='send the command to the background daemon (see "main.py daemon -h")')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='non-interactive command (the interactive menu is run if there is none)')
+    args = parser.parse_args()
+
+    # Report the import times when the program finishes
+    if args.import_times:
+        atexit.register(print_import_report)
+
+    # The daemon only runs non-interactive commands
+    if args.daemon and not args.command:
+        parser.error('a command is required to use the daemon')
+
+    # Non-interactive command, executed by the daemon or by this process
+    if args.daemon:
+        sys.exit(lazy_import('cli.daemon').DaemonClient().execute(args.command))
+    if args.command:
+        sys.exit(lazy_import('cli.commands').CommandLine().execute(args.command))
+
+    lazy_import('cli.cli').Cli()
+
 
 # Main method which executes the CLI
 if __name__ == "__main__":
-    Cli()
+    main()
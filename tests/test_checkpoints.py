@@ -0,0 +1,72 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from logic.checkpoints import TransferCheckpoint
+
+
+class TransferCheckpointTest(unittest.TestCase):
+    """
+    Storage and identity of the transfer checkpoints
+    """
+
+    IDENTITY = {'file': '/tmp/backup.tar', 'size': 1000, 'part_size': 100}
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'checkpoint.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_new_checkpoint(self):
+        checkpoint = TransferCheckpoint(self.path, self.IDENTITY)
+        self.assertEqual(checkpoint.state, {})
+        self.assertEqual(checkpoint.stale, {})
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_resume(self):
+        checkpoint = TransferCheckpoint(self.path, self.IDENTITY)
+        checkpoint.update(upload_id='abc', parts={})
+        checkpoint.record('parts', 1, ['etag-1', 100])
+        checkpoint.record('parts', 2, ['etag-2', 100])
+
+        resumed = TransferCheckpoint(self.path, dict(self.IDENTITY))
+        self.assertEqual(resumed.state, {'upload_id': 'abc', 'parts': {'1': ['etag-1', 100], '2': ['etag-2', 100]}})
+        self.assertEqual(resumed.stale, {})
+
+    def test_only_readable_by_the_user(self):
+        TransferCheckpoint(self.path, self.IDENTITY).update(upload_id='abc')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+
+    def test_other_transfer_is_stale(self):
+        TransferCheckpoint(self.path, self.IDENTITY).update(upload_id='abc')
+
+        changed = TransferCheckpoint(self.path, dict(self.IDENTITY, size=2000))
+        self.assertEqual(changed.state, {})
+        self.assertEqual(changed.stale, {'upload_id': 'abc'})
+
+        # The new transfer replaces the stale one
+        changed.update(upload_id='def')
+        self.assertEqual(TransferCheckpoint(self.path, dict(self.IDENTITY, size=2000)).state, {'upload_id': 'def'})
+
+    def test_corrupt_checkpoint_is_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('{"identity": ')
+        checkpoint = TransferCheckpoint(self.path, self.IDENTITY)
+        self.assertEqual(checkpoint.state, {})
+        self.assertEqual(checkpoint.stale, {})
+
+    def test_delete(self):
+        checkpoint = TransferCheckpoint(self.path, self.IDENTITY)
+        checkpoint.record('ranges', 0)
+        checkpoint.delete()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(checkpoint.state, {})
+        checkpoint.delete()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import unittest
+
+from logic.compute_aws import AwsCompute, InstanceIndex, InstanceRecord
+
+
+def record(instance_id, state='running', instance_type='m5.large', zone='eu-west-1a', launch_time='2016-01-01T10:00',
+           tags=None, account=None):
+    """
+    Create an instance record
+
+    :return: Instance record of eu-west-1
+    """
+    return InstanceRecord(instance_id, instance_type, 'ami-1', 'eu-west-1', zone, launch_time, state, tags, account)
+
+
+class InstanceIndexTest(unittest.TestCase):
+    """
+    Queries over the instance index
+    """
+
+    def setUp(self):
+        self.index = InstanceIndex([
+            record('i-1', tags={'team': 'search', 'env': 'prod'}, launch_time='2016-01-01T10:00:00.000Z'),
+            record('i-2', state='stopped', instance_type='m5.xlarge', tags={'team': 'search'},
+                   launch_time='2016-01-15T00:00:00.000Z'),
+            record('i-3', instance_type='t2.micro', zone='eu-west-1b', tags={'team': 'ads'},
+                   launch_time='2016-02-01T12:00:00.000Z', account='prod'),
+            record('i-4', state='terminated', instance_type='t2.micro', launch_time='2016-03-01T00:00:00.000Z'),
+        ])
+
+    def query(self, expression):
+        return [instance.id for instance in self.index.query(expression)]
+
+    def test_empty_query(self):
+        self.assertEqual(self.query(''), ['i-1', 'i-2', 'i-3', 'i-4'])
+
+    def test_fields(self):
+        self.assertEqual(self.query('state=running'), ['i-1', 'i-3'])
+        self.assertEqual(self.query('zone=eu-west-1b'), ['i-3'])
+        self.assertEqual(self.query('account=prod'), ['i-3'])
+        self.assertEqual(self.query('state=pending'), [])
+
+    def test_wildcards_and_alternatives(self):
+        self.assertEqual(self.query('type=m5.*'), ['i-1', 'i-2'])
+        self.assertEqual(self.query('type=t2.*,m5.x*'), ['i-2', 'i-3', 'i-4'])
+        self.assertEqual(self.query('state=running,stopped'), ['i-1', 'i-2', 'i-3'])
+
+    def test_tags(self):
+        self.assertEqual(self.query('tag:team=search'), ['i-1', 'i-2'])
+        self.assertEqual(self.query('tag:team'), ['i-1', 'i-2', 'i-3'])
+        self.assertEqual(self.query('tag:env=p*'), ['i-1'])
+        self.assertEqual(self.query('tag:owner'), [])
+
+    def test_intersection(self):
+        self.assertEqual(self.query('state=running tag:team=search'), ['i-1'])
+        self.assertEqual(self.query('type=t2.* state=running,terminated tag:team'), ['i-3'])
+
+    def test_launch_ranges(self):
+        self.assertEqual(self.query('launched>=2016-01-15'), ['i-2', 'i-3', 'i-4'])
+        self.assertEqual(self.query('launched>2016-01-15'), ['i-3', 'i-4'])
+        self.assertEqual(self.query('launched<2016-01-15'), ['i-1'])
+        self.assertEqual(self.query('launched<=2016-01-15'), ['i-1', 'i-2'])
+        self.assertEqual(self.query('launched>=2016-01-01 launched<2016-02-01T12:00'), ['i-1', 'i-2'])
+        self.assertEqual(self.query('launched<=2015-12-31'), [])
+
+    def test_launch_range_and_fields(self):
+        self.assertEqual(self.query('launched>2016-01-01 type=t2.*'), ['i-3', 'i-4'])
+
+    def test_invalid_terms(self):
+        self.assertRaises(ValueError, self.index.query, 'colour=red')
+        self.assertRaises(ValueError, self.index.query, 'state')
+        self.assertRaises(ValueError, self.index.query, 'launched=2016-01-01')
+
+
+class BulkError(Exception):
+    """
+    EC2 error, as raised by boto
+    """
+
+    def __init__(self, error_code, status=400):
+        Exception.__init__(self, error_code)
+        self.error_code = error_code
+        self.status = status
+
+
+class FakeConnection:
+    """
+    EC2 connection failing the requests which contain some instances
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.requests = []
+
+    def stop_instances(self, instance_ids):
+        self.requests.append(list(instance_ids))
+        for instance_id in instance_ids:
+            if instance_id in self.failures:
+                raise BulkError(self.failures[instance_id])
+
+
+class FakeCompute(AwsCompute):
+    """
+    EC2 handler with a fake connection
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+class BulkChunkTest(unittest.TestCase):
+    """
+    Splitting of the failed bulk requests
+    """
+
+    def bulk_chunk(self, instance_ids, failures):
+        conn = FakeConnection(failures)
+        return FakeCompute(conn)._bulk_chunk('stop_instances', instance_ids), conn.requests
+
+    def test_success(self):
+        results, requests = self.bulk_chunk(['i-1', 'i-2', 'i-3'], {})
+        self.assertEqual(results, {'i-1': None, 'i-2': None, 'i-3': None})
+        self.assertEqual(len(requests), 1)
+
+    def test_instance_errors_are_isolated(self):
+        results, requests = self.bulk_chunk(['i-%d' % n for n in range(8)], {
+            'i-2': 'InvalidInstanceID.NotFound', 'i-5': 'IncorrectInstanceState'})
+        self.assertEqual(results['i-2'], 'InvalidInstanceID.NotFound')
+        self.assertEqual(results['i-5'], 'IncorrectInstanceState')
+        self.assertEqual(sorted(instance_id for instance_id, error in results.items() if error is None),
+                         ['i-0', 'i-1', 'i-3', 'i-4', 'i-6', 'i-7'])
+
+    def test_throttling_is_retried(self):
+        conn = FakeConnection({})
+        attempts = []
+
+        def stop_instances(instance_ids):
+            attempts.append(instance_ids)
+            if len(attempts) == 1:
+                raise BulkError('RequestLimitExceeded')
+
+        conn.stop_instances = stop_instances
+        compute = FakeCompute(conn)
+        compute.BULK_RETRY_TIMEOUT = 5
+        self.assertEqual(compute._bulk_chunk('stop_instances', ['i-1', 'i-2']), {'i-1': None, 'i-2': None})
+        self.assertEqual(len(attempts), 2)
+
+    def test_request_errors_fail_the_chunk(self):
+        results, requests = self.bulk_chunk(['i-1', 'i-2', 'i-3'], {'i-2': 'UnauthorizedOperation'})
+        self.assertEqual(results, dict((instance_id, 'UnauthorizedOperation') for instance_id in ['i-1', 'i-2', 'i-3']))
+        self.assertEqual(len(requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import threading
+import time
+import unittest
+
+from logic.parallel import fan_out, fan_out_streams, parallel_map, stream_map
+
+
+class ParallelMapTest(unittest.TestCase):
+    """
+    Concurrent map keeping the order of the items
+    """
+
+    def test_order(self):
+        self.assertEqual(parallel_map(lambda n: n * 2, range(20), 4), [n * 2 for n in range(20)])
+
+    def test_sequential(self):
+        self.assertEqual(parallel_map(lambda n: n + 1, [1], 4), [2])
+        self.assertEqual(parallel_map(lambda n: n + 1, [1, 2], 1), [2, 3])
+
+    def test_error_aborts(self):
+        def f(n):
+            if n == 3:
+                raise ValueError(n)
+            return n
+        self.assertRaises(ValueError, parallel_map, f, range(10), 4)
+
+
+class FanOutTest(unittest.TestCase):
+    """
+    Concurrent map reporting the error of each item
+    """
+
+    def test_errors_do_not_stop_the_rest(self):
+        def f(n):
+            if n % 2:
+                raise ValueError(n)
+            return n * 10
+        results = dict((item, (result, error)) for item, result, error in fan_out(f, range(6), 3))
+        self.assertEqual(sorted(results), range(6))
+        for n in range(6):
+            result, error = results[n]
+            if n % 2:
+                self.assertIsNone(result)
+                self.assertIsInstance(error, ValueError)
+            else:
+                self.assertEqual(result, n * 10)
+                self.assertIsNone(error)
+
+
+class FanOutStreamsTest(unittest.TestCase):
+    """
+    Merge of concurrent streams
+    """
+
+    def test_values_and_errors(self):
+        def stream(n):
+            for value in range(n):
+                yield n, value
+            if n == 2:
+                raise ValueError(n)
+
+        values = []
+        errors = {}
+        for item, value, error in fan_out_streams(stream, [1, 2, 3], 3, pending=2):
+            if error is not None:
+                errors[item] = error
+            else:
+                values.append(value)
+        self.assertEqual(sorted(values), [(1, 0), (2, 0), (2, 1), (3, 0), (3, 1), (3, 2)])
+        self.assertEqual(errors.keys(), [2])
+
+    def test_sequential_error(self):
+        def stream(n):
+            yield n
+            raise ValueError(n)
+        self.assertEqual([(item, value, type(error)) for item, value, error in fan_out_streams(stream, [1], 4)],
+                         [(1, 1, type(None)), (1, None, ValueError)])
+
+    def test_early_stop(self):
+        def endless(n):
+            while True:
+                yield n
+
+        stream = fan_out_streams(endless, [1, 2], 2, pending=1)
+        self.assertIn(next(stream)[1], (1, 2))
+        stream.close()
+
+
+class StreamMapTest(unittest.TestCase):
+    """
+    Concurrent map over items which are still being produced
+    """
+
+    def test_results(self):
+        self.assertEqual(sorted(stream_map(lambda n: n * 2, iter(range(50)), 4)), [n * 2 for n in range(50)])
+
+    def test_bounded_read_ahead(self):
+        read = []
+        release = threading.Event()
+
+        def items():
+            for n in range(100):
+                read.append(n)
+                yield n
+
+        def f(n):
+            release.wait(5)
+            return n
+
+        results = stream_map(f, items(), 2, pending=2)
+        consumer = threading.Thread(target=lambda: list(results))
+        consumer.start()
+        time.sleep(0.2)
+        self.assertLessEqual(len(read), 2 * 2 + 1)
+        release.set()
+        consumer.join(5)
+        self.assertEqual(len(read), 100)
+
+    def test_listing_error_is_raised(self):
+        def items():
+            yield 1
+            yield 2
+            raise IOError('listing failed')
+        self.assertRaises(IOError, list, stream_map(lambda n: n, items(), 2))
+
+    def test_function_error_is_raised(self):
+        def f(n):
+            if n == 5:
+                raise ValueError(n)
+            return n
+        self.assertRaises(ValueError, list, stream_map(f, iter(range(10)), 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
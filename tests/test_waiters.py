@@ -0,0 +1,79 @@
+import unittest
+
+from logic.waiters import Waiter
+
+
+class WaiterTest(unittest.TestCase):
+    """
+    Waits for many resources, and retries of throttled calls
+    """
+
+    def test_wait(self):
+        checks = []
+
+        def describe(ids):
+            checks.append(sorted(ids))
+            # i-1 is running from the second check, i-2 never shows up until the third one
+            states = {'i-1': 'running' if len(checks) > 1 else 'pending'}
+            if len(checks) > 2:
+                states['i-2'] = 'running'
+            return states
+
+        done, states = Waiter(describe, 0.001, 0.002).wait(['i-1', 'i-2'], 'running', timeout=5)
+        self.assertTrue(done)
+        self.assertEqual(states, {'i-1': 'running', 'i-2': 'running'})
+        self.assertEqual(checks, [['i-1', 'i-2'], ['i-1', 'i-2'], ['i-2']])
+
+    def test_failure_states(self):
+        done, states = Waiter(lambda ids: {'i-1': 'terminated', 'i-2': 'running'}, 0.001).wait(
+            ['i-1', 'i-2'], 'running', ['terminated'], timeout=5)
+        self.assertFalse(done)
+        self.assertEqual(states, {'i-1': 'terminated', 'i-2': 'running'})
+
+    def test_timeout(self):
+        done, states = Waiter(lambda ids: {}, 0.001, 0.002).wait(['i-1'], 'running', timeout=0.05)
+        self.assertFalse(done)
+        self.assertEqual(states, {'i-1': None})
+
+    def test_describe_errors_are_retried(self):
+        checks = []
+
+        def describe(ids):
+            checks.append(ids)
+            if len(checks) == 1:
+                raise IOError('throttled')
+            return {'i-1': 'available'}
+
+        self.assertTrue(Waiter(describe, 0.001).wait(['i-1'], ['available', 'in-use'], timeout=5)[0])
+
+    def test_retry(self):
+        calls = []
+
+        def f():
+            calls.append(1)
+            if len(calls) < 3:
+                raise IOError('throttled')
+            return 'done'
+
+        self.assertEqual(Waiter(initial_delay=0.001).retry(f, lambda e: isinstance(e, IOError), timeout=5), 'done')
+        self.assertEqual(len(calls), 3)
+
+    def test_retry_raises_other_errors(self):
+        calls = []
+
+        def f():
+            calls.append(1)
+            raise ValueError('invalid')
+
+        self.assertRaises(ValueError, Waiter(initial_delay=0.001).retry, f, lambda e: isinstance(e, IOError), 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_retry_timeout(self):
+        def f():
+            raise IOError('throttled')
+
+        self.assertRaises(IOError, Waiter(initial_delay=0.001, max_delay=0.002).retry, f, lambda e: True, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()